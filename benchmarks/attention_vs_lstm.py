@@ -0,0 +1,37 @@
+# Run from home directory with python benchmarks/attention_vs_lstm.py
+"""Compares the forward pass throughput of PyTorch RNNs built from lstm layers against ones built from attention layers
+as the sequence length grows"""
+import copy
+import time
+import torch
+from nn_builder.pytorch.RNN import RNN
+
+BATCH_SIZE = 32
+INPUT_DIM = 16
+HIDDEN_UNITS = 64
+SEQ_LENGTHS = [16, 64, 256, 1024]
+REPEATS = 5
+
+def time_forward_passes(network, x):
+    """Returns the number of timesteps per second the network processes in a forward pass"""
+    with torch.no_grad():
+        network(x)
+        start = time.perf_counter()
+        for _ in range(REPEATS): network(x)
+        duration = time.perf_counter() - start
+    return REPEATS * x.shape[0] * x.shape[1] / duration
+
+def main():
+    networks = {"lstm": [["lstm", HIDDEN_UNITS], ["lstm", HIDDEN_UNITS], ["linear", 1]],
+                "attention": [["attention", HIDDEN_UNITS, 4, True], ["attention", HIDDEN_UNITS, 4], ["linear", 1]]}
+    print("{:>10} {:>18} {:>18}".format("seq_length", *["{} timesteps/s".format(name) for name in networks]))
+    for seq_length in SEQ_LENGTHS:
+        x = torch.randn((BATCH_SIZE, seq_length, INPUT_DIM))
+        throughputs = []
+        for layers_info in networks.values():
+            network = RNN(input_dim=INPUT_DIM, layers_info=copy.deepcopy(layers_info), return_final_seq_only=False).eval()
+            throughputs.append(time_forward_passes(network, x))
+        print("{:>10} {:>18.0f} {:>18.0f}".format(seq_length, *throughputs))
+
+if __name__ == "__main__":
+    main()
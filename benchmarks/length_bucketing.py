@@ -0,0 +1,45 @@
+# Run from home directory with python benchmarks/length_bucketing.py
+"""Compares the training throughput of a PyTorch RNN on variable length sequences when the batches are drawn at random
+against when they are drawn by a Length_Bucket_Sampler"""
+import functools
+import time
+import torch
+from torch.utils.data import DataLoader
+from nn_builder.pytorch.Length_Bucketing import Length_Bucket_Sampler, collate_padded_sequences, padding_efficiency
+from nn_builder.pytorch.RNN import RNN
+
+NUM_SEQUENCES = 2000
+MIN_LENGTH, MAX_LENGTH = 5, 300
+BATCH_SIZE = 32
+INPUT_DIM = 8
+
+def train_for_one_epoch(data_loader):
+    """Trains a new RNN for 1 epoch and returns the number of real (non padding) timesteps processed per second"""
+    rnn = RNN(input_dim=INPUT_DIM, layers_info=[["lstm", 64], ["linear", 1]], return_final_seq_only=False)
+    optimizer = torch.optim.Adam(rnn.parameters())
+    real_timesteps = 0
+    start = time.perf_counter()
+    for x, lengths, y in data_loader:
+        mask = torch.arange(x.shape[1])[None, :] < lengths[:, None]
+        loss = ((rnn(x, lengths=lengths) - y)[mask] ** 2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        real_timesteps += int(lengths.sum())
+    return real_timesteps / (time.perf_counter() - start)
+
+def main():
+    torch.manual_seed(0)
+    lengths = torch.randint(MIN_LENGTH, MAX_LENGTH + 1, (NUM_SEQUENCES,))
+    dataset = [(sequence, sequence[:, :1].cumsum(0)) for sequence in [torch.randn((length, INPUT_DIM)) for length in lengths]]
+    collate_fn = functools.partial(collate_padded_sequences, pad_targets=True)
+    random_batches = [batch.tolist() for batch in torch.randperm(NUM_SEQUENCES).split(BATCH_SIZE)]
+    bucket_sampler = Length_Bucket_Sampler(lengths, BATCH_SIZE, batches_per_bucket=20, random_seed=0)
+    random_tokens_per_second = train_for_one_epoch(DataLoader(dataset, batch_sampler=random_batches, collate_fn=collate_fn))
+    bucket_tokens_per_second = train_for_one_epoch(DataLoader(dataset, batch_sampler=bucket_sampler, collate_fn=collate_fn))
+    print("{:>10} {:>20} {:>12}".format("batching", "padding efficiency", "tokens/s"))
+    print("{:>10} {:>20.3f} {:>12.0f}".format("random", padding_efficiency(lengths, random_batches), random_tokens_per_second))
+    print("{:>10} {:>20.3f} {:>12.0f}".format("bucketed", bucket_sampler.padding_efficiency(), bucket_tokens_per_second))
+
+if __name__ == "__main__":
+    main()
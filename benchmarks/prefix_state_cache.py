@@ -0,0 +1,45 @@
+# Run from home directory with python benchmarks/prefix_state_cache.py
+"""Measures the throughput of scoring requests that share long prefixes through a Prefix_State_Cache at different cache
+hit rates, compared to putting the whole of every request through the RNN"""
+import time
+import torch
+from nn_builder.pytorch.Prefix_State_Cache import Prefix_State_Cache
+from nn_builder.pytorch.RNN import RNN
+
+PREFIX_LENGTH = 200
+TAIL_LENGTH = 5
+INPUT_DIM = 8
+BATCH_SIZE = 64
+NUM_BATCHES = 30
+HIT_RATES = [0.0, 0.5, 0.9, 0.99]
+
+def create_batches(hit_rate):
+    """Creates batches of requests where roughly hit_rate of the prefixes have already been seen"""
+    seen_prefixes = torch.randn((10, PREFIX_LENGTH, INPUT_DIM))
+    batches = []
+    for _ in range(NUM_BATCHES):
+        prefixes = torch.randn((BATCH_SIZE, PREFIX_LENGTH, INPUT_DIM))
+        seen = torch.rand(BATCH_SIZE) < hit_rate
+        prefixes[seen] = seen_prefixes[torch.randint(0, 10, (int(seen.sum()),))]
+        batches.append(torch.cat((prefixes, torch.randn((BATCH_SIZE, TAIL_LENGTH, INPUT_DIM))), dim=1))
+    return seen_prefixes, batches
+
+def main():
+    rnn = RNN(input_dim=INPUT_DIM, layers_info=[["lstm", 128], ["gru", 128], ["linear", 1]]).eval()
+    print("{:>9} {:>15} {:>18}".format("hit rate", "no cache req/s", "prefix cache req/s"))
+    for hit_rate in HIT_RATES:
+        seen_prefixes, batches = create_batches(hit_rate)
+        cache = Prefix_State_Cache(rnn, max_entries=1000)
+        with torch.no_grad():
+            cache(torch.cat((seen_prefixes, torch.randn((10, TAIL_LENGTH, INPUT_DIM))), dim=1), PREFIX_LENGTH)
+            start = time.perf_counter()
+            for batch in batches: rnn(batch)
+            no_cache_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for batch in batches: cache(batch, PREFIX_LENGTH)
+            cache_time = time.perf_counter() - start
+        num_requests = BATCH_SIZE * NUM_BATCHES
+        print("{:>9.2f} {:>15.0f} {:>18.0f}".format(hit_rate, num_requests / no_cache_time, num_requests / cache_time))
+
+if __name__ == "__main__":
+    main()
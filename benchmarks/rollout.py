@@ -0,0 +1,35 @@
+# Run from home directory with python benchmarks/rollout.py
+"""Compares forecasting with RNN.rollout against re-running the whole history through forward for every step"""
+import time
+import torch
+from nn_builder.pytorch.RNN import RNN
+
+NUM_SERIES = 10000
+HISTORY_LENGTH = 50
+HORIZON = 100
+
+def forecast_by_rerunning_history(rnn, history, horizon):
+    """Forecasts by putting the history and all the predictions so far through forward again for each step"""
+    sequence = history
+    for _ in range(horizon):
+        prediction = rnn(sequence)
+        sequence = torch.cat((sequence, prediction.unsqueeze(1)), dim=1)
+    return sequence[:, history.shape[1]:]
+
+def main():
+    rnn = RNN(input_dim=1, layers_info=[["gru", 32], ["lstm", 32], ["linear", 1]]).eval()
+    history = torch.randn((NUM_SERIES, HISTORY_LENGTH, 1))
+    with torch.no_grad():
+        start = time.perf_counter()
+        rollout_predictions = rnn.rollout(history, HORIZON)
+        rollout_time = time.perf_counter() - start
+        start = time.perf_counter()
+        rerun_predictions = forecast_by_rerunning_history(rnn, history, HORIZON)
+        rerun_time = time.perf_counter() - start
+    assert torch.allclose(rollout_predictions, rerun_predictions, atol=1e-4)
+    print("{} series, history {}, horizon {}".format(NUM_SERIES, HISTORY_LENGTH, HORIZON))
+    print("re-running history: {:.2f}s".format(rerun_time))
+    print("rollout:            {:.2f}s".format(rollout_time))
+
+if __name__ == "__main__":
+    main()
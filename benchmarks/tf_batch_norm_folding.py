@@ -0,0 +1,35 @@
+# Run from home directory with python benchmarks/tf_batch_norm_folding.py
+"""Compares the inference throughput of TensorFlow networks with batch norm before and after folding it into the layers
+after it"""
+import time
+import numpy as np
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.NN import NN
+
+NUM_CALLS = 50
+
+def time_compiled_call(network, x):
+    """Returns the number of examples per second the compiled forward pass of the network processes"""
+    compiled_call = network.compile_call(input_signature=x.shape[1:])
+    for _ in range(3): compiled_call(x)
+    start = time.perf_counter()
+    for _ in range(NUM_CALLS): compiled_call(x)
+    return NUM_CALLS * x.shape[0] / (time.perf_counter() - start)
+
+def main():
+    networks = {"NN": (NN(layers_info=[1024, 1024, 1024, 10], batch_norm=True), np.random.random((512, 256)).astype('float32')),
+                "CNN": (CNN(layers_info=[["conv", 64, 3, 1, "valid"], ["conv", 64, 3, 1, "valid"], ["conv", 64, 3, 1, "valid"],
+                                         ["linear", 10]], batch_norm=True),
+                        np.random.random((64, 32, 32, 3)).astype('float32'))}
+    print("{:>4} {:>20} {:>19} {:>15}".format("", "batch norm examples/s", "folded examples/s", "max abs error"))
+    for name, (network, x) in networks.items():
+        for _ in range(5): network(x, training=True)
+        output = network(x, training=False)
+        batch_norm_throughput = time_compiled_call(network, x)
+        network.fold_batch_norm()
+        folded_throughput = time_compiled_call(network, x)
+        max_abs_error = np.max(np.abs(network(x, training=False) - output))
+        print("{:>4} {:>20.0f} {:>19.0f} {:>15.2e}".format(name, batch_norm_throughput, folded_throughput, max_abs_error))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# Run from home directory with python benchmarks/tf_data_format.py
+"""Compares the forward pass of a TensorFlow CNN on (batch, channels, height, width) images, as the PyTorch data pipeline
+produces them, when they have to be transposed for a channels_last network first with a channels_first network that
+takes them as they are"""
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.CNN import CNN
+
+NUM_CALLS = 20
+LAYERS_INFO = [["conv", 32, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["conv", 64, 3, 1, "same"], ["maxpool", 2, 2, "valid"],
+               ["linear", 128], ["linear", 10]]
+
+def time_call(function, x):
+    """Returns the mean number of milliseconds a call of the function takes in the fastest of 5 repeats"""
+    function(x)
+    repeat_milliseconds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(NUM_CALLS): function(x)
+        repeat_milliseconds.append((time.perf_counter() - start) / NUM_CALLS * 1000)
+    return min(repeat_milliseconds)
+
+def main():
+    channels_last_cnn = CNN(layers_info=LAYERS_INFO)
+    channels_first_cnn = CNN(layers_info=LAYERS_INFO, data_format="channels_first")
+    transpose_then_call = tf.function(lambda x: channels_last_cnn(tf.transpose(x, [0, 2, 3, 1]), training=False))
+    call = tf.function(lambda x: channels_first_cnn(x, training=False))
+    print("{:>6} {:>24} {:>16}".format("batch", "transpose + channels_last", "channels_first"))
+    for batch_size in [16, 128]:
+        x = tf.constant(np.random.random((batch_size, 3, 32, 32)).astype('float32'))
+        print("{:>6} {:>22.2f}ms {:>14.2f}ms".format(batch_size, time_call(transpose_then_call, x), time_call(call, x)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# Run from home directory with python benchmarks/tf_distribute.py
+"""Measures how the training throughput of a TensorFlow NN with batch norm and dropout scales when it is created with
+distribute to train on 1, 2, 4 and 8 replicas on logical CPU devices of this machine"""
+import os
+import time
+import numpy as np
+from nn_builder.tensorflow.Base_Network import Base_Network
+from nn_builder.tensorflow.NN import NN
+
+NUM_EPOCHS = 3
+BATCH_SIZE = 1024
+REPLICAS = [1, 2, 4, 8]
+
+def measure_examples_per_second(distribute, X, y):
+    """Returns the number of examples per second a network created with distribute trains on after a warm up epoch"""
+    nn_instance = NN(layers_info=[512, 512, 256, 1], batch_norm=True, dropout=0.1, distribute=distribute)
+    nn_instance.compile(optimizer="adam", loss="mse")
+    nn_instance.fit(X, y, batch_size=BATCH_SIZE, epochs=1, verbose=0)
+    start = time.perf_counter()
+    nn_instance.fit(X, y, batch_size=BATCH_SIZE, epochs=NUM_EPOCHS, verbose=0)
+    return NUM_EPOCHS * len(X) / (time.perf_counter() - start)
+
+def main():
+    Base_Network.split_cpu_into_devices(max(REPLICAS))
+    X = np.random.random((65536, 64)).astype('float32')
+    y = np.sum(X[:, :8], axis=1, keepdims=True)
+    print("{} CPU cores".format(os.cpu_count()))
+    print("{:>9} {:>12} {:>8}".format("replicas", "examples/s", "speedup"))
+    single_replica = measure_examples_per_second(None, X, y)
+    print("{:>9} {:>12.0f} {:>8.2f}".format("none", single_replica, 1.0))
+    for replicas in REPLICAS:
+        examples_per_second = measure_examples_per_second(replicas, X, y)
+        print("{:>9} {:>12.0f} {:>8.2f}".format(replicas, examples_per_second, examples_per_second / single_replica))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Run from home directory with python benchmarks/tf_eager_call_overhead.py
+"""Measures the per call overhead of eagerly calling small TensorFlow networks on small batches, where the time is
+dominated by Python and layer overhead rather than by the maths"""
+import time
+import numpy as np
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+
+NUM_CALLS = 300
+
+def time_call(network, x):
+    """Returns the mean number of microseconds per eager call of the network"""
+    for _ in range(10): network(x, training=False)
+    start = time.perf_counter()
+    for _ in range(NUM_CALLS): network(x, training=False)
+    return (time.perf_counter() - start) / NUM_CALLS * 1e6
+
+def main():
+    nn_x = np.random.random((8, 6)).astype('float32')
+    nn_x[:, :2] = np.round(nn_x[:, :2] * 5)
+    networks = {
+        "NN": (NN(layers_info=[16, 16, [2, 3, 1]], output_activation=["softmax", None, "sigmoid"],
+                  columns_of_data_to_be_embedded=[0, 1], embedding_dimensions=[[10, 3], [10, 2]]), nn_x),
+        "CNN": (CNN(layers_info=[["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"], [["linear", 2], ["linear", 3]]],
+                    output_activation=["softmax", None]), np.random.random((8, 8, 8, 1)).astype('float32')),
+        "RNN": (RNN(layers_info=[["gru", 16], [["linear", 2], ["linear", 3]]], output_activation=["softmax", None],
+                    columns_of_data_to_be_embedded=[0, 1], embedding_dimensions=[[10, 3], [10, 2]]),
+                np.round(np.random.random((8, 5, 6)).astype('float32') * 5))}
+    for name, (network, x) in networks.items():
+        print("{:>4}: {:>8.0f} microseconds per call".format(name, time_call(network, x)))
+
+if __name__ == "__main__":
+    main()
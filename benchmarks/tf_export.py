@@ -0,0 +1,33 @@
+# Run from home directory with python benchmarks/tf_export.py
+"""Reports the size, error and latency of TensorFlow networks exported as a SavedModel and as quantized TFLite models"""
+import os
+import tempfile
+import numpy as np
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+
+def create_networks():
+    """Creates a small NN, CNN and RNN along with example inputs and export settings for them"""
+    return {"NN": (NN(layers_info=[256, 256, 10]), np.random.random((64, 32)).astype('float32'), None,
+                   ["saved_model", None, "dynamic", "int8"]),
+            "CNN": (CNN(layers_info=[["conv", 32, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["conv", 64, 3, 1, "same"],
+                                     ["linear", 10]]), np.random.random((64, 16, 16, 3)).astype('float32'), None,
+                    ["saved_model", None, "dynamic", "int8"]),
+            "RNN": (RNN(layers_info=[["lstm", 128], ["lstm", 128], ["linear", 10]]),
+                    np.random.random((8, 20, 16)).astype('float32'), 8, ["saved_model", None, "dynamic"])}
+
+def main():
+    directory = tempfile.mkdtemp()
+    print("{:>4} {:>12} {:>10} {:>14} {:>11}".format("", "variant", "size KB", "max abs error", "latency ms"))
+    for name, (network, x, batch_size, variants) in create_networks().items():
+        for variant in variants:
+            if variant == "saved_model": kwargs = {"format": "saved_model"}
+            else: kwargs = {"format": "tflite", "quantize": variant}
+            path = os.path.join(directory, "{}_{}".format(name, variant) + (".tflite" if variant != "saved_model" else ""))
+            report = network.export_for_serving(path, x.shape[1:], representative_data=x, batch_size=batch_size, **kwargs)
+            print("{:>4} {:>12} {:>10.1f} {:>14.2e} {:>11.3f}".format(name, str(variant), report["size_bytes"] / 1024,
+                                                                    report["max_abs_error"], report["latency_ms"]))
+
+if __name__ == "__main__":
+    main()
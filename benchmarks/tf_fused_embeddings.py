@@ -0,0 +1,63 @@
+# Run from home directory with python benchmarks/tf_fused_embeddings.py
+"""Compares putting the columns of data to be embedded through 1 Embedding layer each, as the TensorFlow networks used
+to, with the fused embedding layer that stacks the tables and gathers every column with the same embedding size at once"""
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import ops
+from nn_builder.tensorflow.NN import NN
+
+NUM_CALLS = 50
+EMBEDDING_COLUMNS = list(range(0, 16, 2))
+
+def time_call(function, *args):
+    """Returns the mean number of milliseconds a call of the function takes in the fastest of 5 repeats"""
+    function(*args)
+    repeat_milliseconds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(NUM_CALLS): function(*args)
+        repeat_milliseconds.append((time.perf_counter() - start) / NUM_CALLS * 1000)
+    return min(repeat_milliseconds)
+
+def create_separate_embedding_layers(nn_instance):
+    """Returns 1 Embedding layer per column holding the same embeddings as the network's fused embedding layer"""
+    embedding_layers = []
+    for embedding_ix, (input_dim, output_dim) in enumerate(nn_instance.embedding_dimensions):
+        embedding_layer = tf.keras.layers.Embedding(input_dim, output_dim)
+        embedding_layer.build((None,))
+        embedding_layer.set_weights([nn_instance.embedding_layer.get_embeddings(embedding_ix)])
+        embedding_layers.append(embedding_layer)
+    return embedding_layers
+
+def incorporate_embeddings_separately(x, embedding_layers):
+    """Embeds each column with its own Embedding layer the way the networks did before the embeddings were fused"""
+    all_embedded_data = ops.concatenate([embedding_layers[embedding_ix](x[:, column])
+                                         for embedding_ix, column in enumerate(EMBEDDING_COLUMNS)], axis=1)
+    non_embedded_columns = [col for col in range(x.shape[1]) if col not in EMBEDDING_COLUMNS]
+    return ops.concatenate([ops.take(x, non_embedded_columns, axis=1), all_embedded_data], axis=1)
+
+def create_data(batch_size, embedding_dimensions):
+    """Returns a batch of data with valid integers in the columns to be embedded"""
+    x = np.random.random((batch_size, 16)).astype('float32')
+    for column, (input_dim, _) in zip(EMBEDDING_COLUMNS, embedding_dimensions):
+        x[:, column] = np.random.randint(0, input_dim, batch_size)
+    return tf.constant(x)
+
+def main():
+    print("{:>6} {:>6} {:>9} {:>9} {:>15}".format("tables", "batch", "", "eager ms", "tf.function ms"))
+    for embedding_dimensions in [[[1000, 16]] * 8, [[1000, 16]] * 6 + [[50, 4]] * 2]:
+        nn_instance = NN(layers_info=[64, 1], columns_of_data_to_be_embedded=EMBEDDING_COLUMNS,
+                         embedding_dimensions=embedding_dimensions)
+        nn_instance(create_data(1, embedding_dimensions))
+        embedding_layers = create_separate_embedding_layers(nn_instance)
+        separate = lambda x: incorporate_embeddings_separately(x, embedding_layers)
+        for batch_size in [16, 256, 4096]:
+            x = create_data(batch_size, embedding_dimensions)
+            assert np.array_equal(separate(x), nn_instance.incorporate_embeddings(x))
+            for name, function in [("separate", separate), ("fused", nn_instance.incorporate_embeddings)]:
+                print("{:>6} {:>6} {:>9} {:>9.2f} {:>15.2f}".format(len(nn_instance.embedding_layer.tables), batch_size, name,
+                                                                   time_call(function, x), time_call(tf.function(function), x)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# Run from home directory with python benchmarks/tf_fused_output_heads.py
+"""Compares the forward pass of a TensorFlow NN with 20 output heads when each head is its own Dense layer, as the
+networks used to create them, with fuse_output_heads where the heads are 1 Dense layer whose output gets split for the
+activations of the heads"""
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.NN import NN
+
+NUM_CALLS = 50
+NUM_HEADS = 20
+
+def time_call(function, x):
+    """Returns the mean number of milliseconds a call of the function takes in the fastest of 5 repeats"""
+    function(x)
+    repeat_milliseconds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(NUM_CALLS): function(x)
+        repeat_milliseconds.append((time.perf_counter() - start) / NUM_CALLS * 1000)
+    return min(repeat_milliseconds)
+
+def main():
+    print("{:>12} {:>6} {:>9} {:>9} {:>15}".format("activations", "batch", "", "eager ms", "tf.function ms"))
+    for name, output_activation in [("same", ["sigmoid"] * NUM_HEADS), ("per head", ["softmax", "sigmoid"] * (NUM_HEADS // 2))]:
+        networks = [NN(layers_info=[256, 256, [4] * NUM_HEADS], output_activation=output_activation,
+                       fuse_output_heads=fuse_output_heads) for fuse_output_heads in [False, True]]
+        for network in networks: network(tf.zeros((1, 64)))
+        networks[1].set_weights(networks[1].fuse_output_head_weights(networks[0].get_weights()))
+        for batch_size in [16, 256, 4096]:
+            x = tf.constant(np.random.random((batch_size, 64)).astype('float32'))
+            assert np.allclose(networks[0](x, training=False), networks[1](x, training=False), atol=1e-5)
+            for network_name, network in zip(["per head", "fused"], networks):
+                call = lambda x: network(x, training=False)
+                print("{:>12} {:>6} {:>9} {:>9.2f} {:>15.2f}".format(name, batch_size, network_name, time_call(call, x),
+                                                                    time_call(tf.function(call), x)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Run from home directory with python benchmarks/tf_input_pipeline.py
+"""Compares training a TensorFlow CNN on batches of standardised images made in a Python loop with training it on batches
+from an Input_Pipeline and reports how much of the time each spends waiting for its input"""
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.Input_Pipeline import Input_Pipeline
+
+NUM_EPOCHS = 5
+BATCH_SIZE = 64
+
+def create_train_step(network):
+    """Returns a compiled training step for the network"""
+    optimizer = tf.keras.optimizers.Adam()
+    @tf.function(reduce_retracing=True)
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.keras.losses.sparse_categorical_crossentropy(y, network(x, training=True)))
+        optimizer.apply_gradients(zip(tape.gradient(loss, network.trainable_variables), network.trainable_variables))
+    return train_step
+
+def standardise(image):
+    """Scales an image to have a mean of 0 and a standard deviation of 1"""
+    return (image - image.mean()) / max(image.std(), 1e-6)
+
+def python_batches(images, labels):
+    """Yields shuffled batches that get standardised one image at a time in Python"""
+    indices = np.random.permutation(len(images))
+    for start in range(0, len(images), BATCH_SIZE):
+        batch_indices = indices[start:start + BATCH_SIZE]
+        yield np.stack([standardise(images[ix].astype(np.float32)) for ix in batch_indices]), labels[batch_indices]
+
+def time_training(batches_per_epoch, train_step):
+    """Returns the examples per second and the fraction of the time spent waiting for batches"""
+    stall_seconds, examples = 0.0, 0
+    start = time.perf_counter()
+    for epoch in range(NUM_EPOCHS):
+        iterator = iter(batches_per_epoch())
+        while True:
+            wait_start = time.perf_counter()
+            try: x, y = next(iterator)
+            except StopIteration: break
+            stall_seconds += time.perf_counter() - wait_start
+            train_step(x, y)
+            examples += len(y)
+    total_seconds = time.perf_counter() - start
+    return examples / total_seconds, stall_seconds / total_seconds
+
+def create_cnn():
+    """Creates a small image classifier"""
+    return CNN(layers_info=[["conv", 8, 3, 2, "valid"], ["maxpool", 2, 2, "valid"], ["linear", 10]], output_activation="softmax")
+
+def main():
+    images = np.random.randint(0, 255, (10000, 32, 32, 3)).astype(np.uint8)
+    labels = np.random.randint(0, 10, 10000)
+    python_throughput, python_stall = time_training(lambda: python_batches(images, labels), create_train_step(create_cnn()))
+    cnn = create_cnn()
+    start = time.perf_counter()
+    pipeline = Input_Pipeline(cnn, images, labels, batch_size=BATCH_SIZE,
+                              map_fn=lambda x, y: (tf.image.per_image_standardization(x), y), random_seed=0)
+    creation_seconds = time.perf_counter() - start
+    pipeline_throughput, pipeline_stall = time_training(lambda: pipeline, create_train_step(cnn))
+    print("{:>15} {:>12} {:>15}".format("", "examples/s", "stall fraction"))
+    print("{:>15} {:>12.0f} {:>15.2f}".format("Python batches", python_throughput, python_stall))
+    print("{:>15} {:>12.0f} {:>15.2f}".format("Input_Pipeline", pipeline_throughput, pipeline_stall))
+    print("Creating the Input_Pipeline, which standardises every image once, took {:.2f}s".format(creation_seconds))
+    print("Input_Pipeline stall report:", pipeline.stall_report())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+# Run from home directory with python benchmarks/tf_mixed_precision.py
+"""Compares the inference throughput of TensorFlow networks with the float32 and mixed_bfloat16 dtype policies"""
+import time
+import numpy as np
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+
+NUM_CALLS = 20
+
+def time_compiled_call(network, x):
+    """Returns the number of examples per second the compiled forward pass of the network processes"""
+    compiled_call = network.compile_call(input_signature=x.shape[1:])
+    for _ in range(3): compiled_call(x)
+    start = time.perf_counter()
+    for _ in range(NUM_CALLS): compiled_call(x)
+    return NUM_CALLS * x.shape[0] / (time.perf_counter() - start)
+
+def create_networks(dtype_policy):
+    """Creates a medium sized NN, CNN and RNN with the given dtype policy along with inputs for them"""
+    return {"NN": (NN(layers_info=[1024, 1024, 1024, 10], dtype_policy=dtype_policy),
+                   np.random.random((512, 256)).astype('float32')),
+            "CNN": (CNN(layers_info=[["conv", 64, 3, 1, "same"], ["conv", 64, 3, 1, "same"], ["maxpool", 2, 2, "valid"],
+                                     ["conv", 128, 3, 1, "same"], ["linear", 10]], dtype_policy=dtype_policy),
+                    np.random.random((64, 32, 32, 3)).astype('float32')),
+            "RNN": (RNN(layers_info=[["lstm", 256], ["lstm", 256], ["linear", 10]], dtype_policy=dtype_policy),
+                    np.random.random((128, 50, 32)).astype('float32'))}
+
+def main():
+    float32_networks, bfloat16_networks = create_networks("float32"), create_networks("mixed_bfloat16")
+    print("{:>4} {:>18} {:>25}".format("", "float32 examples/s", "mixed_bfloat16 examples/s"))
+    for name in float32_networks:
+        print("{:>4} {:>18.0f} {:>25.0f}".format(name, time_compiled_call(*float32_networks[name]),
+                                                 time_compiled_call(*bfloat16_networks[name])))
+
+if __name__ == "__main__":
+    main()
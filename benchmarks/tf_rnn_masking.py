@@ -0,0 +1,36 @@
+# Run from home directory with python benchmarks/tf_rnn_masking.py
+"""Compares putting a batch of short sequences padded to a long length through a TensorFlow RNN as they are with giving
+the RNN a mask or a ragged tensor so that it skips the padding"""
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.RNN import RNN
+
+NUM_CALLS = 10
+
+def time_call(function, *args):
+    """Returns the mean number of milliseconds a call of the function takes"""
+    function(*args)
+    start = time.perf_counter()
+    for _ in range(NUM_CALLS): function(*args)
+    return (time.perf_counter() - start) / NUM_CALLS * 1000
+
+def main():
+    lengths = np.random.randint(10, 60, 128)
+    x = np.random.random((128, 400, 16)).astype('float32')
+    mask = np.arange(400)[None, :] < lengths[:, None]
+    x[~mask] = 0.0
+    ragged_x = tf.RaggedTensor.from_tensor(x, lengths=lengths)
+    rnn = RNN(layers_info=[["lstm", 128], ["gru", 128], ["linear", 10]])
+    padded_call = tf.function(lambda x: rnn(x, training=False), reduce_retracing=True)
+    masked_call = tf.function(lambda x, mask: rnn(x, training=False, mask=mask), reduce_retracing=True)
+    ragged_call = tf.function(lambda x: rnn(x, training=False), reduce_retracing=True)
+    expected = np.stack([rnn(x[ix:ix + 1, :length], training=False)[0] for ix, length in enumerate(lengths[:8])])
+    print("{:>8} {:>10} {:>22}".format("", "ms/batch", "max error (8 samples)"))
+    for name, milliseconds, output in [("padded", time_call(padded_call, x), padded_call(x)),
+                                       ("mask", time_call(masked_call, x, mask), masked_call(x, mask)),
+                                       ("ragged", time_call(ragged_call, ragged_x), ragged_call(ragged_x))]:
+        print("{:>8} {:>10.1f} {:>22.2e}".format(name, milliseconds, np.max(np.abs(np.asarray(output)[:8] - expected))))
+
+if __name__ == "__main__":
+    main()
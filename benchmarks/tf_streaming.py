@@ -0,0 +1,41 @@
+# Run from home directory with python benchmarks/tf_streaming.py
+"""Compares the latency of getting the output for the newest chunk of many streams by putting each stream's whole history
+through a TensorFlow RNN again, as was needed without keeping state between calls, with stepping the streams chunk by
+chunk with a Stream_Manager that carries each stream's state on from its previous chunk"""
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.RNN import RNN
+from nn_builder.tensorflow.Stream_Manager import Stream_Manager
+
+NUM_STREAMS = 64
+CHUNK_LENGTH = 8
+NUM_FEATURES = 16
+HISTORY_LENGTHS = [64, 256, 1024]
+
+def main():
+    rnn = RNN(layers_info=[["gru", 64], ["lstm", 64], ["linear", 1]], return_final_seq_only=False)
+    recompute_history = tf.function(lambda x: rnn(x, training=False)[:, -CHUNK_LENGTH:], reduce_retracing=True)
+    manager = Stream_Manager(rnn, initial_capacity=NUM_STREAMS)
+    stream_ids = list(range(NUM_STREAMS))
+    data = np.random.random((NUM_STREAMS, max(HISTORY_LENGTHS), NUM_FEATURES)).astype('float32')
+    print("{:>8} {:>14} {:>14}".format("history", "recompute ms", "streaming ms"))
+    history_length = 0
+    for next_history_length in HISTORY_LENGTHS:
+        while history_length < next_history_length - CHUNK_LENGTH:
+            manager.step(stream_ids, data[:, history_length:history_length + CHUNK_LENGTH])
+            history_length += CHUNK_LENGTH
+        chunk = data[:, history_length:history_length + CHUNK_LENGTH]
+        recompute_history(data[:, :history_length + CHUNK_LENGTH])
+        start = time.perf_counter()
+        recomputed = recompute_history(data[:, :history_length + CHUNK_LENGTH])
+        recompute_milliseconds = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        streamed = manager.step(stream_ids, chunk)
+        streaming_milliseconds = (time.perf_counter() - start) * 1000
+        history_length += CHUNK_LENGTH
+        assert np.allclose(recomputed, streamed, atol=1e-4)
+        print("{:>8} {:>14.1f} {:>14.1f}".format(history_length, recompute_milliseconds, streaming_milliseconds))
+
+if __name__ == "__main__":
+    main()
@@ -80,11 +80,17 @@ class Base_Network(Overall_Base_Network, ABC):
         initialiser = self.str_to_initialiser_converter[self.initialiser.lower()]
         if initialiser != "use_default":
             for parameters in parameters_list:
-                if type(parameters) == nn.Linear or type(parameters) == nn.Conv2d:
+                if type(parameters) in [nn.Linear, nn.Conv1d, nn.Conv2d]:
                     initialiser(parameters.weight)
                 elif type(parameters) in [nn.LSTM, nn.RNN, nn.GRU]:
                     initialiser(parameters.weight_hh_l0)
                     initialiser(parameters.weight_ih_l0)
+                    if parameters.bidirectional:
+                        initialiser(parameters.weight_hh_l0_reverse)
+                        initialiser(parameters.weight_ih_l0_reverse)
+                elif type(parameters) == nn.MultiheadAttention:
+                    initialiser(parameters.in_proj_weight)
+                    initialiser(parameters.out_proj.weight)
 
     def flatten_tensor(self, tensor):
         """Flattens a tensor of shape (a, b, c, d, ...) into shape (a, b * c * d * .. )"""
@@ -0,0 +1,51 @@
+import math
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
+
+class Causal_Self_Attention(nn.Module):
+    """Multi-head self-attention with a causal mask and a residual connection for sequences of shape
+    (batch, seq length, features). Each output timestep attends to the current and all previous timesteps and, unlike a
+    recurrent layer, all timesteps get computed in parallel
+    Args:
+        - input_dim: Integer to indicate the number of features of the input
+        - d_model: Integer to indicate the number of features of the output. Must be divisible by n_heads
+        - n_heads: Integer to indicate the number of attention heads
+        - positional_encoding: Boolean to indicate whether sinusoidal positional encodings get added to the input
+
+    NOTE that like nn.LSTM its forward method accepts a PackedSequence and returns (output, state) where state is always
+    None because the layer can't carry on from a previous chunk of the sequences
+    """
+    def __init__(self, input_dim, d_model, n_heads, positional_encoding=False):
+        super().__init__()
+        self.input_dim = input_dim
+        self.d_model = d_model
+        self.n_heads = n_heads
+        self.positional_encoding = positional_encoding
+        if input_dim != d_model: self.input_projection = nn.Linear(input_dim, d_model)
+        else: self.input_projection = None
+        self.attention = nn.MultiheadAttention(d_model, n_heads, batch_first=True)
+
+    def forward(self, x, state=None):
+        """Runs causal self-attention over x"""
+        assert state is None, "Causal_Self_Attention layers can't carry on from a previous state"
+        packed = isinstance(x, PackedSequence)
+        if packed: x, lengths = pad_packed_sequence(x, batch_first=True)
+        if self.input_projection is not None: x = self.input_projection(x)
+        seq_length = x.shape[1]
+        if self.positional_encoding: x = x + self.calculate_positional_encoding(seq_length, x.device, x.dtype)
+        causal_mask = torch.triu(torch.ones((seq_length, seq_length), dtype=torch.bool, device=x.device), diagonal=1)
+        attention_output, _ = self.attention(x, x, x, attn_mask=causal_mask, need_weights=False)
+        out = x + attention_output
+        if packed: out = pack_padded_sequence(out, lengths, batch_first=True, enforce_sorted=False)
+        return out, None
+
+    def calculate_positional_encoding(self, seq_length, device, dtype):
+        """Returns the sinusoidal positional encodings of shape (seq_length, d_model)"""
+        positions = torch.arange(seq_length, device=device, dtype=dtype).unsqueeze(1)
+        frequencies = torch.arange(0, self.d_model, 2, device=device, dtype=dtype)
+        frequencies = torch.exp(frequencies * (-math.log(10000.0) / self.d_model))
+        encoding = torch.zeros((seq_length, self.d_model), device=device, dtype=dtype)
+        encoding[:, 0::2] = torch.sin(positions * frequencies)
+        encoding[:, 1::2] = torch.cos(positions * frequencies[:self.d_model // 2])
+        return encoding
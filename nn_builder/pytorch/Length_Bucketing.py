@@ -0,0 +1,95 @@
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Sampler
+
+class Length_Bucket_Sampler(Sampler):
+    """Batch sampler that groups variable length sequences of similar length together so that less padding is needed. Each
+    epoch the sequences are shuffled, split into buckets of batch_size * batches_per_bucket sequences, sorted by length
+    within each bucket and then cut into batches. The order of the batches is then shuffled so the randomness is kept
+    across buckets. Provide it to a DataLoader as the batch_sampler along with collate_padded_sequences as the collate_fn
+    Args:
+        - lengths: List or 1D tensor of the length of each sequence in the dataset
+        - batch_size: Integer to indicate the number of sequences in each batch
+        - batches_per_bucket: Integer to indicate how many batches worth of sequences get sorted together. Larger buckets
+                              mean less padding but less random batches. Default is 50
+        - shuffle: Boolean to indicate whether to shuffle the sequences and batches each epoch. If False the whole dataset
+                   is sorted by length. Default is True
+        - drop_last: Boolean to indicate whether to drop the final batch of each bucket if it is smaller than batch_size.
+                     Default is False
+        - random_seed: Integer to indicate the random seed you want to use for the shuffling. Default is no seed
+    """
+    def __init__(self, lengths, batch_size, batches_per_bucket=50, shuffle=True, drop_last=False, random_seed=None):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.batches_per_bucket = batches_per_bucket
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = torch.Generator()
+        if random_seed is not None: self.generator.manual_seed(random_seed)
+        self.check_all_user_inputs_valid()
+        self.last_batches = None
+
+    def check_all_user_inputs_valid(self):
+        """Checks that all the user inputs were valid"""
+        assert self.lengths.dim() == 1 and len(self.lengths) > 0, "lengths must be a non-empty list or 1D tensor"
+        assert torch.all(self.lengths > 0), "All lengths must be 1 or higher"
+        assert isinstance(self.batch_size, int) and self.batch_size > 0, "batch_size must be an integer of 1 or higher"
+        assert isinstance(self.batches_per_bucket, int) and self.batches_per_bucket > 0, \
+            "batches_per_bucket must be an integer of 1 or higher"
+        assert isinstance(self.shuffle, bool), "shuffle must be a boolean"
+        assert isinstance(self.drop_last, bool), "drop_last must be a boolean"
+
+    def __iter__(self):
+        batches = self.create_batches()
+        self.last_batches = batches
+        return iter(batches)
+
+    def __len__(self):
+        bucket_size = self.batch_size * self.batches_per_bucket
+        full_buckets, final_bucket_size = divmod(len(self.lengths), bucket_size)
+        if not self.shuffle: full_buckets, final_bucket_size = 0, len(self.lengths)
+        if self.drop_last: return full_buckets * self.batches_per_bucket + final_bucket_size // self.batch_size
+        return full_buckets * self.batches_per_bucket + -(-final_bucket_size // self.batch_size)
+
+    def create_batches(self):
+        """Returns a list of batches for 1 epoch where each batch is a list of the indices of the sequences in it"""
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=self.generator)
+            buckets = torch.split(indices, self.batch_size * self.batches_per_bucket)
+        else: buckets = [torch.arange(len(self.lengths))]
+        batches = []
+        for bucket in buckets:
+            bucket = bucket[torch.argsort(self.lengths[bucket], descending=True, stable=True)]
+            for batch in torch.split(bucket, self.batch_size):
+                if self.drop_last and len(batch) < self.batch_size: continue
+                batches.append(batch.tolist())
+        if self.shuffle: batches = [batches[ix] for ix in torch.randperm(len(batches), generator=self.generator)]
+        return batches
+
+    def padding_efficiency(self):
+        """Returns the fraction of the padded timesteps that are real timesteps for the batches of the most recent epoch, or
+        for a newly drawn epoch if the sampler hasn't been iterated over yet"""
+        batches = self.last_batches if self.last_batches is not None else self.create_batches()
+        return padding_efficiency(self.lengths, batches)
+
+def padding_efficiency(lengths, batches):
+    """Returns the fraction of the timesteps in the padded batches that are real timesteps rather than padding"""
+    lengths = torch.as_tensor(lengths)
+    real_timesteps = sum(int(lengths[batch].sum()) for batch in batches)
+    padded_timesteps = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    return real_timesteps / padded_timesteps
+
+def collate_padded_sequences(batch, pad_targets=False):
+    """Collate function for a DataLoader that pads a batch of variable length sequences to the same length. The batch can
+    be a list of sequences of shape (seq length, features) or a list of (sequence, target) pairs. It returns
+    (x, lengths) or (x, lengths, y) where x has shape (batch, max seq length, features) and lengths can be given straight
+    to the forward method of an RNN. If pad_targets is True then the targets are sequences that get padded too, otherwise
+    they get stacked. Use functools.partial to set pad_targets when giving this to a DataLoader"""
+    has_targets = isinstance(batch[0], (tuple, list))
+    sequences = [item[0] for item in batch] if has_targets else batch
+    lengths = torch.tensor([len(sequence) for sequence in sequences])
+    x = pad_sequence(sequences, batch_first=True)
+    if not has_targets: return x, lengths
+    targets = [torch.as_tensor(item[1]) for item in batch]
+    y = pad_sequence(targets, batch_first=True) if pad_targets else torch.stack(targets)
+    return x, lengths, y
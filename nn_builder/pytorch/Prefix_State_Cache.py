@@ -0,0 +1,129 @@
+import hashlib
+from collections import OrderedDict
+import torch
+from nn_builder.pytorch.RNN import RNN
+from nn_builder.pytorch.Temporal_Convolution import Temporal_Convolution
+
+class Prefix_State_Cache(object):
+    """Least recently used cache of the recurrent state of a PyTorch RNN after it has processed a prefix of a sequence. It
+    is for scoring requests that share a long common prefix (e.g. the same user history followed by different candidates).
+    The state at the end of each prefix is cached under a hash of the prefix so later requests with the same prefix only
+    need to run their tail through the network
+    Args:
+        - rnn: The nn_builder PyTorch RNN to cache the states of. It must be possible to stream data through it
+        - max_entries: Integer to indicate the maximum number of prefix states to keep. Default is no limit
+        - max_bytes: Integer to indicate the maximum number of bytes of state tensors to keep. Default is no limit
+
+    NOTE that the cached states are only valid while the parameters of the rnn don't change, so call clear after each
+    parameter update. The rnn should also be in eval mode so that putting a prefix through it is deterministic
+    """
+    def __init__(self, rnn, max_entries=None, max_bytes=None):
+        self.rnn = rnn
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.check_all_user_inputs_valid()
+        self.layers = list(self.rnn.hidden_layers) + list(self.rnn.output_layers)
+        self.cache = OrderedDict()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check_all_user_inputs_valid(self):
+        """Checks that all the user inputs were valid"""
+        assert isinstance(self.rnn, RNN), "rnn must be an nn_builder PyTorch RNN"
+        self.rnn.check_network_can_stream()
+        for limit in [self.max_entries, self.max_bytes]:
+            assert limit is None or (isinstance(limit, int) and limit > 0), "max_entries and max_bytes must be None or a positive integer"
+
+    def __call__(self, x, prefix_length):
+        """Puts the sequences x of shape (batch, seq length, features) through the rnn where the first prefix_length
+        timesteps of each sequence are its prefix. Prefixes found in the cache are skipped and the states of the other
+        distinct prefixes get computed in 1 batch and cached. Returns the output of the rnn for the timesteps after the prefix"""
+        assert 0 < prefix_length < x.shape[1], "prefix_length must be between 1 and the sequence length - 1"
+        prefixes = x[:, :prefix_length]
+        keys = [self.hash_prefix(prefix) for prefix in prefixes]
+        key_to_state = {}
+        missed_rows = {}
+        for row, key in enumerate(keys):
+            if key in key_to_state or key in missed_rows: self.hits += 1
+            else:
+                key_to_state[key] = self.lookup(key)
+                if key_to_state[key] is None: missed_rows[key] = row
+        if len(missed_rows) > 0:
+            with torch.no_grad():
+                _, missed_state = self.rnn(prefixes[list(missed_rows.values())],
+                                           state=self.rnn.init_state(len(missed_rows)))
+            for missed_ix, key in enumerate(missed_rows):
+                key_to_state[key] = self.select_row_of_state(missed_state, missed_ix)
+                self.store(key, key_to_state[key])
+        out, _ = self.rnn(x[:, prefix_length:], state=self.concatenate_states([key_to_state[key] for key in keys]))
+        return out
+
+    def hash_prefix(self, prefix):
+        """Returns the cache key for a prefix of shape (prefix length, features)"""
+        prefix = prefix.detach().contiguous().cpu()
+        digest = hashlib.sha1(prefix.numpy().tobytes()).hexdigest()
+        return digest, tuple(prefix.shape), str(prefix.dtype)
+
+    def lookup(self, key):
+        """Returns the cached state for the key, marking it as the most recently used, or None if it isn't cached"""
+        if key not in self.cache:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def store(self, key, state):
+        """Caches the state under the key and then evicts the least recently used states until the cache is within its
+        memory bounds"""
+        self.cache[key] = state
+        self.bytes_used += self.calculate_state_bytes(state)
+        while (self.max_entries is not None and len(self.cache) > self.max_entries) or \
+                (self.max_bytes is not None and self.bytes_used > self.max_bytes and len(self.cache) > 0):
+            _, evicted_state = self.cache.popitem(last=False)
+            self.bytes_used -= self.calculate_state_bytes(evicted_state)
+            self.evictions += 1
+
+    def clear(self):
+        """Removes every cached state. The hit, miss and eviction counters are kept"""
+        self.cache.clear()
+        self.bytes_used = 0
+
+    def hit_rate(self):
+        """Returns the fraction of prefix lookups that were found in the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def calculate_state_bytes(self, state):
+        """Returns the number of bytes used by the tensors in a state"""
+        total_bytes = 0
+        for layer_state in state:
+            if layer_state is None: continue
+            for tensor in (layer_state if isinstance(layer_state, tuple) else (layer_state,)):
+                total_bytes += tensor.element_size() * tensor.nelement()
+        return total_bytes
+
+    def select_row_of_state(self, state, row):
+        """Returns the state of 1 sequence from the state of a batch of sequences. The tensors are cloned so that the
+        cached state doesn't keep the rest of the batch's state in memory"""
+        row_state = []
+        for layer, layer_state in zip(self.layers, state):
+            if layer_state is None: row_state.append(None)
+            elif type(layer) == Temporal_Convolution: row_state.append(layer_state[row:row+1].clone())
+            elif isinstance(layer_state, tuple): row_state.append(tuple(tensor[:, row:row+1].clone() for tensor in layer_state))
+            else: row_state.append(layer_state[:, row:row+1].clone())
+        return row_state
+
+    def concatenate_states(self, states):
+        """Concatenates the states of individual sequences into the state of a batch of sequences"""
+        batch_state = []
+        for layer_ix, layer in enumerate(self.layers):
+            layer_states = [state[layer_ix] for state in states]
+            if layer_states[0] is None: batch_state.append(None)
+            elif type(layer) == Temporal_Convolution: batch_state.append(torch.cat(layer_states, dim=0))
+            elif isinstance(layer_states[0], tuple):
+                batch_state.append(tuple(torch.cat(tensors, dim=1) for tensors in zip(*layer_states)))
+            else: batch_state.append(torch.cat(layer_states, dim=1))
+        return batch_state
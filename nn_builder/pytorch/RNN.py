@@ -1,17 +1,27 @@
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 from nn_builder.pytorch.Base_Network import Base_Network
+from nn_builder.pytorch.Temporal_Convolution import Temporal_Convolution
+from nn_builder.pytorch.Causal_Self_Attention import Causal_Self_Attention
 
 class RNN(nn.Module, Base_Network):
     """Creates a PyTorch recurrent neural network
     Args:
         - input_dim: Integer to indicate the dimension of the input into the network
         - layers_info: List of layer specifications to specify the hidden layers of the network. Each element of the list must be
-                         one of these 3 forms:
+                         one of these 7 forms:
                          - ["lstm", hidden_units]
                          - ["gru", hidden_units]
+                         - ["bilstm", hidden_units]
+                         - ["bigru", hidden_units]
+                         - ["tcn", channels, kernel_size, dilation]
+                         - ["attention", d_model, n_heads, positional_encoding]
                          - ["linear", hidden_units]
+                       where the bidirectional layers output 2 * hidden_units features, tcn is a causal dilated
+                       convolution with a residual connection and attention is causal multi-head self-attention with a
+                       residual connection. positional_encoding is an optional boolean and defaults to False
         - hidden_activations: String or list of string to indicate the activations you want used on the output of linear hidden layers
                               (not including the output layer). Default is ReLU.
         - output_activation: String to indicate the activation function you want the output to go through. Provide a list of
@@ -20,33 +30,44 @@ class RNN(nn.Module, Base_Network):
         - initialiser: String to indicate which initialiser you want used to initialise all the parameters. All PyTorch
                        initialisers are supported. PyTorch's default initialisation is the default.
         - batch_norm: Boolean to indicate whether you want batch norm applied to the output of every hidden layer. Default is False
+        - layer_norm: Boolean to indicate whether you want layer norm applied to the output of every hidden layer instead of
+                      batch norm. Default is False
         - columns_of_data_to_be_embedded: List to indicate the columns numbers of the data that you want to be put through an embedding layer
                                           before being fed through the other layers of the network. Default option is no embeddings
         - embedding_dimensions: If you have categorical variables you want embedded before flowing through the network then
                                 you specify the embedding dimensions here with a list like so: [ [embedding_input_dim_1, embedding_output_dim_1],
                                 [embedding_input_dim_2, embedding_output_dim_2] ...]. Default is no embeddings
+        - static_columns_of_data_to_be_embedded: List of the columns in columns_of_data_to_be_embedded whose values are constant
+                                                 across each sequence (e.g. a user id). They get embedded once per sequence
+                                                 from the first timestep and then broadcast across time. Default is none
         - y_range: Tuple of float or integers of the form (y_lower, y_upper) indicating the range you want to restrict the
                    output values to in regression tasks. Default is no range restriction
         - return_final_seq_only: Boolean to indicate whether you only want to return the output for the final timestep (True)
                                  or if you want to return the output for all timesteps (False)
         - random_seed: Integer to indicate the random seed you want to use
 
-    NOTE that this class' forward method expects input data in the form: (batch, sequence length, features)
+    NOTE that this class' forward method expects input data in the form: (batch, sequence length, features). If the sequences
+    in a batch have different lengths then pad them to the same length and provide their true lengths to forward via the
+    lengths argument. To stream data through the network chunk by chunk get an initial state from init_state and then pass
+    it to forward, which will then also return the state to use for the next chunk
     """
 
     def __init__(self, input_dim, layers_info, output_activation=None,
                  hidden_activations="relu", dropout=0.0, initialiser="default", batch_norm=False,
                  columns_of_data_to_be_embedded=[], embedding_dimensions=[], y_range= (),
-                 return_final_seq_only=True, random_seed=0):
+                 return_final_seq_only=True, random_seed=0, layer_norm=False, static_columns_of_data_to_be_embedded=[]):
         nn.Module.__init__(self)
+        self.layer_norm = layer_norm
         self.embedding_to_occur = len(columns_of_data_to_be_embedded) > 0
         self.columns_of_data_to_be_embedded = columns_of_data_to_be_embedded
+        self.static_columns_of_data_to_be_embedded = static_columns_of_data_to_be_embedded
         self.embedding_dimensions = embedding_dimensions
         self.embedding_layers = self.create_embedding_layers()
         self.return_final_seq_only = return_final_seq_only
-        self.valid_RNN_hidden_layer_types = {"linear", "gru", "lstm"}
+        self.valid_RNN_hidden_layer_types = {"linear", "gru", "lstm", "bilstm", "bigru", "tcn", "attention"}
         Base_Network.__init__(self, input_dim, layers_info, output_activation,
                               hidden_activations, dropout, initialiser, batch_norm, y_range, random_seed)
+        if self.layer_norm: self.layer_norm_layers = self.create_layer_norm_layers()
 
     def check_all_user_inputs_valid(self):
         """Checks that all the user inputs were valid"""
@@ -54,14 +75,33 @@ class RNN(nn.Module, Base_Network):
         self.check_RNN_layers_valid()
         self.check_activations_valid()
         self.check_embedding_dimensions_valid()
+        self.check_static_columns_of_data_to_be_embedded_valid()
         self.check_initialiser_valid()
         self.check_y_range_values_valid()
         self.check_return_final_seq_only_valid()
+        self.check_layer_norm_valid()
+
+    def check_static_columns_of_data_to_be_embedded_valid(self):
+        """Checks that user input for static_columns_of_data_to_be_embedded is valid"""
+        assert isinstance(self.static_columns_of_data_to_be_embedded, list), \
+            "static_columns_of_data_to_be_embedded must be a list"
+        for column in self.static_columns_of_data_to_be_embedded:
+            assert column in self.columns_of_data_to_be_embedded, \
+                "Static column {} must also be in columns_of_data_to_be_embedded".format(column)
+
+    def check_layer_norm_valid(self):
+        """Checks that user input for layer_norm is valid"""
+        assert isinstance(self.layer_norm, bool), "layer_norm must be a boolean"
+        assert not (self.layer_norm and self.batch_norm), "Can only use one of batch_norm and layer_norm"
 
     def check_RNN_layers_valid(self):
         """Checks that layers provided by user are valid"""
         error_msg_layer_type = "First element in a layer specification must be one of {}".format(self.valid_RNN_hidden_layer_types)
         error_msg_layer_form = "Layer must be of form [layer_name, hidden_units]"
+        error_msg_tcn_layer = "TCN layer must be of form ['tcn', channels, kernel_size, dilation] where all are integers >= 1"
+        error_msg_attention_layer = """Attention layer must be of form ['attention', d_model, n_heads, positional_encoding] 
+                                    where d_model and n_heads are integers >= 1, d_model is divisible by n_heads and the 
+                                    optional positional_encoding is a boolean"""
         error_msg_layer_list = "Layers must be provided as a list"
         error_msg_output_heads = "Number of output activations must equal number of output heads"
 
@@ -88,9 +128,18 @@ class RNN(nn.Module, Base_Network):
             assert layer_type_name in self.valid_RNN_hidden_layer_types, "Layer name {} not valid, use one of {}".format(
                 layer_type_name, self.valid_RNN_hidden_layer_types)
 
-            assert isinstance(layer[1], int), error_msg_layer_form
-            assert layer[1] > 0, "Must have hidden_units >= 1"
-            assert len(layer) == 2, error_msg_layer_form
+            if layer_type_name == "tcn":
+                assert len(layer) == 4, error_msg_tcn_layer
+                for ix in range(3): assert isinstance(layer[ix + 1], int) and layer[ix + 1] > 0, error_msg_tcn_layer
+            elif layer_type_name == "attention":
+                assert len(layer) in [3, 4], error_msg_attention_layer
+                for ix in range(2): assert isinstance(layer[ix + 1], int) and layer[ix + 1] > 0, error_msg_attention_layer
+                assert layer[1] % layer[2] == 0, error_msg_attention_layer
+                if len(layer) == 4: assert isinstance(layer[3], bool), error_msg_attention_layer
+            else:
+                assert isinstance(layer[1], int), error_msg_layer_form
+                assert layer[1] > 0, "Must have hidden_units >= 1"
+                assert len(layer) == 2, error_msg_layer_form
 
             if rest_must_be_linear: assert layer[0].lower() == "linear", "If have linear layers then they must come at end"
             if layer_type_name == "linear": rest_must_be_linear = True
@@ -108,16 +157,25 @@ class RNN(nn.Module, Base_Network):
     def create_and_append_layer(self, input_dim, layer, RNN_hidden_layers):
         layer_type_name = layer[0].lower()
         hidden_size = layer[1]
-        if layer_type_name == "lstm":
-            RNN_hidden_layers.extend([nn.LSTM(input_size=input_dim, hidden_size=hidden_size, batch_first=True)])
-        elif layer_type_name == "gru":
+        bidirectional = layer_type_name in ["bilstm", "bigru"]
+        if layer_type_name in ["lstm", "bilstm"]:
+            RNN_hidden_layers.extend([nn.LSTM(input_size=input_dim, hidden_size=hidden_size, batch_first=True,
+                                              bidirectional=bidirectional)])
+        elif layer_type_name in ["gru", "bigru"]:
             RNN_hidden_layers.extend(
-                [nn.GRU(input_size=input_dim, hidden_size=hidden_size, batch_first=True)])
+                [nn.GRU(input_size=input_dim, hidden_size=hidden_size, batch_first=True, bidirectional=bidirectional)])
+        elif layer_type_name == "tcn":
+            RNN_hidden_layers.extend([Temporal_Convolution(input_dim, channels=layer[1], kernel_size=layer[2],
+                                                           dilation=layer[3])])
+        elif layer_type_name == "attention":
+            positional_encoding = layer[3] if len(layer) == 4 else False
+            RNN_hidden_layers.extend([Causal_Self_Attention(input_dim, d_model=layer[1], n_heads=layer[2],
+                                                            positional_encoding=positional_encoding)])
         elif layer_type_name == "linear":
             RNN_hidden_layers.extend([nn.Linear(input_dim, hidden_size)])
         else:
             raise ValueError("Wrong layer names")
-        input_dim = hidden_size
+        input_dim = self.get_layer_output_dim(layer)
         return input_dim
 
     def create_output_layers(self):
@@ -131,15 +189,26 @@ class RNN(nn.Module, Base_Network):
 
     def initialise_all_parameters(self):
         """Initialises the parameters in the linear and embedding layers"""
-        self.initialise_parameters(self.hidden_layers)
-        self.initialise_parameters(self.output_layers)
+        self.initialise_parameters(self.hidden_layers.modules())
+        self.initialise_parameters(self.output_layers.modules())
         self.initialise_parameters(self.embedding_layers)
 
     def create_batch_norm_layers(self):
         """Creates the batch norm layers in the network"""
-        batch_norm_layers = nn.ModuleList([nn.BatchNorm1d(num_features=layer[1]) for layer in self.layers_info[:-1]])
+        batch_norm_layers = nn.ModuleList([nn.BatchNorm1d(num_features=self.get_layer_output_dim(layer))
+                                           for layer in self.layers_info[:-1]])
         return batch_norm_layers
 
+    def create_layer_norm_layers(self):
+        """Creates the layer norm layers in the network"""
+        layer_norm_layers = nn.ModuleList([nn.LayerNorm(self.get_layer_output_dim(layer)) for layer in self.layers_info[:-1]])
+        return layer_norm_layers
+
+    def get_layer_output_dim(self, layer):
+        """Returns the number of features output by a layer given its specification"""
+        if layer[0].lower() in ["bilstm", "bigru"]: return layer[1] * 2
+        return layer[1]
+
     def get_activation(self, activations, ix=None):
         """Gets the activation function"""
         if isinstance(activations, list):
@@ -148,20 +217,168 @@ class RNN(nn.Module, Base_Network):
             activation = self.str_to_activations_converter[str(activations).lower()]
         return activation
 
-    def forward(self, x):
-        """Forward pass for the network. Note that it expects input data in the form (batch, seq length, features)"""
-        if not self.checked_forward_input_data_once: self.check_input_data_into_forward_once(x)
+    def forward(self, x, lengths=None, state=None):
+        """Forward pass for the network. Note that it expects input data in the form (batch, seq length, features). If the
+        sequences are padded then provide their true lengths as a 1D tensor or list in lengths and only the valid timesteps
+        will be put through the network. If a state (see init_state) is provided then the recurrent layers start from it
+        and the tuple (output, new state) is returned so that the next chunk of the sequences can carry on from there"""
+        if not self.checked_forward_input_data_once: self.check_input_data_into_forward_once(x, lengths)
         batch_size, seq_length, data_dimension = x.shape
+        return_state = state is not None
+        if return_state: self.check_state_valid(state, batch_size)
+        else: state = [None] * (len(self.hidden_layers) + len(self.output_layers))
         if self.embedding_to_occur: x = self.incorporate_embeddings(x, batch_size, seq_length)
-        x = self.process_hidden_layers(x, batch_size, seq_length)
-        out = self.process_output_layers(x, batch_size, seq_length)
-        if self.return_final_seq_only: out = out[:, -1, :]
-        if self.y_range: out = self.y_range[0] + (self.y_range[1] - self.y_range[0])*nn.Sigmoid()(out)
+        if lengths is not None: x = self.pack_sequences(x, lengths)
+        x, restricted_to_final_seq, new_hidden_state = self.process_hidden_layers(x, batch_size, seq_length,
+                                                                                  state[:len(self.hidden_layers)])
+        out, new_output_state = self.process_output_layers(x, batch_size, seq_length, restricted_to_final_seq,
+                                                           state[len(self.hidden_layers):])
+        if self.y_range: out = self.apply_y_range(out)
+        if isinstance(out, PackedSequence): out, _ = pad_packed_sequence(out, batch_first=True, total_length=seq_length)
+        if return_state: return out, new_hidden_state + new_output_state
         return out
 
-    def check_input_data_into_forward_once(self, x):
+    def apply_y_range(self, out):
+        """Restricts the output to y_range. Packed output gets restricted before it is padded so the padding stays 0"""
+        if isinstance(out, PackedSequence): return out._replace(data=self.apply_y_range(out.data))
+        return self.y_range[0] + (self.y_range[1] - self.y_range[0])*nn.Sigmoid()(out)
+
+    def init_state(self, batch_size):
+        """Returns the initial state to provide to forward when streaming a batch of sequences through the network chunk by
+        chunk. It is a list with 1 element per hidden layer and output layer: None for linear layers, a tensor h for GRU
+        layers and a tuple (h, c) for LSTM layers where h and c have shape (1, batch_size, hidden_units) and a tensor of the
+        previous inputs of shape (batch_size, history_length, input_dim) for tcn layers"""
+        self.check_network_can_stream()
+        parameter = next(self.parameters())
+        state = []
+        for layer in list(self.hidden_layers) + list(self.output_layers):
+            if type(layer) == nn.Linear:
+                state.append(None)
+                continue
+            if type(layer) == Temporal_Convolution:
+                state.append(torch.zeros((batch_size, layer.history_length, layer.input_dim), dtype=parameter.dtype,
+                                         device=parameter.device))
+                continue
+            zeros = torch.zeros((1, batch_size, layer.hidden_size), dtype=parameter.dtype, device=parameter.device)
+            if type(layer) == nn.LSTM: state.append((zeros, zeros.clone()))
+            else: state.append(zeros)
+        return state
+
+    def detach_state(self, state):
+        """Returns a copy of the state with every tensor detached from the computation graph so that gradients stop
+        flowing back into earlier chunks"""
+        detached_state = []
+        for layer_state in state:
+            if layer_state is None: detached_state.append(None)
+            elif isinstance(layer_state, tuple): detached_state.append(tuple(tensor.detach() for tensor in layer_state))
+            else: detached_state.append(layer_state.detach())
+        return detached_state
+
+    def rollout(self, history, horizon, feedback_fn=None):
+        """Forecasts horizon steps ahead for a batch of series by putting the history of shape (batch, seq length, features)
+        through the network once and then feeding each prediction back in as the next input while carrying the state, so
+        each extra step only costs 1 timestep. feedback_fn(prediction, previous_input) should return the next input of shape
+        (batch, features) from the prediction of shape (batch, output dim) and the previous input. If it isn't provided
+        then the prediction itself is used as the next input. Returns the predictions with shape (batch, horizon, output dim)"""
+        assert isinstance(horizon, int) and horizon >= 1, "horizon must be an integer of 1 or higher"
+        if feedback_fn is None: feedback_fn = lambda prediction, previous_input: prediction
+        out, state = self(history, state=self.init_state(history.shape[0]))
+        prediction = out if self.return_final_seq_only else out[:, -1]
+        previous_input = history[:, -1]
+        predictions = [prediction]
+        for _ in range(horizon - 1):
+            previous_input = feedback_fn(prediction, previous_input)
+            out, state = self(previous_input.unsqueeze(1), state=state)
+            prediction = out if self.return_final_seq_only else out[:, -1]
+            predictions.append(prediction)
+        return torch.stack(predictions, dim=1)
+
+    def check_state_valid(self, state, batch_size):
+        """Checks that the state provided to forward matches the layers of the network and the batch size"""
+        assert isinstance(state, list), "state must be a list created by init_state"
+        assert len(state) == len(self.hidden_layers) + len(self.output_layers), "state must have 1 element per layer"
+        self.check_network_can_stream()
+        for layer, layer_state in zip(list(self.hidden_layers) + list(self.output_layers), state):
+            if type(layer) == nn.Linear: continue
+            if type(layer) == Temporal_Convolution:
+                assert layer_state.shape == (batch_size, layer.history_length, layer.input_dim), \
+                    "state for a tcn layer must have shape {}".format((batch_size, layer.history_length, layer.input_dim))
+                continue
+            h = layer_state[0] if type(layer) == nn.LSTM else layer_state
+            assert h.shape == (1, batch_size, layer.hidden_size), \
+                "state for a {} layer must have shape {}".format(type(layer).__name__, (1, batch_size, layer.hidden_size))
+
+    def calculate_receptive_field(self):
+        """Returns the number of input timesteps that each output timestep depends on. Returns None if the network has
+        recurrent layers because then each output depends on the whole history"""
+        receptive_field = 1
+        for layer in self.hidden_layers:
+            if type(layer) == Temporal_Convolution: receptive_field += layer.history_length
+            elif type(layer) != nn.Linear: return None
+        output_history_lengths = [0]
+        for layer in self.output_layers:
+            if type(layer) == Temporal_Convolution: output_history_lengths.append(layer.history_length)
+            elif type(layer) != nn.Linear: return None
+        return receptive_field + max(output_history_lengths)
+
+    def check_network_can_stream(self):
+        """Checks that the network has no bidirectional or attention layers because they need the whole sequence at once"""
+        for layer in list(self.hidden_layers) + list(self.output_layers):
+            assert not getattr(layer, "bidirectional", False), "Can't stream data through bidirectional layers"
+            assert type(layer) != Causal_Self_Attention, "Can't stream data through attention layers"
+
+    def pack_sequences(self, x, lengths):
+        """Packs the padded data x of shape (batch, seq length, features) so that the padding is skipped by every layer"""
+        lengths = torch.as_tensor(lengths, dtype=torch.int64).cpu()
+        assert lengths.shape == (x.shape[0],), "lengths must provide exactly 1 length per sequence in the batch"
+        return pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+
+    def extract_final_timestep(self, x, previous_layer=None):
+        """Returns the data at the final timestep of each sequence in x as a tensor of shape (batch, features). If x is the
+        output of a bidirectional layer then the backward direction's output is taken from the first timestep instead,
+        which is where it has seen the whole sequence"""
+        if isinstance(x, PackedSequence): final_timesteps = self.extract_final_timestep_of_each_sequence(x)
+        else: final_timesteps = x[:, -1, :]
+        if getattr(previous_layer, "bidirectional", False):
+            if isinstance(x, PackedSequence): first_timesteps = self.extract_first_timestep_of_each_sequence(x)
+            else: first_timesteps = x[:, 0, :]
+            hidden_size = previous_layer.hidden_size
+            final_timesteps = torch.cat((final_timesteps[:, :hidden_size], first_timesteps[:, hidden_size:]), dim=1)
+        return final_timesteps
+
+    def extract_first_timestep_of_each_sequence(self, x):
+        """Returns the data at the first timestep of each sequence in the PackedSequence x as a tensor of
+        shape (batch, features)"""
+        first_timesteps = x.data[:int(x.batch_sizes[0])]
+        if x.unsorted_indices is not None: first_timesteps = first_timesteps[x.unsorted_indices]
+        return first_timesteps
+
+    def extract_final_timestep_of_each_sequence(self, x):
+        """Returns the data at the true final timestep of each sequence in the PackedSequence x as a tensor of
+        shape (batch, features)"""
+        batch_sizes = x.batch_sizes
+        batch_size = int(batch_sizes[0])
+        sorted_lengths = (batch_sizes.unsqueeze(0) > torch.arange(batch_size).unsqueeze(1)).sum(dim=1)
+        timestep_offsets = torch.cumsum(batch_sizes, dim=0) - batch_sizes
+        indexes = timestep_offsets[sorted_lengths - 1] + torch.arange(batch_size)
+        final_timesteps = x.data[indexes.to(x.data.device)]
+        if x.unsorted_indices is not None: final_timesteps = final_timesteps[x.unsorted_indices]
+        return final_timesteps
+
+    def apply_to_each_timestep(self, function, x, batch_size, seq_length):
+        """Applies a function that expects data of shape (N, features) to every timestep of x. If x is a PackedSequence
+        then only the valid timesteps are used and if x has already been restricted to the final timestep then the function
+        is applied directly"""
+        if isinstance(x, PackedSequence):
+            return PackedSequence(function(x.data), x.batch_sizes, x.sorted_indices, x.unsorted_indices)
+        if x.dim() == 2: return function(x)
+        x = function(x.contiguous().view(batch_size * seq_length, -1))
+        return x.view(batch_size, seq_length, -1)
+
+    def check_input_data_into_forward_once(self, x, lengths=None):
         """Checks the input data into forward is of the right format. Then sets a flag indicating that this has happened once
-        so that we don't keep checking as this would slow down the model too much"""
+        so that we don't keep checking as this would slow down the model too much. If lengths are given then static columns
+        only have to be constant over the valid timesteps of each sequence"""
         assert len(x.shape) == 3, "x should have the shape (batch_size, sequence_length, dimension)"
         assert x.shape[2] == self.input_dim, "x must have the same dimension as the input_dim you provided"
         for embedding_dim in self.columns_of_data_to_be_embedded:
@@ -172,15 +389,27 @@ class RNN(nn.Module, Base_Network):
             assert torch.sum(abs(data.float() - data_long.float())) < 0.0001, """Data columns to be embedded should be integer 
                                                                                 values 0 and above to represent the different 
                                                                                 classes"""
+        valid_timesteps = torch.ones(x.shape[:2], dtype=torch.bool, device=x.device)
+        if lengths is not None:
+            lengths = torch.as_tensor(lengths, device=x.device)
+            valid_timesteps = torch.arange(x.shape[1], device=x.device).unsqueeze(0) < lengths.unsqueeze(1)
+        for static_column in self.static_columns_of_data_to_be_embedded:
+            data = x[:, :, static_column]
+            assert torch.all((data == data[:, :1]) | ~valid_timesteps), "Static column {} must be constant across each sequence".format(static_column)
         if self.input_dim > len(self.columns_of_data_to_be_embedded):
           assert isinstance(x, torch.FloatTensor) or isinstance(x, torch.cuda.FloatTensor), "Input data must be a float tensor"
         self.checked_forward_input_data_once = True #So that it doesn't check again
 
     def incorporate_embeddings(self, x, batch_size, seq_length):
         """Puts relevant data through embedding layers and then concatenates the result with the rest of the data ready
-        to then be put through the hidden layers"""
+        to then be put through the hidden layers. Static columns only get embedded for the first timestep and the result is
+        broadcast across the sequence"""
         all_embedded_data = []
         for embedding_layer_ix, embedding_var in enumerate(self.columns_of_data_to_be_embedded):
+            if embedding_var in self.static_columns_of_data_to_be_embedded:
+                embedded_data = self.embedding_layers[embedding_layer_ix](x[:, 0, embedding_var].long())
+                all_embedded_data.append(embedded_data.unsqueeze(1).expand(-1, seq_length, -1))
+                continue
             data = x[:, :, embedding_var].long()
             data = data.contiguous().view(batch_size * seq_length, -1)
             embedded_data = self.embedding_layers[embedding_layer_ix](data)
@@ -191,47 +420,64 @@ class RNN(nn.Module, Base_Network):
         x = torch.cat((non_embedded_data, all_embedded_data), dim=2)
         return x
 
-    def process_hidden_layers(self, x, batch_size, seq_length):
-        """Puts the data x through all the hidden layers"""
+    def process_hidden_layers(self, x, batch_size, seq_length, state):
+        """Puts the data x through all the hidden layers. If we only need the output for the final timestep and no later
+        layer is recurrent then x gets restricted to the final timestep before the first linear layer. The recurrent layers
+        start from the given state and their final states get returned"""
+        restricted_to_final_seq = False
+        new_state = []
+        only_final_seq_needed = self.return_final_seq_only and all(type(layer) == nn.Linear for layer in self.output_layers)
         for layer_ix, layer in enumerate(self.hidden_layers):
             if type(layer) == nn.Linear:
-                x = x.contiguous().view(batch_size * seq_length, -1)
+                if only_final_seq_needed and not restricted_to_final_seq:
+                    x = self.extract_final_timestep(x, self.hidden_layers[layer_ix - 1] if layer_ix > 0 else None)
+                    restricted_to_final_seq = True
                 activation = self.get_activation(self.hidden_activations, layer_ix)
-                x = activation(layer(x))
-                x = x.view(batch_size, seq_length, layer.out_features)
+                x = self.apply_to_each_timestep(lambda data: activation(layer(data)), x, batch_size, seq_length)
+                new_state.append(None)
             else:
-                x = layer(x)
-                x = x[0] #because we only want to keep the output and not the hidden states
-            if self.batch_norm:
-                x.transpose_(1, 2)
-                x = self.batch_norm_layers[layer_ix](x)
-                x.transpose_(1, 2)
-            if self.dropout != 0.0: x = self.dropout_layer(x)
-        return x
+                x, layer_state = layer(x, state[layer_ix])
+                new_state.append(layer_state)
+                if type(layer) in [Temporal_Convolution, Causal_Self_Attention]:
+                    activation = self.get_activation(self.hidden_activations, layer_ix)
+                    x = self.apply_to_each_timestep(activation, x, batch_size, seq_length)
+            if self.batch_norm: x = self.apply_to_each_timestep(self.batch_norm_layers[layer_ix], x, batch_size, seq_length)
+            if self.layer_norm: x = self.apply_to_each_timestep(self.layer_norm_layers[layer_ix], x, batch_size, seq_length)
+            if self.dropout != 0.0: x = self.apply_to_each_timestep(self.dropout_layer, x, batch_size, seq_length)
+        return x, restricted_to_final_seq, new_state
 
-    def process_output_layers(self, x, batch_size, seq_length):
-        """Puts the data x through all the output layers"""
+    def process_output_layers(self, x, batch_size, seq_length, restricted_to_final_seq, state):
+        """Puts the data x through all the output layers. If we only need the output for the final timestep then linear
+        output layers only get applied to the final timestep"""
         out = None
+        new_state = []
+        final_seq_x = x if restricted_to_final_seq else None
         for output_layer_ix, output_layer in enumerate(self.output_layers):
             activation = self.get_activation(self.output_activation, output_layer_ix)
 
             if type(output_layer) == nn.Linear:
-                x = x.contiguous().view(batch_size * seq_length, -1)
-                temp_output = output_layer(x)
+                if self.return_final_seq_only:
+                    if final_seq_x is None:
+                        previous_layer = self.hidden_layers[-1] if len(self.hidden_layers) > 0 else None
+                        final_seq_x = self.extract_final_timestep(x, previous_layer)
+                    temp_output = output_layer(final_seq_x)
+                else:
+                    temp_output = self.apply_to_each_timestep(output_layer, x, batch_size, seq_length)
                 if activation is not None:
-                    temp_output = activation(temp_output)
-                temp_output = temp_output.view(batch_size, seq_length, -1)
-                x = x.view(batch_size, seq_length, -1)
+                    temp_output = self.apply_to_each_timestep(activation, temp_output, batch_size, seq_length)
+                new_state.append(None)
             else:
-                temp_output = output_layer(x)
-                temp_output = temp_output[0]
+                temp_output, layer_state = output_layer(x, state[output_layer_ix])
+                new_state.append(layer_state)
+                if self.return_final_seq_only: temp_output = self.extract_final_timestep(temp_output, output_layer)
                 if activation is not None:
-                    if type(activation) == nn.Softmax:
-                        temp_output = temp_output.contiguous().view(batch_size * seq_length, -1)
-                        temp_output = activation(temp_output)
-                        temp_output = temp_output.view(batch_size, seq_length, -1)
+                    if type(activation) == nn.Softmax or isinstance(temp_output, PackedSequence):
+                        temp_output = self.apply_to_each_timestep(activation, temp_output, batch_size, seq_length)
                     else:
                         temp_output = activation(temp_output)
             if out is None: out = temp_output
-            else: out = torch.cat((out, temp_output), dim=2)
-        return out
\ No newline at end of file
+            elif isinstance(out, PackedSequence):
+                out = PackedSequence(torch.cat((out.data, temp_output.data), dim=1), out.batch_sizes,
+                                     out.sorted_indices, out.unsorted_indices)
+            else: out = torch.cat((out, temp_output), dim=-1)
+        return out, new_state
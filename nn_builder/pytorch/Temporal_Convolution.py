@@ -0,0 +1,46 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
+
+class Temporal_Convolution(nn.Module):
+    """Causal dilated 1D convolution with a residual connection for sequences of shape (batch, seq length, features). Each
+    output timestep only depends on the current and previous (kernel_size - 1) * dilation input timesteps so, unlike a
+    recurrent layer, all timesteps get computed in parallel
+    Args:
+        - input_dim: Integer to indicate the number of features of the input
+        - channels: Integer to indicate the number of features of the output
+        - kernel_size: Integer to indicate the number of timesteps the convolution kernel covers
+        - dilation: Integer to indicate the spacing between the timesteps the convolution kernel covers
+
+    NOTE that like nn.LSTM its forward method accepts a PackedSequence and an optional state and returns (output, state)
+    where state is the last history_length timesteps of input, which a later chunk of the sequences can carry on from
+    """
+    def __init__(self, input_dim, channels, kernel_size, dilation):
+        super().__init__()
+        self.input_dim = input_dim
+        self.channels = channels
+        self.kernel_size = kernel_size
+        self.dilation = dilation
+        self.history_length = (kernel_size - 1) * dilation
+        self.conv = nn.Conv1d(input_dim, channels, kernel_size=kernel_size, dilation=dilation)
+        if input_dim != channels: self.residual = nn.Conv1d(input_dim, channels, kernel_size=1)
+        else: self.residual = None
+
+    def forward(self, x, state=None):
+        """Runs the causal convolution over x, starting from the given state of previous inputs or zeros if there is none"""
+        packed = isinstance(x, PackedSequence)
+        if packed: x, lengths = pad_packed_sequence(x, batch_first=True)
+        if state is None: state = x.new_zeros((x.shape[0], self.history_length, self.input_dim))
+        x_with_history = torch.cat((state, x), dim=1)
+        out = self.conv(x_with_history.transpose(1, 2))
+        if self.residual is None: out = out + x.transpose(1, 2)
+        else: out = out + self.residual(x.transpose(1, 2))
+        out = out.transpose(1, 2)
+        if packed:
+            history_indexes = lengths.unsqueeze(1) + torch.arange(self.history_length).unsqueeze(0)
+            history_indexes = history_indexes.to(x.device).unsqueeze(2).expand(-1, -1, self.input_dim)
+            new_state = torch.gather(x_with_history, 1, history_indexes)
+            out = pack_padded_sequence(out, lengths, batch_first=True, enforce_sorted=False)
+        else:
+            new_state = x_with_history[:, x_with_history.shape[1] - self.history_length:]
+        return out, new_state
@@ -0,0 +1,76 @@
+import torch
+from nn_builder.pytorch.RNN import RNN
+
+class Truncated_BPTT(object):
+    """Trains a PyTorch RNN on long sequences using truncated backpropagation through time. The sequences are split into
+    windows and the recurrent state is carried between windows but detached, so memory is bounded by the window length
+    rather than the sequence length
+    Args:
+        - rnn: The nn_builder PyTorch RNN to train
+        - optimizer: PyTorch optimizer for the parameters of the rnn
+        - loss_function: Function that takes (output, target) and returns a scalar loss, e.g. nn.MSELoss()
+        - k1: Integer to indicate the number of new timesteps to run forward between each parameter update
+        - k2: Integer to indicate the number of timesteps to backpropagate through for each parameter update. Must be at
+              least k1. If it is larger than k1 then consecutive windows overlap by k2 - k1 timesteps. Default is k1
+        - clip_grad_norm: Float to indicate the max norm to clip the gradients to before each update. Default is no clipping
+
+    NOTE that the targets provided to train_on_sequences must be of the form (batch, sequence length, output dim). If the
+    rnn has return_final_seq_only=True then each window is only trained on the target at its final timestep
+    """
+    def __init__(self, rnn, optimizer, loss_function, k1, k2=None, clip_grad_norm=None):
+        if k2 is None: k2 = k1
+        self.rnn = rnn
+        self.optimizer = optimizer
+        self.loss_function = loss_function
+        self.k1 = k1
+        self.k2 = k2
+        self.clip_grad_norm = clip_grad_norm
+        self.check_all_user_inputs_valid()
+
+    def check_all_user_inputs_valid(self):
+        """Checks that all the user inputs were valid"""
+        assert isinstance(self.rnn, RNN), "rnn must be an nn_builder PyTorch RNN"
+        assert isinstance(self.k1, int) and self.k1 > 0, "k1 must be an integer of 1 or higher"
+        assert isinstance(self.k2, int) and self.k2 >= self.k1, "k2 must be an integer greater than or equal to k1"
+        assert self.clip_grad_norm is None or self.clip_grad_norm > 0, "clip_grad_norm must be None or positive"
+
+    def train_on_sequences(self, x, y):
+        """Runs 1 pass over the sequences x of shape (batch, seq length, features) with targets y, updating the parameters
+        every k1 timesteps. Returns the list of losses for each window"""
+        assert x.shape[:2] == y.shape[:2], "x and y must have the same batch size and sequence length"
+        seq_length = x.shape[1]
+        self.rnn.train()
+        window_start_state = self.rnn.init_state(x.shape[0])
+        window_start, window_end = 0, 0
+        losses = []
+        while window_end < seq_length:
+            previous_window_end = window_end
+            window_end = min(window_end + self.k1, seq_length)
+            next_window_start = max(window_start, window_end + self.k1 - self.k2)
+            first_out, next_window_start_state = self.run_segment(x[:, window_start:next_window_start], window_start_state)
+            second_out, _ = self.run_segment(x[:, next_window_start:window_end], next_window_start_state)
+            outputs = [out for out in (first_out, second_out) if out is not None]
+            if self.rnn.return_final_seq_only:
+                loss = self.loss_function(outputs[-1], y[:, window_end - 1])
+            else:
+                out = torch.cat(outputs, dim=1)[:, previous_window_end - window_end:]
+                loss = self.loss_function(out, y[:, previous_window_end:window_end])
+            self.take_optimisation_step(loss)
+            losses.append(loss.item())
+            window_start_state = self.rnn.detach_state(next_window_start_state)
+            window_start = next_window_start
+        return losses
+
+    def run_segment(self, x, state):
+        """Runs the rnn over a segment of the sequences starting from the given state. Returns (None, state) for an empty
+        segment"""
+        if x.shape[1] == 0: return None, state
+        return self.rnn(x, state=state)
+
+    def take_optimisation_step(self, loss):
+        """Backpropagates the loss and updates the parameters of the rnn"""
+        self.optimizer.zero_grad()
+        loss.backward()
+        if self.clip_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(self.rnn.parameters(), self.clip_grad_norm)
+        self.optimizer.step()
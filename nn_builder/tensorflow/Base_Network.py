@@ -1,19 +1,27 @@
-from tensorflow.keras.layers import BatchNormalization
+from tensorflow.keras.layers import BatchNormalization, Conv2D, Dense
 from nn_builder.Overall_Base_Network import Overall_Base_Network
+from nn_builder.tensorflow.Fused_Embedding import Fused_Embedding
 import tensorflow.keras.activations as activations
 import tensorflow.keras.initializers as initializers
+import contextlib
+import os
+import time
 import numpy as np
 import random
 import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
 from abc import ABC, abstractmethod
 
 class Base_Network(Overall_Base_Network, ABC):
     """Base class for TensorFlow neural network classes"""
+    cpu_strategies = {}
+
     def __init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser, batch_norm, y_range,
                  random_seed, input_dim):
         if input_dim is not None: print("You don't need to provide input_dim for a tensorflow network")
         super().__init__(None, layers_info, output_activation,
                  hidden_activations, dropout, initialiser, batch_norm, y_range, random_seed)
+        self.folded_batch_norm_layer_ixs = set()
 
     @abstractmethod
     def call(self, x, training=True):
@@ -50,9 +58,61 @@ class Base_Network(Overall_Base_Network, ABC):
                                         "variance_scaling": initializers.VarianceScaling, "default": initializers.glorot_uniform}
         return str_to_initialiser_converter
 
+    @staticmethod
+    def create_distribution_strategy(distribute):
+        """Returns the distribution strategy to create and train the network with. An integer gives a MirroredStrategy
+        over that many logical CPU devices and None gives the current strategy, which is a single replica unless the
+        network is created within another strategy's scope. The MirroredStrategy for each number of replicas only gets
+        created once and is shared by the networks because separate strategies over the same devices clash in the
+        collective operations that synchronize the batch norm statistics"""
+        if distribute is None: return tf.distribute.get_strategy()
+        if isinstance(distribute, tf.distribute.Strategy): return distribute
+        assert isinstance(distribute, int) and not isinstance(distribute, bool) and distribute > 0, \
+            "distribute must be None, a positive integer or a tf.distribute.Strategy"
+        if distribute not in Base_Network.cpu_strategies:
+            devices = Base_Network.split_cpu_into_devices(distribute)
+            # Each MirroredStrategy numbers its collective operations from the same key so strategies over different
+            # numbers of replicas in 1 process would wait on each other's operations. A private subclass per number of
+            # replicas gives each its own starting key without changing MirroredStrategy itself
+            strategy_class = type("_CPU_Strategy", (tf.distribute.MirroredStrategy,),
+                                  {"_collective_key_base": 100000 * (len(Base_Network.cpu_strategies) + 1)})
+            Base_Network.cpu_strategies[distribute] = strategy_class(devices[:distribute])
+        return Base_Network.cpu_strategies[distribute]
+
+    @staticmethod
+    def split_cpu_into_devices(num_devices):
+        """Splits the CPU into at least num_devices logical devices so that replicas can run on them in parallel and
+        returns the names of the logical CPU devices. This is only possible before TensorFlow has run anything"""
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        try:
+            if len(tf.config.get_logical_device_configuration(cpu) or [cpu]) < num_devices:
+                tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_devices)
+        except RuntimeError: pass
+        devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+        assert len(devices) >= num_devices, "TensorFlow has already started with {} CPU devices so it can't train on {} " \
+                                            "replicas. Create the network or call split_cpu_into_devices before running " \
+                                            "anything else in TensorFlow".format(len(devices), num_devices)
+        return devices
+
+    def check_batch_norm_momentum_valid(self):
+        """Checks that user input for batch_norm_momentum is valid"""
+        assert isinstance(self.batch_norm_momentum, float) and 0.0 <= self.batch_norm_momentum <= 1.0, \
+            "batch_norm_momentum must be a float between 0 and 1"
+
+    def check_dtype_policy_valid(self):
+        """Checks that user input for dtype_policy is valid"""
+        valid_dtype_policies = [None, "float32", "mixed_float16", "mixed_bfloat16"]
+        assert self.layer_dtype_policy in valid_dtype_policies, "dtype_policy must be one of {}".format(valid_dtype_policies)
+
+    def get_layer_dtype(self, output_layer=False):
+        """Returns the dtype policy to create a layer with. Output layers always use float32 so that the output activations
+        and y_range are computed in full precision"""
+        if output_layer: return "float32"
+        return self.layer_dtype_policy
+
     def create_dropout_layer(self):
         """Creates a dropout layer"""
-        return tf.keras.layers.Dropout(rate=self.dropout)
+        return tf.keras.layers.Dropout(rate=self.dropout, dtype=self.get_layer_dtype())
 
     def create_hidden_layers(self):
         """Creates the hidden layers in the network"""
@@ -72,28 +132,269 @@ class Base_Network(Overall_Base_Network, ABC):
             if isinstance(self.layers_info[-1], int): self.layers_info[-1] = [self.layers_info[-1]]
         else:
             raise ValueError("Network type not recognised")
+        self.output_head_sizes = [layer if isinstance(layer, int) else layer[1] for layer in self.layers_info[-1]]
+        self.fused_output_heads = self.fuse_output_heads and len(self.layers_info[-1]) > 1
+        if self.fused_output_heads:
+            fused_units = sum(self.output_head_sizes)
+            fused_layer = fused_units if network_type == "NN" else ["linear", fused_units]
+            self.create_and_append_layer(fused_layer, output_layers, None, output_layer=True)
+            return output_layers
         for output_layer_ix, output_layer in enumerate(self.layers_info[-1]):
             activation = self.get_activation(self.output_activation, output_layer_ix)
             self.create_and_append_layer(output_layer, output_layers, activation, output_layer=True)
         return output_layers
 
-    def create_embedding_layers(self):
-        """Creates the embedding layers in the network"""
-        embedding_layers = []
-        for embedding_dimension in self.embedding_dimensions:
-            input_dim, output_dim = embedding_dimension
-            embedding_layers.extend([tf.keras.layers.Embedding(input_dim, output_dim)])
-        return embedding_layers
+    def check_fuse_output_heads_valid(self):
+        """Checks that user input for fuse_output_heads is valid"""
+        assert isinstance(self.fuse_output_heads, bool), "fuse_output_heads must be a boolean"
+        if not self.fuse_output_heads or type(self).__name__ == "NN": return
+        output_layers = self.layers_info[-1] if isinstance(self.layers_info[-1][0], list) else [self.layers_info[-1]]
+        for output_layer in output_layers:
+            assert output_layer[0].lower() == "linear", "fuse_output_heads needs every output head to be a linear layer"
+
+    def apply_fused_output_activations(self, out):
+        """Applies the output activation of each head to its part of the output of the fused output layer. If every head
+        has the same elementwise activation then it gets applied to the whole output at once. Softmax normalises over all
+        the values it is given so it always gets applied to each head separately"""
+        head_activations = [self.get_activation(self.output_activation, head_ix) for head_ix in range(len(self.output_head_sizes))]
+        if head_activations[0] is not activations.softmax and all(activation is head_activations[0]
+                                                                   for activation in head_activations):
+            return head_activations[0](out)
+        heads = tf.split(out, self.output_head_sizes, axis=-1)
+        return tf.concat([activation(head) for activation, head in zip(head_activations, heads)], axis=-1)
+
+    def fuse_output_head_weights(self, weights):
+        """Converts the weights of the same network created without fuse_output_heads, as returned by its get_weights,
+        into weights for this network by concatenating the kernels and biases of the output heads. A checkpoint saved
+        with 1 layer per output head can then be loaded with network.set_weights(network.fuse_output_head_weights(weights))"""
+        assert self.fused_output_heads, "The network must have been created with fuse_output_heads=True and several heads"
+        assert self.built, "The network must be called on some data before weights can be converted for it"
+        fused_layer = self.output_layers[0]
+        kernel_ix = next(ix for ix, weight in enumerate(self.weights) if weight is fused_layer.kernel)
+        num_heads = len(self.output_head_sizes)
+        error_msg = "weights must come from the same network with 1 layer per output head"
+        assert len(weights) == len(self.weights) + 2 * (num_heads - 1), error_msg
+        head_weights = weights[kernel_ix:kernel_ix + 2 * num_heads]
+        assert [np.shape(weight)[-1] for weight in head_weights] == np.repeat(self.output_head_sizes, 2).tolist(), error_msg
+        fused_weights = list(weights[:kernel_ix]) + [np.concatenate(head_weights[0::2], axis=-1),
+                                                     np.concatenate(head_weights[1::2])] + list(weights[kernel_ix + 2 * num_heads:])
+        assert all(np.shape(fused_weight) == tuple(weight.shape) for fused_weight, weight in zip(fused_weights, self.weights)), \
+            error_msg
+        return fused_weights
+
+    def create_embedding_layer(self, static_columns=()):
+        """Creates the layer that embeds every column of data to be embedded, or None if there are no embeddings. Static
+        columns only get embedded for the first timestep and the result is broadcast across the sequence"""
+        if len(self.embedding_dimensions) == 0: return None
+        return Fused_Embedding(self.embedding_dimensions, self.columns_of_data_to_be_embedded, static_columns=static_columns,
+                               dtype=self.get_layer_dtype())
+
+    def get_non_embedded_columns(self, num_columns):
+        """Returns the columns of data that don't get embedded as an array. It only gets computed the first time for each
+        number of columns of data"""
+        if num_columns not in self.non_embedded_columns:
+            self.non_embedded_columns[num_columns] = np.array([col for col in range(num_columns)
+                                                               if col not in self.columns_of_data_to_be_embedded], dtype="int32")
+        return self.non_embedded_columns[num_columns]
 
     def create_batch_norm_layers(self):
         """Creates the batch norm layers in the network"""
         batch_norm_layers = []
         for layer in self.layers_info[:-1]:
-            batch_norm_layers.extend([BatchNormalization()])
+            batch_norm_layers.extend([BatchNormalization(momentum=self.batch_norm_momentum, synchronized=tf.distribute.has_strategy(),
+                                                         dtype=self.get_layer_dtype())])
         return batch_norm_layers
 
+    def apply_batch_norm(self, x, batch_norm_ix, training, mask=None):
+        """Puts the data x through a batch norm layer unless it has been folded into the layers after it. The batch norm
+        layer gets the training argument the network was called with so it normalises with the batch statistics and
+        updates its moving statistics when training and uses its moving statistics otherwise. If a mask of padded
+        timesteps is given then they get left out of the batch statistics"""
+        if batch_norm_ix in self.folded_batch_norm_layer_ixs: return x
+        return self.batch_norm_layers[batch_norm_ix](x, training=training, mask=mask)
+
+    def fold_batch_norm(self):
+        """Folds the moving statistics and parameters of each batch norm layer into the kernel and bias of the Dense or
+        Conv2D (with valid padding) layers that its output goes into, so serving the network needs one less pass over the
+        activations. The output of the network when not training stays the same but the network shouldn't be trained
+        afterwards. Batch norm layers whose output goes into other types of layers (e.g. pooling or recurrent layers) are
+        kept. Returns the indices of the batch norm layers that have been folded"""
+        if not self.batch_norm: return []
+        assert self.built, "The network must be called on some data before its batch norm layers can be folded"
+        for batch_norm_ix, batch_norm_layer in enumerate(self.batch_norm_layers):
+            if batch_norm_ix in self.folded_batch_norm_layer_ixs: continue
+            next_layers = self.get_layers_after_batch_norm(batch_norm_ix)
+            if not all(type(layer) == Dense or (type(layer) == Conv2D and layer.padding == "valid") for layer in next_layers):
+                continue
+            scale = batch_norm_layer.gamma / tf.sqrt(batch_norm_layer.moving_variance + batch_norm_layer.epsilon)
+            shift = batch_norm_layer.beta - batch_norm_layer.moving_mean * scale
+            for layer in next_layers: self.fold_batch_norm_into_layer(scale, shift, layer, channels_first=batch_norm_layer.axis == 1)
+            self.folded_batch_norm_layer_ixs.add(batch_norm_ix)
+        return sorted(self.folded_batch_norm_layer_ixs)
+
+    def get_layers_after_batch_norm(self, batch_norm_ix):
+        """Returns the layers that the output of a batch norm layer goes into"""
+        if batch_norm_ix + 1 < len(self.hidden_layers): return [self.hidden_layers[batch_norm_ix + 1]]
+        return list(self.output_layers)
+
+    def fold_batch_norm_into_layer(self, scale, shift, layer, channels_first=False):
+        """Changes the kernel and bias of a Dense or Conv2D layer so that it gives the same output without the per feature
+        scale and shift being applied to its input first. If the input to a Dense layer got flattened then the scale and
+        shift get repeated to match it, which is for each position in turn or for each channel in turn if the batch norm
+        normalised channels_first data"""
+        if type(layer) == Dense:
+            repeats = layer.kernel.shape[0] // scale.shape[0]
+            if channels_first: scale, shift = tf.repeat(scale, repeats), tf.repeat(shift, repeats)
+            else: scale, shift = tf.tile(scale, [repeats]), tf.tile(shift, [repeats])
+            layer.bias.assign(layer.bias + tf.tensordot(shift, layer.kernel, 1))
+            layer.kernel.assign(layer.kernel * scale[:, None])
+        else:
+            layer.bias.assign(layer.bias + tf.einsum("hwio,i->o", layer.kernel, shift))
+            layer.kernel.assign(layer.kernel * scale[None, None, :, None])
+
+    def compile_call(self, input_signature=None, jit_compile=False):
+        """Returns a version of the forward pass wrapped in tf.function which gets called as compiled_call(x, training=False).
+        input_signature can be a tf.TensorSpec for the input or a tuple of the input shape excluding the batch dimension,
+        e.g. (None, 5) for an RNN with 5 features. Providing it means the forward pass only gets traced once for all batch
+        sizes. If it isn't provided then TensorFlow traces a version that works for the shapes seen so far. Set jit_compile
+        to True to compile the forward pass with XLA. The number of times it has been traced is kept in self.trace_count
+        so that retracing can be spotted. If the network hasn't been built yet then the first call is also run eagerly to
+        create the variables, as tf.function would otherwise trace twice. The state argument of an RNN isn't supported by the compiled call"""
+        if input_signature is not None and not isinstance(input_signature, tf.TensorSpec):
+            input_signature = tf.TensorSpec(shape=(None,) + tuple(input_signature), dtype=tf.float32)
+        self.trace_count = 0
+        compiled_functions = {}
+        def forward(x, training):
+            self.trace_count += 1
+            return self(x, training=training)
+        def compiled_call(x, training=False):
+            if not self.built: self(x, training=training)
+            if training not in compiled_functions:
+                compiled_functions[training] = tf.function(
+                    lambda x: forward(x, training), jit_compile=jit_compile, reduce_retracing=input_signature is None,
+                    input_signature=None if input_signature is None else [input_signature])
+            return compiled_functions[training](x)
+        self.compiled_call = compiled_call
+        return compiled_call
+
+    def to_functional(self, input_shape):
+        """Returns an equivalent Keras functional model for inputs of the given shape (excluding the batch dimension) which is
+        built out of this network's layers, so the 2 models share their weights. The functional model has a static graph
+        so it gives an accurate summary() and can be optimised and exported as a whole. Dropout in the functional model
+        follows the training argument it gets called with"""
+        inputs = tf.keras.Input(shape=input_shape)
+        outputs = self.call(inputs, training=None)
+        return tf.keras.Model(inputs=inputs, outputs=outputs, name="{}_functional".format(type(self).__name__))
+
+    def export_for_serving(self, path, input_shape, format="saved_model", quantize=None, representative_data=None, batch_size=None):
+        """Exports the network for serving without the Python model code and checks the exported model against the network.
+        Args:
+            - path: Directory to save the SavedModel to or file to save the TFLite model to
+            - input_shape: Tuple of the input shape excluding the batch dimension
+            - format: String to indicate the export format, either "saved_model" or "tflite"
+            - quantize: String to indicate the post-training quantization for TFLite, either "dynamic" (int8 weights) or
+                        "int8" (int8 weights and activations). Default is no quantization
+            - representative_data: Array of example inputs. It is needed to calibrate "int8" quantization and is also used
+                                   to check the exported model. If not provided then the model is checked on zeros
+            - batch_size: Integer to fix the batch size of the exported model. Default is any batch size
+        The SavedModel has a serving_default signature that runs the network with training=False and returns {"output": ...}.
+        TFLite models of networks with recurrent layers need a fixed batch_size and sequence length and can't be "int8"
+        quantized. Returns a dictionary with the path, format, quantize, size in bytes, the max absolute difference between
+        the outputs of the exported model and the network, and the mean latency in milliseconds of the exported model"""
+        self.check_export_inputs_valid(input_shape, format, quantize, representative_data, batch_size)
+        if representative_data is None:
+            representative_data = np.zeros((batch_size or 1,) + tuple(1 if dim is None else dim for dim in input_shape))
+        representative_data = np.asarray(representative_data, dtype=np.float32)
+        if not self.built: self(representative_data[:batch_size or 1], training=False)
+        serving_function = tf.function(lambda x: self(x, training=False),
+                                       input_signature=[tf.TensorSpec((batch_size,) + tuple(input_shape), tf.float32)])
+        if format == "saved_model": exported_call = self.export_saved_model(path, serving_function)
+        else: exported_call = self.export_tflite(path, serving_function, quantize, representative_data, batch_size)
+        validation_data = representative_data[:batch_size or len(representative_data)]
+        max_abs_error = float(np.max(np.abs(exported_call(validation_data) - self(validation_data, training=False))))
+        exported_call(validation_data)
+        start = time.perf_counter()
+        for _ in range(10): exported_call(validation_data)
+        latency_ms = (time.perf_counter() - start) / 10 * 1000
+        return {"path": path, "format": format, "quantize": quantize, "size_bytes": self.calculate_export_size(path),
+                "max_abs_error": max_abs_error, "latency_ms": latency_ms}
+
+    def check_export_inputs_valid(self, input_shape, format, quantize, representative_data, batch_size):
+        """Checks that the user inputs to export_for_serving are valid"""
+        assert isinstance(input_shape, tuple), "input_shape must be a tuple"
+        assert format in ["saved_model", "tflite"], "format must be saved_model or tflite"
+        assert quantize in [None, "dynamic", "int8"], "quantize must be None, dynamic or int8"
+        assert format == "tflite" or quantize is None, "Quantization is only supported for the tflite format"
+        assert quantize != "int8" or representative_data is not None, "int8 quantization needs representative_data"
+        assert batch_size is None or (isinstance(batch_size, int) and batch_size > 0), "batch_size must be a positive integer"
+        if format == "tflite" and self.has_recurrent_layers():
+            assert batch_size is not None and None not in input_shape, \
+                "TFLite export of recurrent layers needs a fixed batch_size and sequence length"
+            assert quantize != "int8", "int8 quantization isn't supported for recurrent layers, use dynamic instead"
+
+    def has_recurrent_layers(self):
+        """Returns whether the network has any recurrent layers"""
+        return any(isinstance(layer, (tf.keras.layers.RNN, tf.keras.layers.Bidirectional))
+                   for layer in self.hidden_layers + self.output_layers)
+
+    def export_saved_model(self, path, serving_function):
+        """Saves the network as a SavedModel with the serving function as its serving_default signature and returns a
+        function that calls the saved model"""
+        module = tf.Module()
+        module.network_variables = list(self.variables)
+        module.serve = tf.function(lambda x: {"output": serving_function(x)}, input_signature=serving_function.input_signature)
+        tf.saved_model.save(module, path, signatures={"serving_default": module.serve})
+        serving_signature = tf.saved_model.load(path).signatures["serving_default"]
+        return lambda x: serving_signature(x=tf.constant(x))["output"].numpy()
+
+    def export_tflite(self, path, serving_function, quantize, representative_data, batch_size):
+        """Converts the serving function to a TFLite model with its variables frozen as constants, saves it and returns a
+        function that runs the saved model in a TFLite interpreter"""
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+            [convert_variables_to_constants_v2(serving_function.get_concrete_function())])
+        if quantize is not None: converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantize == "int8":
+            calibration_batch_size = batch_size or 1
+            converter.representative_dataset = lambda: ([representative_data[ix:ix + calibration_batch_size]] for ix in
+                                                        range(0, len(representative_data) - calibration_batch_size + 1,
+                                                              calibration_batch_size))
+        with open(path, "wb") as f: f.write(converter.convert())
+        interpreter = tf.lite.Interpreter(model_path=path)
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+        def tflite_call(x):
+            if tuple(interpreter.get_input_details()[0]["shape"]) != x.shape:
+                interpreter.resize_tensor_input(input_index, x.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_index, x)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+        interpreter.allocate_tensors()
+        return tflite_call
+
+    def calculate_export_size(self, path):
+        """Returns the size in bytes of an exported file or directory"""
+        if os.path.isfile(path): return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(directory, file)) for directory, _, files in os.walk(path) for file in files)
+
     def print_model_summary(self, input_shape=None):
         assert input_shape is not None, "Must provide the input_shape parameter as a tuple"
         self.build(input_shape=input_shape)
         self.dropout_layer.build(input_shape)
-        self.summary()
\ No newline at end of file
+        self.summary()
+
+class Distribution_Scope_Mixin(object):
+    """Mixin for the TensorFlow networks that calls and compiles them within the scope of the strategy they were created
+    with. It has to come before Model in the bases of a network so that its methods get used instead of Model's"""
+    @tf.autograph.experimental.do_not_convert
+    def __call__(self, *args, **kwargs):
+        with self.get_distribution_scope(): return super().__call__(*args, **kwargs)
+
+    def compile(self, *args, **kwargs):
+        with self.get_distribution_scope(): super().compile(*args, **kwargs)
+
+    def get_distribution_scope(self):
+        """Returns the scope of the strategy the network was created with unless it is already within a strategy's scope,
+        so that calling the network for the first time creates its variables as distributed variables"""
+        if tf.distribute.has_strategy() or self.distribute_strategy is tf.distribute.get_strategy(): return contextlib.nullcontext()
+        return self.distribute_strategy.scope()
@@ -1,10 +1,10 @@
 import numpy as np
-from tensorflow.keras import Model, activations
-from tensorflow.keras.layers import Dense, Flatten, Conv2D, Concatenate, BatchNormalization, MaxPool2D, AveragePooling2D
-from nn_builder.tensorflow.Base_Network import Base_Network
+from tensorflow.keras import Model, activations, ops
+from tensorflow.keras.layers import Dense, Flatten, Conv2D, BatchNormalization, MaxPool2D, AveragePooling2D
+from nn_builder.tensorflow.Base_Network import Base_Network, Distribution_Scope_Mixin
 import tensorflow as tf
 
-class CNN(Model, Base_Network):
+class CNN(Distribution_Scope_Mixin, Model, Base_Network):
     """Creates a PyTorch convolutional neural network
     Args:
         - layers_info: List of layer specifications to specify the hidden layers of the network. Each element of the list must be
@@ -22,27 +22,63 @@ class CNN(Model, Base_Network):
         - initialiser: String to indicate which initialiser you want used to initialise all the parameters. All PyTorch
                        initialisers are supported. PyTorch's default initialisation is the default.
         - batch_norm: Boolean to indicate whether you want batch norm applied to the output of every hidden layer. Default is False
+        - batch_norm_momentum: Float between 0 and 1 to indicate the momentum of the moving statistics of the batch norm
+                               layers. The momentum of 0.1 of a PyTorch network is 0.9 here. Default is 0.99
         - y_range: Tuple of float or integers of the form (y_lower, y_upper) indicating the range you want to restrict the
                    output values to in regression tasks. Default is no range restriction
         - random_seed: Integer to indicate the random seed you want to use
+        - dtype_policy: String to indicate the Keras dtype policy of the hidden layers, one of "float32", "mixed_float16" and
+                        "mixed_bfloat16". The output layers always use float32. Default is the global Keras policy
+        - distribute: Integer to indicate the number of replicas to train the network on with a MirroredStrategy over that
+                      many logical CPU devices of this machine, or a tf.distribute.Strategy such as a
+                      MultiWorkerMirroredStrategy over local worker processes. The layers, including the batch norm and
+                      dropout layers, get created within the strategy's scope, compile and calling the network use it and fit
+                      splits each batch across the replicas with the batch norm statistics synchronized between them. The CPU
+                      can only be split into logical devices before TensorFlow has run anything, so create the network or
+                      call Base_Network.split_cpu_into_devices first. Default is a single replica
+        - fuse_output_heads: Boolean to indicate whether to put multiple linear output heads into 1 Dense layer whose
+                             output gets split into the heads for their activations, so the heads cost 1 matmul instead
+                             of 1 per head. Weights saved without it can be converted with fuse_output_head_weights.
+                             Default is False
+        - data_format: String to indicate the layout of the input and of the conv and pooling layers, either
+                       "channels_last" for (batch, height, width, channels) or "channels_first" for (batch, channels,
+                       height, width) as the PyTorch CNN uses. With "channels_first" the output of the last conv or pooling
+                       layer gets flattened in (channels, height, width) order like the PyTorch CNN does, so weights can be
+                       moved between the two without permuting the first linear layer. Default is "channels_last"
 
-    NOTE that this class' call method expects input data in the form: (batch, channels, height, width)
+    NOTE that this class' call method expects input data in the form: (batch, height, width, channels), or (batch,
+    channels, height, width) if data_format is "channels_first"
     """
     def __init__(self, layers_info, output_activation=None, hidden_activations="relu", dropout= 0.0, initialiser="default",
-                 batch_norm=False, y_range=(), random_seed=0, input_dim=None):
-        Model.__init__(self)
-        self.valid_cnn_hidden_layer_types = {'conv', 'maxpool', 'avgpool', 'linear'}
-        self.valid_layer_types_with_no_parameters = (MaxPool2D, AveragePooling2D)
-        Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
-                              batch_norm, y_range, random_seed, input_dim)
+                 batch_norm=False, y_range=(), random_seed=0, input_dim=None, dtype_policy=None, distribute=None,
+                 fuse_output_heads=False, data_format="channels_last", batch_norm_momentum=0.99):
+        with self.create_distribution_strategy(distribute).scope():
+            Model.__init__(self)
+            self.layer_dtype_policy = dtype_policy
+            self.batch_norm_momentum = batch_norm_momentum
+            self.fuse_output_heads = fuse_output_heads
+            self.data_format = data_format
+            self.valid_cnn_hidden_layer_types = {'conv', 'maxpool', 'avgpool', 'linear'}
+            self.valid_layer_types_with_no_parameters = (MaxPool2D, AveragePooling2D)
+            self.flatten_layer = Flatten(data_format="channels_last", dtype=self.get_layer_dtype())
+            Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
+                                  batch_norm, y_range, random_seed, input_dim)
 
     def check_all_user_inputs_valid(self):
         """Checks that all the user inputs were valid"""
         self.check_CNN_layers_valid()
         self.check_activations_valid()
+        self.check_dtype_policy_valid()
+        self.check_batch_norm_momentum_valid()
+        self.check_fuse_output_heads_valid()
+        self.check_data_format_valid()
         self.check_initialiser_valid()
         self.check_y_range_values_valid()
 
+    def check_data_format_valid(self):
+        """Checks that user input for data_format is valid"""
+        assert self.data_format in ["channels_last", "channels_first"], "data_format must be channels_last or channels_first"
+
     def check_CNN_layers_valid(self):
         """Checks that the user inputs for cnn_hidden_layers were valid. cnn_hidden_layers must be a list of layers where
         each layer must be of one of these forms:
@@ -116,29 +152,45 @@ class CNN(Model, Base_Network):
         if layer_name == "conv":
             list_to_append_layer_to.extend([Conv2D(filters=layer[1], kernel_size=layer[2],
                                                 strides=layer[3], padding=layer[4], activation=activation,
-                                                   kernel_initializer=self.initialiser_function)])
+                                                   data_format=self.data_format, kernel_initializer=self.initialiser_function,
+                                                   dtype=self.get_layer_dtype(output_layer))])
         elif layer_name == "maxpool":
             list_to_append_layer_to.extend([MaxPool2D(pool_size=(layer[1], layer[1]),
-                                                   strides=(layer[2], layer[2]), padding=layer[3])])
+                                                   strides=(layer[2], layer[2]), padding=layer[3], data_format=self.data_format,
+                                                   dtype=self.get_layer_dtype(output_layer))])
         elif layer_name == "avgpool":
             list_to_append_layer_to.extend([AveragePooling2D(pool_size=(layer[1], layer[1]),
-                                                   strides=(layer[2], layer[2]), padding=layer[3])])
+                                                   strides=(layer[2], layer[2]), padding=layer[3], data_format=self.data_format,
+                                                   dtype=self.get_layer_dtype(output_layer))])
         elif layer_name == "linear":
-            list_to_append_layer_to.extend([Dense(layer[1], activation=activation, kernel_initializer=self.initialiser_function)])
+            list_to_append_layer_to.extend([Dense(layer[1], activation=activation, kernel_initializer=self.initialiser_function,
+                                                  dtype=self.get_layer_dtype(output_layer))])
         else:
             raise ValueError("Wrong layer name")
 
     def create_batch_norm_layers(self):
-        """Creates the batch norm layers in the network"""
+        """Creates the batch norm layers in the network. They normalise the channels axis of the output of conv layers"""
         batch_norm_layers = []
         for layer in self.layers_info[:-1]:
             layer_type = layer[0].lower()
             if layer_type in ["conv", "linear"]:
-                batch_norm_layers.extend([BatchNormalization()])
+                axis = 1 if layer_type == "conv" and self.data_format == "channels_first" else -1
+                batch_norm_layers.extend([BatchNormalization(axis=axis, momentum=self.batch_norm_momentum,
+                                                             synchronized=tf.distribute.has_strategy(),
+                                                             dtype=self.get_layer_dtype())])
         return batch_norm_layers
 
+    def get_layers_after_batch_norm(self, batch_norm_ix):
+        """Returns the layers that the output of a batch norm layer goes into"""
+        layer_ixs_with_batch_norm = [layer_ix for layer_ix, layer in enumerate(self.hidden_layers)
+                                     if type(layer) not in self.valid_layer_types_with_no_parameters]
+        layer_ix = layer_ixs_with_batch_norm[batch_norm_ix]
+        if layer_ix + 1 < len(self.hidden_layers): return [self.hidden_layers[layer_ix + 1]]
+        return list(self.output_layers)
+
     def call(self, x, training=True):
-        """Forward pass for the network. Note that it expects input data in the form (Batch, Height, Width, Channels)"""
+        """Forward pass for the network. Note that it expects input data in the form (Batch, Height, Width, Channels), or
+        (Batch, Channels, Height, Width) if data_format is channels_first"""
         x = self.process_hidden_layers(x, training)
         out = self.process_output_layers(x)
         if self.y_range: out = self.y_range[0] + (self.y_range[1] - self.y_range[0]) * activations.sigmoid(out)
@@ -154,14 +206,14 @@ class CNN(Model, Base_Network):
                 x = layer(x)
             else:
                 if type(layer) == Dense and not flattened:
-                    x = Flatten()(x)
+                    x = self.flatten_layer(x)
                     flattened = True
                 x = layer(x)
                 if self.batch_norm:
-                    x = self.batch_norm_layers[valid_batch_norm_layer_ix](x, training=False)
+                    x = self.apply_batch_norm(x, valid_batch_norm_layer_ix, training)
                     valid_batch_norm_layer_ix += 1
                 if self.dropout != 0.0 and training: x = self.dropout_layer(x)
-        if not flattened: x = Flatten()(x)
+        if not flattened: x = self.flatten_layer(x)
         return x
 
     def process_output_layers(self, x):
@@ -169,6 +221,7 @@ class CNN(Model, Base_Network):
         out = None
         for output_layer_ix, output_layer in enumerate(self.output_layers):
             temp_output = output_layer(x)
+            if self.fused_output_heads: temp_output = self.apply_fused_output_activations(temp_output)
             if out is None: out = temp_output
-            else: out = Concatenate(axis=1)([out, temp_output])
+            else: out = ops.concatenate([out, temp_output], axis=1)
         return out
@@ -0,0 +1,52 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Layer, Dense, MultiHeadAttention
+
+class Causal_Self_Attention(Layer):
+    """Multi-head self-attention with a causal mask and a residual connection for sequences of shape
+    (batch, seq length, features). Each output timestep attends to the current and all previous timesteps and, unlike a
+    recurrent layer, all timesteps get computed in parallel. Padding at the end of sequences can't change the output for
+    the real timesteps before it so masks of such padding pass through the layer
+    Args:
+        - d_model: Integer to indicate the number of features of the output. Must be divisible by n_heads
+        - n_heads: Integer to indicate the number of attention heads
+        - positional_encoding: Boolean to indicate whether sinusoidal positional encodings get added to the input
+        - kernel_initializer: Initialiser to use for the weights
+    """
+    def __init__(self, d_model, n_heads, positional_encoding=False, kernel_initializer="glorot_uniform", **kwargs):
+        super().__init__(**kwargs)
+        self.d_model = d_model
+        self.n_heads = n_heads
+        self.positional_encoding = positional_encoding
+        self.kernel_initializer = kernel_initializer
+        self.attention = MultiHeadAttention(num_heads=n_heads, key_dim=d_model // n_heads,
+                                            kernel_initializer=kernel_initializer, dtype=self.dtype_policy)
+        self.input_projection = None
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        """Creates the input projection if the input doesn't already have d_model features"""
+        if input_shape[-1] != self.d_model:
+            self.input_projection = Dense(self.d_model, kernel_initializer=self.kernel_initializer, dtype=self.dtype_policy)
+            self.input_projection.build(input_shape)
+        projected_shape = tuple(input_shape[:-1]) + (self.d_model,)
+        self.attention.build(projected_shape, projected_shape)
+        super().build(input_shape)
+
+    def call(self, x):
+        """Runs causal self-attention over x"""
+        if self.input_projection is not None: x = self.input_projection(x)
+        if self.positional_encoding: x = x + self.calculate_positional_encoding(tf.shape(x)[1], x.dtype)
+        return x + self.attention(x, x, use_causal_mask=True)
+
+    def calculate_positional_encoding(self, seq_length, dtype):
+        """Returns the sinusoidal positional encodings of shape (seq_length, d_model)"""
+        positions = tf.cast(tf.range(seq_length), dtype)[:, tf.newaxis]
+        frequencies = np.exp(np.arange(0, self.d_model, 2) * (-np.log(10000.0) / self.d_model))
+        angles = positions * tf.cast(frequencies, dtype)[tf.newaxis, :]
+        encoding = tf.stack([tf.sin(angles), tf.cos(angles)], axis=2)
+        encoding = tf.reshape(encoding, (seq_length, -1))
+        return encoding[:, :self.d_model]
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.d_model,)
@@ -0,0 +1,112 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import ops
+from tensorflow.keras.layers import Layer
+
+class Fused_Embedding(Layer):
+    """Embeds several columns of categorical data with 1 gather per distinct embedding output dimension instead of 1
+    Embedding layer per column. The tables of the columns with the same output dimension are stacked into 1 table and
+    each column's values get offset by where its rows start, with the offsets and the order of the columns computed once
+    as constants. The output is the concatenation of the columns' embeddings in the order of embedding_dimensions, which
+    is the same as putting each column through its own Embedding layer and concatenating the results
+    Args:
+        - embedding_dimensions: List of [embedding_input_dim, embedding_output_dim] for each column to be embedded
+        - columns: List of the columns of the input to be embedded in the same order as embedding_dimensions. Default is
+                   that the input only has the columns to be embedded
+        - embeddings_initializer: Initialiser to use for the tables. Default is the same as for a Keras Embedding layer
+        - static_columns: List of the columns in columns whose values are constant along the 2nd axis of a 3D input, such as
+                          the timesteps of a sequence. They only get looked up for x[:, 0] and their embeddings get
+                          broadcast along the 2nd axis. Default is none
+    """
+    def __init__(self, embedding_dimensions, columns=None, embeddings_initializer="uniform", static_columns=(), **kwargs):
+        super().__init__(**kwargs)
+        self.embedding_dimensions = embedding_dimensions
+        self.columns = list(range(len(embedding_dimensions))) if columns is None else list(columns)
+        self.static_columns = list(static_columns)
+        self.embeddings_initializer = embeddings_initializer
+        self.output_dims = list(dict.fromkeys(output_dim for _, output_dim in embedding_dimensions))
+        table_ixs = [self.output_dims.index(output_dim) for _, output_dim in embedding_dimensions]
+        self.table_embedding_ixs = [[embedding_ix for embedding_ix, ix in enumerate(table_ixs) if ix == table_ix]
+                                    for table_ix in range(len(self.output_dims))]
+        self.table_offsets = [np.cumsum([0] + [embedding_dimensions[ix][0] for ix in embedding_ixs[:-1]]).astype("int32")
+                              for embedding_ixs in self.table_embedding_ixs]
+        self.embedding_positions = [(table_ix, table_ixs[:embedding_ix].count(table_ix))
+                                    for embedding_ix, table_ix in enumerate(table_ixs)]
+        self.lookups = self.calculate_lookups()
+        self.input_columns = [np.array([self.columns[ix] for _, static, embedding_ixs, _ in self.lookups
+                                        if static == lookup_static for ix in embedding_ixs], dtype="int32")
+                              for lookup_static in [False, True]]
+        self.embedding_runs = self.calculate_embedding_runs()
+        self.tables = []
+
+    def calculate_lookups(self):
+        """Returns a list of [table index, static, embedding indexes, offsets] for each gather the layer does. The columns of
+        a table that aren't static get looked up together and so do its static columns, with all the lookups of columns
+        that aren't static coming first"""
+        lookups = []
+        for static in [False, True]:
+            for table_ix, (embedding_ixs, offsets) in enumerate(zip(self.table_embedding_ixs, self.table_offsets)):
+                lookup = [(ix, offset) for ix, offset in zip(embedding_ixs, offsets) if (self.columns[ix] in self.static_columns) == static]
+                if len(lookup) == 0: continue
+                lookups.append([table_ix, static, [ix for ix, _ in lookup], np.array([offset for _, offset in lookup], dtype="int32")])
+        return lookups
+
+    def calculate_embedding_runs(self):
+        """Returns a list of [lookup index, start position, end position] for each run of consecutive embeddings that are
+        next to each other in the output of the same lookup, so the output can be put together with 1 slice per run"""
+        embedding_runs = []
+        for embedding_ix in range(len(self.embedding_dimensions)):
+            lookup_ix = next(lookup_ix for lookup_ix, lookup in enumerate(self.lookups) if embedding_ix in lookup[2])
+            position = self.lookups[lookup_ix][2].index(embedding_ix)
+            if len(embedding_runs) > 0 and embedding_runs[-1][0] == lookup_ix and embedding_runs[-1][2] == position:
+                embedding_runs[-1][2] += 1
+            else: embedding_runs.append([lookup_ix, position, position + 1])
+        return embedding_runs
+
+    def build(self, input_shape):
+        """Creates 1 table per distinct output dimension holding the rows of every column with that output dimension"""
+        self.tables = []
+        for output_dim, embedding_ixs in zip(self.output_dims, self.table_embedding_ixs):
+            input_dim = int(sum(self.embedding_dimensions[ix][0] for ix in embedding_ixs))
+            self.tables.append(self.add_weight(shape=(input_dim, output_dim), initializer=self.embeddings_initializer,
+                                               name="embeddings_{}".format(output_dim)))
+        super().build(input_shape)
+
+    def call(self, x):
+        """Embeds the columns of x of shape (..., features) and returns the embeddings of shape (..., sum of output dims)"""
+        lookup_embedded_data = []
+        for static, input_columns in zip([False, True], self.input_columns):
+            if len(input_columns) == 0: continue
+            data = x[:, 0] if static else x
+            if not np.array_equal(input_columns, np.arange(x.shape[-1])): data = tf.gather(data, input_columns, axis=-1)
+            data = ops.cast(data, "int32")
+            lookups = [lookup for lookup in self.lookups if lookup[1] == static]
+            start = 0
+            for table_ix, _, embedding_ixs, offsets in lookups:
+                lookup_data = data if len(lookups) == 1 else data[..., start:start + len(embedding_ixs)]
+                lookup_embedded_data.append(tf.gather(self.tables[table_ix], lookup_data + offsets))
+                start += len(embedding_ixs)
+        batch_shape = tf.shape(x)[:-1]
+        all_embedded_data = []
+        for lookup_ix, start, end in self.embedding_runs:
+            table_ix, static, embedding_ixs, _ = self.lookups[lookup_ix]
+            embedded_data = lookup_embedded_data[lookup_ix]
+            if end - start < len(embedding_ixs): embedded_data = embedded_data[..., start:end, :]
+            output_dim = (end - start) * self.output_dims[table_ix]
+            if static:
+                embedded_data = tf.reshape(embedded_data, tf.concat([batch_shape[:1], [output_dim]], axis=0))
+                embedded_data = tf.broadcast_to(embedded_data[:, None], tf.concat([batch_shape, [output_dim]], axis=0))
+            else: embedded_data = tf.reshape(embedded_data, tf.concat([batch_shape, [output_dim]], axis=0))
+            all_embedded_data.append(embedded_data)
+        if len(all_embedded_data) > 1: all_embedded_data = ops.concatenate(all_embedded_data, axis=-1)
+        else: all_embedded_data = all_embedded_data[0]
+        return ops.cast(all_embedded_data, self.compute_dtype)
+
+    def get_embeddings(self, embedding_ix):
+        """Returns the rows of the tables that hold the embeddings of the given element of embedding_dimensions"""
+        table_ix, position = self.embedding_positions[embedding_ix]
+        start = self.table_offsets[table_ix][position]
+        return self.tables[table_ix][start:start + self.embedding_dimensions[embedding_ix][0]]
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (sum(output_dim for _, output_dim in self.embedding_dimensions),)
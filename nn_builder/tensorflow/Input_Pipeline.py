@@ -0,0 +1,163 @@
+import time
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+
+class Input_Pipeline(object):
+    """Builds a tf.data input pipeline that feeds in-memory data to an nn_builder TensorFlow network in batches of the shape
+    and dtype it expects, so batching and preprocessing happen in parallel with the training step instead of in a Python
+    loop. The examples get put through map_fn in parallel, cached, shuffled each epoch, batched and then prefetched.
+    Iterating over the pipeline yields the batches and records how long was spent waiting for each of them so that
+    stall_report shows whether training is input bound. The dataset attribute can also be given straight to model.fit
+    Args:
+        - network: The nn_builder TensorFlow NN, CNN or RNN the data is for
+        - x: Array of inputs. For a CNN it has shape (examples, height, width, channels), or (examples, channels, height,
+             width) if its data_format is "channels_first", or (examples, height, width) for single channel images, and
+             can have an integer dtype such as uint8. For an RNN it can also be a list of arrays of shape (seq length,
+             features) with different lengths which get padded with zeros in each batch. The batches of x are then the
+             tuple (x, mask) with a mask of the real timesteps that the RNN takes as its input
+        - y: Array of targets. For an RNN it can also be a list of per timestep targets of shape (seq length, targets) with
+             the length of their sequence in x, which get padded like x and come with the mask as their sample weights.
+             Any other list of targets, such as 1 array of shape (targets,) per sequence, gets stacked. Default is no targets
+        - batch_size: Integer to indicate the number of examples in each batch. Default is 32
+        - shuffle: Boolean to indicate whether to shuffle the examples each epoch. Default is True
+        - cache: Boolean to indicate whether to put every example through map_fn once when the pipeline gets created and
+                 keep the results in memory. Set it to False for random augmentations that should differ each epoch.
+                 Default is True
+        - map_fn: Function of tensors applied to each example before caching, called as map_fn(x) or map_fn(x, y) and
+                  returning the same structure. Default is no function
+        - num_parallel_calls: Integer to indicate how many examples or batches to process in parallel. Default is
+                              tf.data.AUTOTUNE
+        - prefetch: Integer to indicate how many batches to prepare ahead of the training step. Default is tf.data.AUTOTUNE
+        - random_seed: Integer to indicate the random seed you want to use for the shuffling. Default is no seed
+    """
+    def __init__(self, network, x, y=None, batch_size=32, shuffle=True, cache=True, map_fn=None,
+                 num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE, random_seed=None):
+        self.network = network
+        self.variable_length = isinstance(network, RNN) and isinstance(x, (list, tuple))
+        self.x = x if self.variable_length else np.asarray(x)
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.cache = cache
+        self.map_fn = map_fn
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+        self.random_seed = random_seed
+        self.check_all_user_inputs_valid()
+        if isinstance(network, CNN) and self.x.ndim == 3:
+            self.x = self.x[:, None] if network.data_format == "channels_first" else self.x[..., None]
+        self.dataset = self.create_dataset()
+        self.batches = 0
+        self.stall_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def check_all_user_inputs_valid(self):
+        """Checks that all the user inputs were valid"""
+        assert isinstance(self.network, (NN, CNN, RNN)), "network must be an nn_builder TensorFlow NN, CNN or RNN"
+        if self.variable_length:
+            assert len(self.x) > 0 and all(np.ndim(sequence) == 2 for sequence in self.x), \
+                "x must be a non-empty list of arrays of shape (seq length, features)"
+            assert len(set(np.shape(sequence)[1] for sequence in self.x)) == 1, "Every sequence must have the same number of features"
+        else:
+            expected_dims = {NN: [2], CNN: [3, 4], RNN: [3]}[type(self.network)]
+            assert self.x.ndim in expected_dims, "x for a {} must have {} dimensions".format(type(self.network).__name__,
+                                                                                           " or ".join(map(str, expected_dims)))
+        if self.y is not None: assert len(self.y) == len(self.x), "x and y must contain the same number of examples"
+        assert isinstance(self.batch_size, int) and self.batch_size > 0, "batch_size must be an integer of 1 or higher"
+        assert isinstance(self.shuffle, bool), "shuffle must be a boolean"
+        assert isinstance(self.cache, bool), "cache must be a boolean"
+        assert self.map_fn is None or callable(self.map_fn), "map_fn must be None or a function"
+        self.check_embedding_columns_valid()
+
+    def check_embedding_columns_valid(self):
+        """Checks that the columns of data to be embedded contain integers the network's embedding layers can take"""
+        if isinstance(self.network, CNN) or not self.network.embedding_to_occur: return
+        features = np.concatenate(self.x) if self.variable_length else self.x.reshape(-1, self.x.shape[-1])
+        for embedding_column, (embedding_input_dim, _) in zip(self.network.columns_of_data_to_be_embedded,
+                                                             self.network.embedding_dimensions):
+            column = features[:, embedding_column]
+            assert np.all(np.mod(column, 1) == 0), "Column {} to be embedded must only contain integers".format(embedding_column)
+            assert np.all((column >= 0) & (column < embedding_input_dim)), \
+                "Column {} to be embedded must contain integers from 0 to {}".format(embedding_column, embedding_input_dim - 1)
+
+    def create_dataset(self):
+        """Creates the tf.data dataset of batches. Unless map_fn has to run every epoch the batches get gathered from the
+        in-memory data with shuffled indices, which avoids the overhead of putting each example through tf.data separately"""
+        data = self.create_tensor_slices(self.x, self.variable_length)
+        if self.y is not None: data = (data, self.create_tensor_slices(self.y, self.has_per_timestep_targets()))
+        if self.map_fn is not None and self.cache: data = self.apply_map_fn_to_all_examples(data)
+        if self.map_fn is None or self.cache:
+            dataset = tf.data.Dataset.range(len(self.x))
+            if self.shuffle: dataset = dataset.shuffle(len(self.x), seed=self.random_seed, reshuffle_each_iteration=True)
+            dataset = dataset.batch(self.batch_size)
+            dataset = dataset.map(lambda indices: self.convert_batch(*self.gather_examples(data, indices)),
+                                  num_parallel_calls=self.num_parallel_calls)
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(data).map(self.map_fn, num_parallel_calls=self.num_parallel_calls)
+            if self.shuffle: dataset = dataset.shuffle(len(self.x), seed=self.random_seed, reshuffle_each_iteration=True)
+            dataset = dataset.ragged_batch(self.batch_size) if self.variable_length else dataset.batch(self.batch_size)
+            dataset = dataset.map(self.convert_batch, num_parallel_calls=self.num_parallel_calls)
+        return dataset.prefetch(self.prefetch)
+
+    def apply_map_fn_to_all_examples(self, data):
+        """Puts every example through map_fn in parallel and returns the results stacked together, so they are cached in
+        memory and map_fn doesn't run again"""
+        dataset = tf.data.Dataset.from_tensor_slices(data).map(self.map_fn, num_parallel_calls=self.num_parallel_calls)
+        if self.variable_length: return dataset.ragged_batch(len(self.x)).get_single_element()
+        return dataset.batch(len(self.x)).get_single_element()
+
+    def gather_examples(self, data, indices):
+        """Returns the examples at the given indices as a tuple of (x,) or (x, y)"""
+        gathered = tf.nest.map_structure(lambda tensor: tf.gather(tensor, indices), data)
+        return gathered if isinstance(gathered, tuple) else (gathered,)
+
+    def has_per_timestep_targets(self):
+        """Returns whether y is a list of per timestep targets for variable length sequences, which is when every target is
+        2D and as long as its sequence in x"""
+        return self.variable_length and isinstance(self.y, (list, tuple)) and \
+            all(np.ndim(target) == 2 and len(target) == len(sequence) for target, sequence in zip(self.y, self.x))
+
+    def create_tensor_slices(self, data, ragged):
+        """Returns the data as a tensor that can be split into examples. If ragged then the list of variable length
+        sequences becomes a ragged tensor so that they can be batched without padding every sequence to the longest one in
+        the dataset"""
+        if ragged: return tf.RaggedTensor.from_row_lengths(np.concatenate(data), [len(sequence) for sequence in data])
+        return tf.convert_to_tensor(np.asarray(data))
+
+    def convert_batch(self, x, y=None):
+        """Casts the inputs to float32 as the network expects. Ragged batches of sequences get padded with zeros and
+        become the tuple (x, mask) with the mask marking the real timesteps, so the RNN skips the padding. Per timestep
+        targets get padded too and the mask is returned as their sample weights so that the padding isn't in the loss"""
+        mask = None
+        if isinstance(x, tf.RaggedTensor): x, mask = x.to_tensor(), tf.sequence_mask(x.row_lengths())
+        x = tf.cast(x, tf.float32)
+        if mask is not None: x = (x, mask)
+        if y is None: return x
+        if isinstance(y, tf.RaggedTensor): return x, y.to_tensor(), tf.cast(mask, tf.float32)
+        return x, y
+
+    def __iter__(self):
+        iterator = iter(self.dataset)
+        epoch_start = time.perf_counter()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                try: batch = next(iterator)
+                except StopIteration: return
+                self.stall_seconds += time.perf_counter() - wait_start
+                self.batches += 1
+                yield batch
+        finally: self.total_seconds += time.perf_counter() - epoch_start
+
+    def __len__(self):
+        return -(-len(self.x) // self.batch_size)
+
+    def stall_report(self):
+        """Returns a dictionary with the number of batches taken from the pipeline, the seconds spent waiting for them,
+        the total seconds spent iterating over the pipeline and the fraction of that time spent waiting. A stall fraction
+        close to 1 means the training loop is input bound"""
+        return {"batches": self.batches, "stall_seconds": self.stall_seconds, "total_seconds": self.total_seconds,
+                "stall_fraction": self.stall_seconds / self.total_seconds if self.total_seconds > 0 else 0.0}
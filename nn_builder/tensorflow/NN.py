@@ -1,11 +1,11 @@
 import tensorflow as tf
-from tensorflow.keras import Model, activations
+from tensorflow.keras import Model, activations, ops
 import numpy as np
-from tensorflow.keras.layers import Dense, Flatten, Conv2D, Concatenate, BatchNormalization
-from nn_builder.tensorflow.Base_Network import Base_Network
+from tensorflow.keras.layers import Dense, Flatten, Conv2D, BatchNormalization
+from nn_builder.tensorflow.Base_Network import Base_Network, Distribution_Scope_Mixin
 
 
-class NN(Model, Base_Network):
+class NN(Distribution_Scope_Mixin, Model, Base_Network):
     """Creates a PyTorch neural network
     Args:
         - layers_info: List of integers to indicate the width and number of linear layers you want in your network
@@ -17,6 +17,8 @@ class NN(Model, Base_Network):
         - initialiser: String to indicate which initialiser you want used to initialise all the parameters. All PyTorch
                        initialisers are supported. PyTorch's default initialisation is the default.
         - batch_norm: Boolean to indicate whether you want batch norm applied to the output of every hidden layer. Default is False
+        - batch_norm_momentum: Float between 0 and 1 to indicate the momentum of the moving statistics of the batch norm
+                               layers. The momentum of 0.1 of a PyTorch network is 0.9 here. Default is 0.99
         - columns_of_data_to_be_embedded: List to indicate the columns numbers of the data that you want to be put through an embedding layer
                                           before being fed through the other layers of the network. Default option is no embeddings
         - embedding_dimensions: If you have categorical variables you want embedded before flowing through the network then
@@ -25,29 +27,51 @@ class NN(Model, Base_Network):
         - y_range: Tuple of float or integers of the form (y_lower, y_upper) indicating the range you want to restrict the
                    output values to in regression tasks. Default is no range restriction
         - random_seed: Integer to indicate the random seed you want to use
+        - dtype_policy: String to indicate the Keras dtype policy of the hidden layers, one of "float32", "mixed_float16" and
+                        "mixed_bfloat16". The output layers always use float32. Default is the global Keras policy
+        - distribute: Integer to indicate the number of replicas to train the network on with a MirroredStrategy over that
+                      many logical CPU devices of this machine, or a tf.distribute.Strategy such as a
+                      MultiWorkerMirroredStrategy over local worker processes. The layers, including the batch norm and
+                      dropout layers, get created within the strategy's scope, compile and calling the network use it and fit
+                      splits each batch across the replicas with the batch norm statistics synchronized between them. The CPU
+                      can only be split into logical devices before TensorFlow has run anything, so create the network or
+                      call Base_Network.split_cpu_into_devices first. Default is a single replica
+        - fuse_output_heads: Boolean to indicate whether to put multiple linear output heads into 1 Dense layer whose
+                             output gets split into the heads for their activations, so the heads cost 1 matmul instead
+                             of 1 per head. Weights saved without it can be converted with fuse_output_head_weights.
+                             Default is False
     """
     def __init__(self, layers_info, output_activation=None, hidden_activations="relu", dropout=0.0, initialiser="default",
                  batch_norm=False, columns_of_data_to_be_embedded=[], embedding_dimensions=[], y_range= (), random_seed=0,
-                 input_dim=None):
-        Model.__init__(self)
-        self.embedding_to_occur = len(columns_of_data_to_be_embedded) > 0
-        self.columns_of_data_to_be_embedded = columns_of_data_to_be_embedded
-        self.embedding_dimensions = embedding_dimensions
-        self.embedding_layers = self.create_embedding_layers()
-        Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
-                              batch_norm, y_range, random_seed, input_dim)
+                 input_dim=None, dtype_policy=None, distribute=None, fuse_output_heads=False, batch_norm_momentum=0.99):
+        with self.create_distribution_strategy(distribute).scope():
+            Model.__init__(self)
+            self.layer_dtype_policy = dtype_policy
+            self.batch_norm_momentum = batch_norm_momentum
+            self.fuse_output_heads = fuse_output_heads
+            self.embedding_to_occur = len(columns_of_data_to_be_embedded) > 0
+            self.columns_of_data_to_be_embedded = columns_of_data_to_be_embedded
+            self.embedding_dimensions = embedding_dimensions
+            Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
+                                  batch_norm, y_range, random_seed, input_dim)
+            self.embedding_layer = self.create_embedding_layer()
+            self.non_embedded_columns = {}
 
     def check_all_user_inputs_valid(self):
         """Checks that all the user inputs were valid"""
         self.check_NN_layers_valid()
         self.check_activations_valid()
         self.check_embedding_dimensions_valid()
+        self.check_dtype_policy_valid()
+        self.check_batch_norm_momentum_valid()
+        self.check_fuse_output_heads_valid()
         self.check_initialiser_valid()
         self.check_y_range_values_valid()
 
     def create_and_append_layer(self, layer, list_to_append_layer_to, activation=None, output_layer=False):
         """Creates and appends a layer to the list provided"""
-        list_to_append_layer_to.extend([Dense(layer, activation=activation, kernel_initializer=self.initialiser_function)])
+        list_to_append_layer_to.extend([Dense(layer, activation=activation, kernel_initializer=self.initialiser_function,
+                                              dtype=self.get_layer_dtype(output_layer))])
 
     def call(self, x, training=True):
         if self.embedding_to_occur: x = self.incorporate_embeddings(x)
@@ -57,28 +81,23 @@ class NN(Model, Base_Network):
         return out
 
     def incorporate_embeddings(self, x):
-        """Puts relevant data through embedding layers and then concatenates the result with the rest of the data ready
+        """Puts relevant data through the embedding layer and then concatenates the result with the rest of the data ready
         to then be put through the hidden layers"""
-        all_embedded_data = []
-        for embedding_layer_ix, embedding_var in enumerate(self.columns_of_data_to_be_embedded):
-            data = x[:, embedding_var]
-            embedded_data = self.embedding_layers[embedding_layer_ix](data)
-            all_embedded_data.append(embedded_data)
-        if len(all_embedded_data) > 1: all_embedded_data = Concatenate(axis=1)(all_embedded_data)
-        else: all_embedded_data = all_embedded_data[0]
-        non_embedded_columns = [col for col in range(x.shape[1]) if col not in self.columns_of_data_to_be_embedded]
+        all_embedded_data = self.embedding_layer(x)
+        non_embedded_columns = self.get_non_embedded_columns(x.shape[1])
         if len(non_embedded_columns) > 0:
-            x = tf.gather(x, non_embedded_columns, axis=1)
-            x = Concatenate(axis=1)([tf.dtypes.cast(x, float), all_embedded_data])
+            x = ops.take(x, non_embedded_columns, axis=1)
+            x = ops.concatenate([ops.cast(x, all_embedded_data.dtype), all_embedded_data], axis=1)
         else: x = all_embedded_data
         return x
 
     def process_hidden_layers(self, x, training):
         """Puts the data x through all the hidden layers"""
+        training = training or training is None
         for layer_ix, linear_layer in enumerate(self.hidden_layers):
             x = linear_layer(x)
-            if self.batch_norm: x = self.batch_norm_layers[layer_ix](x, training=False)
-            if self.dropout != 0.0 and (training or training is None):
+            if self.batch_norm: x = self.apply_batch_norm(x, layer_ix, training)
+            if self.dropout != 0.0 and training:
                 x = self.dropout_layer(x)
         return x
 
@@ -87,8 +106,9 @@ class NN(Model, Base_Network):
         out = None
         for output_layer_ix, output_layer in enumerate(self.output_layers):
             temp_output = output_layer(x)
+            if self.fused_output_heads: temp_output = self.apply_fused_output_activations(temp_output)
             if out is None: out = temp_output
             else:
-                out = Concatenate(axis=1)(inputs=[out, temp_output])
+                out = ops.concatenate([out, temp_output], axis=1)
         return out
 
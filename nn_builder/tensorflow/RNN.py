@@ -1,17 +1,24 @@
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras import Model, activations
-from tensorflow.keras.layers import Dense, Concatenate, GRU, LSTM
-from nn_builder.tensorflow.Base_Network import Base_Network
+from tensorflow.keras import Model, activations, ops
+from tensorflow.keras.layers import Dense, GRU, LSTM, Bidirectional
+from nn_builder.tensorflow.Base_Network import Base_Network, Distribution_Scope_Mixin
+from nn_builder.tensorflow.Causal_Self_Attention import Causal_Self_Attention
 
-class RNN(Model, Base_Network):
+class RNN(Distribution_Scope_Mixin, Model, Base_Network):
     """Creates a TensorFlow recurrent neural network
     Args:
         - layers_info: List of layer specifications to specify the hidden layers of the network. Each element of the list must be
-                         one of these 3 forms:
+                         one of these 6 forms:
                          - ["lstm", hidden_units]
                          - ["gru", hidden_units]
+                         - ["bilstm", hidden_units]
+                         - ["bigru", hidden_units]
+                         - ["attention", d_model, n_heads, positional_encoding]
                          - ["linear", hidden_units]
+                       where the bidirectional layers output 2 * hidden_units features and attention is causal multi-head
+                       self-attention with a residual connection. positional_encoding is an optional boolean and
+                       defaults to False
         - hidden_activations: String or list of string to indicate the activations you want used on the output of linear hidden layers
                               (not including the output layer). Default is ReLU.
         - output_activation: String to indicate the activation function you want the output to go through. Provide a list of
@@ -20,45 +27,91 @@ class RNN(Model, Base_Network):
         - initialiser: String to indicate which initialiser you want used to initialise all the parameters. All PyTorch
                        initialisers are supported. PyTorch's default initialisation is the default.
         - batch_norm: Boolean to indicate whether you want batch norm applied to the output of every hidden layer. Default is False
+        - batch_norm_momentum: Float between 0 and 1 to indicate the momentum of the moving statistics of the batch norm
+                               layers. The momentum of 0.1 of a PyTorch network is 0.9 here. Default is 0.99
         - columns_of_data_to_be_embedded: List to indicate the columns numbers of the data that you want to be put through an embedding layer
                                           before being fed through the other layers of the network. Default option is no embeddings
         - embedding_dimensions: If you have categorical variables you want embedded before flowing through the network then
                                 you specify the embedding dimensions here with a list like so: [ [embedding_input_dim_1, embedding_output_dim_1],
                                 [embedding_input_dim_2, embedding_output_dim_2] ...]. Default is no embeddings
+        - static_columns_of_data_to_be_embedded: List of the columns in columns_of_data_to_be_embedded whose values are constant
+                                                 across each sequence (e.g. a user id). They get embedded once per sequence
+                                                 from the first timestep and then broadcast across time. Default is none
+        - dtype_policy: String to indicate the Keras dtype policy of the hidden layers, one of "float32", "mixed_float16" and
+                        "mixed_bfloat16". The output layers always use float32. Default is the global Keras policy
+        - distribute: Integer to indicate the number of replicas to train the network on with a MirroredStrategy over that
+                      many logical CPU devices of this machine, or a tf.distribute.Strategy such as a
+                      MultiWorkerMirroredStrategy over local worker processes. The layers, including the batch norm and
+                      dropout layers, get created within the strategy's scope, compile and calling the network use it and fit
+                      splits each batch across the replicas with the batch norm statistics synchronized between them. The CPU
+                      can only be split into logical devices before TensorFlow has run anything, so create the network or
+                      call Base_Network.split_cpu_into_devices first. Default is a single replica
+        - fuse_output_heads: Boolean to indicate whether to put multiple linear output heads into 1 Dense layer whose
+                             output gets split into the heads for their activations, so the heads cost 1 matmul instead
+                             of 1 per head. Weights saved without it can be converted with fuse_output_head_weights.
+                             Default is False
         - y_range: Tuple of float or integers of the form (y_lower, y_upper) indicating the range you want to restrict the
                    output values to in regression tasks. Default is no range restriction
         - return_final_seq_only: Boolean to indicate whether you only want to return the output for the final timestep (True)
                                  or if you want to return the output for all timesteps (False)
         - random_seed: Integer to indicate the random seed you want to use
 
-    NOTE that this class' call method expects input data in the form: (batch, sequence length, features)
+    NOTE that this class' call method expects input data in the form: (batch, sequence length, features). If the sequences
+    have different lengths then either provide them as a tf.RaggedTensor or pad them at the end and provide a mask to call.
+    To stream data through the network chunk by chunk get an initial state from init_state and then pass it to call, which
+    will then also return the state to use for the next chunk. Stream_Manager does this for many streams at once, keeping
+    the state of each stream id between calls
     """
     def __init__(self, layers_info, output_activation=None, hidden_activations="relu", dropout=0.0, initialiser="default",
                  batch_norm=False, columns_of_data_to_be_embedded=[], embedding_dimensions=[], y_range= (),
-                 return_final_seq_only=True, random_seed=0, input_dim=None):
-        Model.__init__(self)
-        self.embedding_to_occur = len(columns_of_data_to_be_embedded) > 0
-        self.columns_of_data_to_be_embedded = columns_of_data_to_be_embedded
-        self.embedding_dimensions = embedding_dimensions
-        self.embedding_layers = self.create_embedding_layers()
-        self.return_final_seq_only = return_final_seq_only
-        self.valid_RNN_hidden_layer_types = {"linear", "gru", "lstm"}
-        Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
-                              batch_norm, y_range, random_seed, input_dim)
+                 return_final_seq_only=True, random_seed=0, input_dim=None, static_columns_of_data_to_be_embedded=[],
+                 dtype_policy=None, distribute=None, fuse_output_heads=False,
+                 batch_norm_momentum=0.99):
+        with self.create_distribution_strategy(distribute).scope():
+            Model.__init__(self)
+            self.layer_dtype_policy = dtype_policy
+            self.batch_norm_momentum = batch_norm_momentum
+            self.fuse_output_heads = fuse_output_heads
+            self.embedding_to_occur = len(columns_of_data_to_be_embedded) > 0
+            self.columns_of_data_to_be_embedded = columns_of_data_to_be_embedded
+            self.static_columns_of_data_to_be_embedded = static_columns_of_data_to_be_embedded
+            self.embedding_dimensions = embedding_dimensions
+            self.return_final_seq_only = return_final_seq_only
+            self.valid_RNN_hidden_layer_types = {"linear", "gru", "lstm", "bilstm", "bigru", "attention"}
+            Base_Network.__init__(self, layers_info, output_activation, hidden_activations, dropout, initialiser,
+                                  batch_norm, y_range, random_seed, input_dim)
+            self.embedding_layer = self.create_embedding_layer(self.static_columns_of_data_to_be_embedded)
+            self.non_embedded_columns = {}
+            self.supports_masking = True
 
     def check_all_user_inputs_valid(self):
         """Checks that all the user inputs were valid"""
         self.check_RNN_layers_valid()
         self.check_activations_valid()
         self.check_embedding_dimensions_valid()
+        self.check_static_columns_of_data_to_be_embedded_valid()
+        self.check_dtype_policy_valid()
+        self.check_batch_norm_momentum_valid()
+        self.check_fuse_output_heads_valid()
         self.check_initialiser_valid()
         self.check_y_range_values_valid()
         self.check_return_final_seq_only_valid()
 
+    def check_static_columns_of_data_to_be_embedded_valid(self):
+        """Checks that user input for static_columns_of_data_to_be_embedded is valid"""
+        assert isinstance(self.static_columns_of_data_to_be_embedded, list), \
+            "static_columns_of_data_to_be_embedded must be a list"
+        for column in self.static_columns_of_data_to_be_embedded:
+            assert column in self.columns_of_data_to_be_embedded, \
+                "Static column {} must also be in columns_of_data_to_be_embedded".format(column)
+
     def check_RNN_layers_valid(self):
         """Checks that layers provided by user are valid"""
         error_msg_layer_type = "First element in a layer specification must be one of {}".format(self.valid_RNN_hidden_layer_types)
         error_msg_layer_form = "Layer must be of form [layer_name, hidden_units]"
+        error_msg_attention_layer = """Attention layer must be of form ['attention', d_model, n_heads, positional_encoding] 
+                                    where d_model and n_heads are integers >= 1, d_model is divisible by n_heads and the 
+                                    optional positional_encoding is a boolean"""
         error_msg_layer_list = "Layers must be provided as a list"
         error_msg_output_heads = "Number of output activations must equal number of output heads"
 
@@ -84,9 +137,15 @@ class RNN(Model, Base_Network):
             assert layer_type_name in self.valid_RNN_hidden_layer_types, "Layer name {} not valid, use one of {}".format(
                 layer_type_name, self.valid_RNN_hidden_layer_types)
 
-            assert isinstance(layer[1], int), error_msg_layer_form
-            assert layer[1] > 0, "Must have hidden_units >= 1"
-            assert len(layer) == 2, error_msg_layer_form
+            if layer_type_name == "attention":
+                assert len(layer) in [3, 4], error_msg_attention_layer
+                for ix in range(2): assert isinstance(layer[ix + 1], int) and layer[ix + 1] > 0, error_msg_attention_layer
+                assert layer[1] % layer[2] == 0, error_msg_attention_layer
+                if len(layer) == 4: assert isinstance(layer[3], bool), error_msg_attention_layer
+            else:
+                assert isinstance(layer[1], int), error_msg_layer_form
+                assert layer[1] > 0, "Must have hidden_units >= 1"
+                assert len(layer) == 2, error_msg_layer_form
 
             if rest_must_be_linear: assert layer[0].lower() == "linear", "If have linear layers then they must come at end"
             if layer_type_name == "linear": rest_must_be_linear = True
@@ -96,78 +155,195 @@ class RNN(Model, Base_Network):
         hidden_size = layer[1]
         if output_layer and self.return_final_seq_only: return_sequences = False
         else: return_sequences = True
-        if layer_type_name == "lstm":
-            rnn_hidden_layers.extend([LSTM(units=hidden_size, kernel_initializer=self.initialiser_function,
-                                           return_sequences=return_sequences)])
-        elif layer_type_name == "gru":
-            rnn_hidden_layers.extend([GRU(units=hidden_size, kernel_initializer=self.initialiser_function,
-                                          return_sequences=return_sequences)])
+        dtype = self.get_layer_dtype(output_layer)
+        if layer_type_name in ["lstm", "bilstm"]:
+            layer = LSTM(units=hidden_size, kernel_initializer=self.initialiser_function,
+                         return_sequences=return_sequences, return_state=True, dtype=dtype)
+            if layer_type_name == "bilstm": layer = Bidirectional(layer, dtype=dtype)
+            rnn_hidden_layers.extend([layer])
+        elif layer_type_name in ["gru", "bigru"]:
+            layer = GRU(units=hidden_size, kernel_initializer=self.initialiser_function,
+                        return_sequences=return_sequences, return_state=True, dtype=dtype)
+            if layer_type_name == "bigru": layer = Bidirectional(layer, dtype=dtype)
+            rnn_hidden_layers.extend([layer])
+        elif layer_type_name == "attention":
+            positional_encoding = layer[3] if len(layer) == 4 else False
+            rnn_hidden_layers.extend([Causal_Self_Attention(d_model=hidden_size, n_heads=layer[2],
+                                                            positional_encoding=positional_encoding,
+                                                            kernel_initializer=self.initialiser_function, dtype=dtype)])
         elif layer_type_name == "linear":
             rnn_hidden_layers.extend(
-                [Dense(units=hidden_size, activation=activation, kernel_initializer=self.initialiser_function)])
+                [Dense(units=hidden_size, activation=activation, kernel_initializer=self.initialiser_function, dtype=dtype)])
         else:
             raise ValueError("Wrong layer names")
         input_dim = hidden_size
         return input_dim
 
-    def call(self, x, training=True):
-        """Forward pass for the network. Note that it expects input data in the form (batch, seq length, features)"""
+    def call(self, x, training=True, state=None, mask=None):
+        """Forward pass for the network. Note that it expects input data in the form (batch, seq length, features). For
+        sequences of different lengths x can be a tf.RaggedTensor, or padded at the end with a boolean mask of shape
+        (batch, seq length) that is True for the real timesteps. The padded x and the mask can also be given together as
+        the tuple (x, mask), which is how Input_Pipeline batches them so that fit passes the mask on. The recurrent layers
+        then skip the padding, the final timestep of a sequence is its last real one and the output for padded timesteps
+        is 0, or the output is ragged too if x was ragged and return_final_seq_only is False. If a state (see init_state)
+        is provided then the recurrent layers start from it and the tuple (output, new state) is returned so that the next
+        chunk of the sequences can carry on from there"""
+        if isinstance(x, (tuple, list)): x, mask = x
+        return_state = state is not None
+        if return_state: self.check_state_valid(state)
+        else: state = [None] * (len(self.hidden_layers) + len(self.output_layers))
+        ragged_seq_lengths = x.row_lengths() if isinstance(x, tf.RaggedTensor) else None
+        if ragged_seq_lengths is not None: x, mask = x.to_tensor(), tf.sequence_mask(ragged_seq_lengths)
+        if mask is not None: x, mask, padded_seq_length = self.remove_padding_only_timesteps(x, mask)
         if self.embedding_to_occur: x = self.incorporate_embeddings(x)
         training = training or training is None
-        x, restricted_to_final_seq = self.process_hidden_layers(x, training)
-        out = self.process_output_layers(x, restricted_to_final_seq)
+        x, restricted_to_final_seq, new_hidden_state = self.process_hidden_layers(x, training,
+                                                                                  state[:len(self.hidden_layers)], mask)
+        out, new_output_state = self.process_output_layers(x, restricted_to_final_seq, state[len(self.hidden_layers):],
+                                                           mask)
         if self.y_range: out = self.y_range[0] + (self.y_range[1] - self.y_range[0]) * activations.sigmoid(out)
+        if mask is not None and not self.return_final_seq_only:
+            out = self.zero_padded_timesteps(out, mask, padded_seq_length)
+            if ragged_seq_lengths is not None: out = tf.RaggedTensor.from_tensor(out, lengths=ragged_seq_lengths)
+        if return_state: return out, new_hidden_state + new_output_state
         return out
 
+    def compute_mask(self, inputs, mask=None):
+        """The padding gets handled within call so the output doesn't carry a mask"""
+        return None
+
+    def remove_padding_only_timesteps(self, x, mask):
+        """Drops the timesteps at the end that are padding for every sequence so no computation is wasted on them. Returns
+        the shortened x and mask along with the original sequence length"""
+        padded_seq_length = ops.shape(x)[1]
+        max_seq_length = ops.max(ops.sum(ops.cast(mask, "int32"), axis=1))
+        return x[:, :max_seq_length], mask[:, :max_seq_length], padded_seq_length
+
+    def zero_padded_timesteps(self, out, mask, padded_seq_length):
+        """Sets the output for padded timesteps to 0 and pads it back to the original sequence length"""
+        out = out * ops.cast(mask[:, :, None], out.dtype)
+        return ops.pad(out, [[0, 0], [0, padded_seq_length - ops.shape(out)[1]], [0, 0]])
+
+    def init_state(self, batch_size):
+        """Returns the initial state to provide to call when streaming a batch of sequences through the network chunk by
+        chunk. It is a list with 1 element per hidden layer and output layer: None for linear layers, [h] for GRU layers and
+        [h, c] for LSTM layers where h and c have shape (batch_size, hidden_units)"""
+        self.check_network_can_stream()
+        state = []
+        for layer in self.hidden_layers + self.output_layers:
+            if type(layer) == Dense: state.append(None)
+            elif type(layer) == LSTM: state.append([tf.zeros((batch_size, layer.units), layer.compute_dtype),
+                                                    tf.zeros((batch_size, layer.units), layer.compute_dtype)])
+            else: state.append([tf.zeros((batch_size, layer.units), layer.compute_dtype)])
+        return state
+
+    def rollout(self, history, horizon, feedback_fn=None):
+        """Forecasts horizon steps ahead for a batch of series by putting the history of shape (batch, seq length, features)
+        through the network once and then feeding each prediction back in as the next input while carrying the state, so
+        each extra step only costs 1 timestep. feedback_fn(prediction, previous_input) should return the next input of shape
+        (batch, features) from the prediction of shape (batch, output dim) and the previous input. If it isn't provided
+        then the prediction itself is used as the next input. Returns the predictions with shape (batch, horizon, output dim)"""
+        assert isinstance(horizon, int) and horizon >= 1, "horizon must be an integer of 1 or higher"
+        if feedback_fn is None: feedback_fn = lambda prediction, previous_input: prediction
+        history = tf.convert_to_tensor(history)
+        out, state = self(history, training=False, state=self.init_state(history.shape[0]))
+        prediction = out if self.return_final_seq_only else out[:, -1]
+        previous_input = history[:, -1]
+        predictions = [prediction]
+        for _ in range(horizon - 1):
+            previous_input = feedback_fn(prediction, previous_input)
+            out, state = self(previous_input[:, None], training=False, state=state)
+            prediction = out if self.return_final_seq_only else out[:, -1]
+            predictions.append(prediction)
+        return tf.stack(predictions, axis=1)
+
+    def check_state_valid(self, state):
+        """Checks that the state provided to call matches the layers of the network"""
+        assert isinstance(state, list), "state must be a list created by init_state"
+        assert len(state) == len(self.hidden_layers) + len(self.output_layers), "state must have 1 element per layer"
+        self.check_network_can_stream()
+        for layer, layer_state in zip(self.hidden_layers + self.output_layers, state):
+            if type(layer) == Dense: continue
+            expected_length = 2 if type(layer) == LSTM else 1
+            assert isinstance(layer_state, list) and len(layer_state) == expected_length, \
+                "state for a {} layer must be a list of {} tensors".format(type(layer).__name__, expected_length)
+
     def incorporate_embeddings(self, x):
-        """Puts relevant data through embedding layers and then concatenates the result with the rest of the data ready
-        to then be put through the hidden layers"""
-        all_embedded_data = []
-        for embedding_layer_ix, embedding_var in enumerate(self.columns_of_data_to_be_embedded):
-            data = x[:, :, embedding_var]
-            embedded_data = self.embedding_layers[embedding_layer_ix](data)
-            all_embedded_data.append(embedded_data)
-        if len(all_embedded_data) > 1: all_embedded_data = Concatenate(axis=2)(all_embedded_data)
-        else: all_embedded_data = all_embedded_data[0]
-        non_embedded_columns = [col for col in range(x.shape[2]) if col not in self.columns_of_data_to_be_embedded]
+        """Puts relevant data through the embedding layer and then concatenates the result with the rest of the data ready
+        to then be put through the hidden layers. Static columns only get embedded for the first timestep and the result is
+        broadcast across the sequence"""
+        all_embedded_data = self.embedding_layer(x)
+        non_embedded_columns = self.get_non_embedded_columns(x.shape[2])
         if len(non_embedded_columns) > 0:
-            x = tf.gather(x, non_embedded_columns, axis=2)
-            x = Concatenate(axis=2)([tf.dtypes.cast(x, float), all_embedded_data])
+            x = ops.take(x, non_embedded_columns, axis=2)
+            x = ops.concatenate([ops.cast(x, all_embedded_data.dtype), all_embedded_data], axis=2)
         else: x = all_embedded_data
         return x
 
-    def process_hidden_layers(self, x, training):
-        """Puts the data x through all the hidden layers"""
+    def check_network_can_stream(self):
+        """Checks that the network has no bidirectional or attention layers because they need the whole sequence at once"""
+        for layer in self.hidden_layers + self.output_layers:
+            assert type(layer) != Bidirectional, "Can't stream data through bidirectional layers"
+            assert type(layer) != Causal_Self_Attention, "Can't stream data through attention layers"
+
+    def extract_final_timestep(self, x, previous_layer, mask=None):
+        """Returns the data at the final timestep of x, or at the last real timestep of each sequence if a mask is given.
+        If x is the output of a bidirectional layer then the backward direction's output is taken from the first timestep
+        instead, which is where it has seen the whole sequence"""
+        if mask is None: final_x = x[:, -1, :]
+        else:
+            final_timesteps = ops.maximum(ops.sum(ops.cast(mask, "int32"), axis=1) - 1, 0)
+            final_x = ops.take_along_axis(x, final_timesteps[:, None, None], axis=1)[:, 0, :]
+        if type(previous_layer) == Bidirectional:
+            units = previous_layer.forward_layer.units
+            return ops.concatenate([final_x[:, :units], x[:, 0, units:]], axis=1)
+        return final_x
+
+    def process_hidden_layers(self, x, training, state, mask):
+        """Puts the data x through all the hidden layers. The recurrent layers start from the given state, skip the
+        timesteps the mask marks as padding and their final states get returned"""
         restricted_to_final_seq = False
+        new_state = []
         for layer_ix, layer in enumerate(self.hidden_layers):
             if type(layer) == Dense:
                 if self.return_final_seq_only and not restricted_to_final_seq:
-                    x = x[:, -1, :]
+                    x = self.extract_final_timestep(x, self.hidden_layers[layer_ix - 1] if layer_ix > 0 else None, mask)
                     restricted_to_final_seq = True
                 x = layer(x)
+                new_state.append(None)
+            elif type(layer) == Causal_Self_Attention:
+                x = self.get_activation(self.hidden_activations, layer_ix)(layer(x))
+                new_state.append(None)
             else:
-                x = layer(x)
-            if self.batch_norm:
-                x = self.batch_norm_layers[layer_ix](x, training=False)
+                x, *layer_state = layer(x, initial_state=state[layer_ix], mask=mask)
+                new_state.append(layer_state)
+            if self.batch_norm: x = self.apply_batch_norm(x, layer_ix, training, None if restricted_to_final_seq else mask)
             if self.dropout != 0.0 and training: x = self.dropout_layer(x)
-        return x, restricted_to_final_seq
+        return x, restricted_to_final_seq, new_state
 
-    def process_output_layers(self, x, restricted_to_final_seq):
+    def process_output_layers(self, x, restricted_to_final_seq, state, mask):
         """Puts the data x through all the output layers"""
         out = None
+        new_state = []
         for output_layer_ix, output_layer in enumerate(self.output_layers):
             if type(output_layer) == Dense:
                 if self.return_final_seq_only and not restricted_to_final_seq:
-                    x = x[:, -1, :]
+                    x = self.extract_final_timestep(x, self.hidden_layers[-1] if len(self.hidden_layers) > 0 else None,
+                                                    mask)
                     restricted_to_final_seq = True
                 temp_output = output_layer(x)
+                if self.fused_output_heads: temp_output = self.apply_fused_output_activations(temp_output)
+                new_state.append(None)
             else:
-                temp_output = output_layer(x)
+                if type(output_layer) == Causal_Self_Attention:
+                    temp_output = output_layer(x)
+                    if self.return_final_seq_only: temp_output = self.extract_final_timestep(temp_output, None, mask)
+                    new_state.append(None)
+                else:
+                    temp_output, *layer_state = output_layer(x, initial_state=state[output_layer_ix], mask=mask)
+                    new_state.append(layer_state)
                 activation = self.get_activation(self.output_activation, output_layer_ix)
                 temp_output = activation(temp_output)
             if out is None: out = temp_output
-            else:
-                if restricted_to_final_seq: dim = 1
-                else: dim = 2
-                out = Concatenate(axis=dim)([out, temp_output])
-        return out
+            else: out = ops.concatenate([out, temp_output], axis=-1)
+        return out, new_state
@@ -0,0 +1,83 @@
+import numpy as np
+import tensorflow as tf
+from nn_builder.tensorflow.RNN import RNN
+
+class Stream_Manager(object):
+    """Steps a TensorFlow RNN through many long streams of data chunk by chunk, such as the readings of sensors or the
+    events of users arriving online, keeping the recurrent state of each stream between calls so that a chunk only costs
+    as much as its own timesteps instead of the stream's whole history. The state of each stream id is kept in a row of
+    preallocated arrays. The rows of the streams in a call get gathered into a batch, put through the network with a
+    compiled step and the final states written back. New streams and streams that have been reset start from a zero state
+    Args:
+        - network: The nn_builder TensorFlow RNN to stream data through. It can't have bidirectional or attention layers
+        - initial_capacity: Integer to indicate the number of streams to allocate state for up front. It doubles whenever
+                            more streams than that are open. Default is 64
+    """
+    def __init__(self, network, initial_capacity=64):
+        self.network = network
+        self.initial_capacity = initial_capacity
+        self.check_all_user_inputs_valid()
+        self.states = [None if layer_state is None else [np.array(tensor) for tensor in layer_state]
+                       for layer_state in network.init_state(initial_capacity)]
+        self.capacity = initial_capacity
+        self.stream_rows = {}
+        self.free_rows = list(range(initial_capacity - 1, -1, -1))
+        self.step_network = tf.function(self.put_chunk_through_network, reduce_retracing=True)
+
+    def check_all_user_inputs_valid(self):
+        """Checks that all the user inputs were valid"""
+        assert isinstance(self.network, RNN), "network must be an nn_builder TensorFlow RNN"
+        assert isinstance(self.initial_capacity, int) and self.initial_capacity > 0, \
+            "initial_capacity must be an integer of 1 or higher"
+        self.network.check_network_can_stream()
+
+    def step(self, stream_ids, x, mask=None):
+        """Puts the next chunk of each stream through the network starting from the state the stream's previous chunk
+        ended in and returns the output. x has shape (len(stream_ids), chunk length, features) and a boolean mask of shape
+        (len(stream_ids), chunk length) can be given if the chunks have different lengths, in which case each stream's
+        state is the one at its last real timestep"""
+        assert len(set(stream_ids)) == len(stream_ids), "Each stream id can only appear once in a call to step"
+        assert len(stream_ids) == len(x), "x must contain 1 chunk per stream id"
+        rows = np.array([self.get_row(stream_id) for stream_id in stream_ids])
+        state = [None if layer_state is None else [tf.convert_to_tensor(array[rows]) for array in layer_state]
+                 for layer_state in self.states]
+        out, new_state = self.step_network(tf.convert_to_tensor(x), state, mask)
+        for layer_state, new_layer_state in zip(self.states, new_state):
+            if layer_state is None: continue
+            for array, tensor in zip(layer_state, new_layer_state): array[rows] = tensor.numpy()
+        return out
+
+    def put_chunk_through_network(self, x, state, mask):
+        """Runs the network in inference mode on a batch of chunks from the given state"""
+        return self.network(x, training=False, state=state, mask=mask)
+
+    def get_row(self, stream_id):
+        """Returns the row holding the state of the stream, giving new streams a free row with a zero state"""
+        if stream_id not in self.stream_rows:
+            if len(self.free_rows) == 0: self.increase_capacity()
+            self.stream_rows[stream_id] = self.free_rows.pop()
+        return self.stream_rows[stream_id]
+
+    def increase_capacity(self):
+        """Doubles the number of rows of state so that more streams can be open at once"""
+        for layer_state in self.states:
+            if layer_state is None: continue
+            for tensor_ix, array in enumerate(layer_state):
+                layer_state[tensor_ix] = np.concatenate([array, np.zeros_like(array)])
+        self.free_rows = list(range(2 * self.capacity - 1, self.capacity - 1, -1))
+        self.capacity *= 2
+
+    def reset(self, stream_id=None):
+        """Ends a stream so that its next chunk starts from a zero state again and its row can be reused. If no stream id
+        is given then every stream gets reset"""
+        stream_ids = list(self.stream_rows) if stream_id is None else [stream_id]
+        for stream_id in stream_ids:
+            if stream_id not in self.stream_rows: continue
+            row = self.stream_rows.pop(stream_id)
+            for layer_state in self.states:
+                if layer_state is None: continue
+                for array in layer_state: array[row] = 0
+            self.free_rows.append(row)
+
+    def __len__(self):
+        return len(self.stream_rows)
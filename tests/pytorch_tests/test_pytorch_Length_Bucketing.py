@@ -0,0 +1,86 @@
+import functools
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from nn_builder.pytorch.Length_Bucketing import Length_Bucket_Sampler, collate_padded_sequences, padding_efficiency
+from nn_builder.pytorch.RNN import RNN
+
+torch.manual_seed(0)
+lengths = torch.randint(1, 60, (500,))
+sequences = [torch.randn((length, 3)) for length in lengths]
+
+def test_user_inputs_checked():
+    """Tests that invalid user inputs raise an error"""
+    for kwargs in [{"lengths": [], "batch_size": 4}, {"lengths": [3, 0], "batch_size": 4},
+                   {"lengths": [3, 2], "batch_size": 0}, {"lengths": [3, 2], "batch_size": 2.0},
+                   {"lengths": [3, 2], "batch_size": 2, "batches_per_bucket": 0},
+                   {"lengths": [3, 2], "batch_size": 2, "shuffle": 1}]:
+        with pytest.raises(AssertionError):
+            Length_Bucket_Sampler(**kwargs)
+
+def test_batches_cover_every_sequence_once():
+    """Tests that each epoch contains every sequence exactly once and that len matches the number of batches"""
+    for batch_size, batches_per_bucket, shuffle, drop_last in [(16, 4, True, False), (7, 3, True, True), (16, 4, False, False),
+                                                                (32, 100, True, False), (9, 2, False, True)]:
+        sampler = Length_Bucket_Sampler(lengths, batch_size, batches_per_bucket, shuffle, drop_last, random_seed=1)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(len(batch) <= batch_size for batch in batches)
+        indices = [ix for batch in batches for ix in batch]
+        assert len(indices) == len(set(indices))
+        if not drop_last: assert sorted(indices) == list(range(len(lengths)))
+        else: assert all(len(batch) == batch_size for batch in batches)
+
+def test_shuffling_is_random_across_epochs_and_seeded():
+    """Tests that the batches change each epoch and are reproducible with a random seed"""
+    sampler = Length_Bucket_Sampler(lengths, 16, batches_per_bucket=4, random_seed=3)
+    first_epoch, second_epoch = list(sampler), list(sampler)
+    assert first_epoch != second_epoch
+    assert list(Length_Bucket_Sampler(lengths, 16, batches_per_bucket=4, random_seed=3)) == first_epoch
+    batch_max_lengths = [max(lengths[batch]) for batch in first_epoch]
+    assert batch_max_lengths != sorted(batch_max_lengths, reverse=True)
+
+def test_bucketing_reduces_padding():
+    """Tests that bucketing needs less padding than random batches and that sorting the whole dataset needs the least"""
+    random_batches = torch.randperm(len(lengths)).split(16)
+    random_efficiency = padding_efficiency(lengths, [batch.tolist() for batch in random_batches])
+    bucket_sampler = Length_Bucket_Sampler(lengths, 16, batches_per_bucket=8, random_seed=0)
+    sorted_sampler = Length_Bucket_Sampler(lengths, 16, shuffle=False)
+    assert random_efficiency < bucket_sampler.padding_efficiency() < sorted_sampler.padding_efficiency() <= 1.0
+    list(bucket_sampler)
+    assert bucket_sampler.padding_efficiency() == padding_efficiency(lengths, bucket_sampler.last_batches)
+    assert padding_efficiency([3, 3, 1], [[0, 1], [2]]) == 1.0
+    assert padding_efficiency([4, 2], [[0, 1]]) == 0.75
+
+def test_collate_padded_sequences():
+    """Tests that collate_padded_sequences pads the sequences and returns their lengths"""
+    x, batch_lengths = collate_padded_sequences(sequences[:5])
+    assert x.shape == (5, max(lengths[:5]), 3)
+    assert torch.equal(batch_lengths, lengths[:5])
+    for ix in range(5):
+        assert torch.equal(x[ix, :lengths[ix]], sequences[ix])
+        assert torch.all(x[ix, lengths[ix]:] == 0)
+    x, batch_lengths, y = collate_padded_sequences([(sequences[ix], torch.tensor([float(ix)])) for ix in range(4)])
+    assert y.shape == (4, 1)
+    x, batch_lengths, y = collate_padded_sequences([(sequences[ix], sequences[ix][:, :1]) for ix in range(4)],
+                                                   pad_targets=True)
+    assert y.shape == (4, x.shape[1], 1)
+
+def test_dataloader_batches_train_rnn():
+    """Tests that the sampler and collate function work with a DataLoader to train an RNN on variable length sequences"""
+    dataset = [(sequence, sequence[:, :1].cumsum(0)) for sequence in sequences]
+    data_loader = DataLoader(dataset, batch_sampler=Length_Bucket_Sampler(lengths, 32, batches_per_bucket=4, random_seed=0),
+                             collate_fn=functools.partial(collate_padded_sequences, pad_targets=True))
+    rnn = RNN(input_dim=3, layers_info=[["gru", 16], ["linear", 1]], return_final_seq_only=False)
+    optimizer = torch.optim.Adam(rnn.parameters(), lr=0.01)
+    losses = []
+    for _ in range(3):
+        for x, batch_lengths, y in data_loader:
+            mask = torch.arange(x.shape[1])[None, :] < batch_lengths[:, None]
+            out = rnn(x, lengths=batch_lengths)
+            loss = ((out - y)[mask] ** 2).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+    assert losses[-1] < losses[0]
@@ -0,0 +1,73 @@
+import pytest
+import torch
+from nn_builder.pytorch.Prefix_State_Cache import Prefix_State_Cache
+from nn_builder.pytorch.RNN import RNN
+
+torch.manual_seed(0)
+prefixes = torch.randn((3, 12, 4))
+
+def create_rnn(return_final_seq_only=True):
+    """Creates an RNN with every streamable type of layer in eval mode"""
+    rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["tcn", 6, 2, 2], ["lstm", 8], ["linear", 3]],
+              return_final_seq_only=return_final_seq_only)
+    return rnn.eval()
+
+def create_requests(prefix_ixs, tail_length=3):
+    """Creates a batch of sequences made of the given shared prefixes followed by random tails"""
+    return torch.cat((prefixes[prefix_ixs], torch.randn((len(prefix_ixs), tail_length, 4))), dim=1)
+
+def test_user_inputs_checked():
+    """Tests that invalid user inputs raise an error"""
+    with pytest.raises(AssertionError):
+        Prefix_State_Cache(RNN(input_dim=4, layers_info=[["bigru", 10], ["linear", 3]]))
+    for kwargs in [{"max_entries": 0}, {"max_bytes": -5}, {"max_entries": 2.5}]:
+        with pytest.raises(AssertionError):
+            Prefix_State_Cache(create_rnn(), **kwargs)
+    with pytest.raises(AssertionError):
+        Prefix_State_Cache(create_rnn())(create_requests([0]), prefix_length=15)
+
+def test_cached_output_matches_full_forward_pass():
+    """Tests that the output is the same as putting the whole sequences through the rnn whether the prefixes were cached
+    or not"""
+    for return_final_seq_only in [True, False]:
+        rnn = create_rnn(return_final_seq_only)
+        cache = Prefix_State_Cache(rnn)
+        for prefix_ixs in [[0, 1, 0], [1, 2, 0, 0, 2], [2]]:
+            x = create_requests(prefix_ixs)
+            with torch.no_grad():
+                out = cache(x, prefix_length=12)
+                expected = rnn(x) if return_final_seq_only else rnn(x)[:, 12:]
+            assert torch.allclose(out, expected, atol=1e-5)
+        assert cache.misses == 3 and cache.hits == 6
+        assert cache.hit_rate() == 6 / 9
+        assert len(cache.cache) == 3
+
+def test_least_recently_used_states_get_evicted():
+    """Tests that the cache keeps within max_entries and max_bytes by evicting the least recently used states"""
+    cache = Prefix_State_Cache(create_rnn(), max_entries=2)
+    with torch.no_grad():
+        cache(create_requests([0, 1]), prefix_length=12)
+        cache(create_requests([0]), prefix_length=12)
+        cache(create_requests([2]), prefix_length=12)
+    assert cache.evictions == 1 and len(cache.cache) == 2
+    assert cache.hash_prefix(prefixes[1]) not in cache.cache
+    assert cache.hash_prefix(prefixes[0]) in cache.cache
+    state_bytes = cache.bytes_used // 2
+    cache = Prefix_State_Cache(create_rnn(), max_bytes=state_bytes * 2 + 1)
+    with torch.no_grad():
+        cache(create_requests([0, 1, 2]), prefix_length=12)
+    assert len(cache.cache) == 2 and cache.bytes_used == state_bytes * 2
+    assert cache.evictions == 1
+    cache.clear()
+    assert len(cache.cache) == 0 and cache.bytes_used == 0
+
+def test_different_prefix_lengths_are_cached_separately():
+    """Tests that the same data with a different prefix length doesn't give a cache hit"""
+    rnn = create_rnn()
+    cache = Prefix_State_Cache(rnn)
+    x = create_requests([0, 1])
+    with torch.no_grad():
+        cache(x, prefix_length=12)
+        out = cache(x, prefix_length=10)
+        assert torch.allclose(out, rnn(x), atol=1e-5)
+    assert cache.misses == 4 and cache.hits == 0
@@ -595,3 +595,279 @@ def test_output_head_shapes_correct():
         out = nn_instance(X)
         assert out.shape[0] == N
         assert out.shape[1] == 20
+
+def test_variable_length_sequences():
+    """Tests that providing lengths gives the same output as putting each unpadded sequence through the network on its own"""
+    lengths = [5, 2, 4, 1]
+    X = torch.randn((4, 5, 6))
+    for multiple_heads in [False, True]:
+        for return_final_seq_only, y_range in [(True, ()), (False, ()), (True, (-1, 3)), (False, (-1, 3))]:
+            if multiple_heads: layers_info = [["lstm", 20], ["gru", 7], [["lstm", 2], ["linear", 3]]]
+            else: layers_info = [["gru", 20], ["lstm", 8], ["linear", 3]]
+            rnn = RNN(input_dim=6, layers_info=layers_info, hidden_activations="relu",
+                      output_activation=["softmax", None] if multiple_heads else None,
+                      return_final_seq_only=return_final_seq_only, initialiser="xavier", y_range=y_range)
+            out = rnn(X, lengths=torch.tensor(lengths))
+            for ix, length in enumerate(lengths):
+                individual_out = rnn(X[ix:ix+1, :length])
+                if return_final_seq_only:
+                    assert torch.allclose(out[ix], individual_out[0], atol=1e-5)
+                else:
+                    assert out.shape[1] == 5
+                    assert torch.allclose(out[ix, :length], individual_out[0], atol=1e-5)
+                    assert torch.all(out[ix, length:] == 0.0)
+
+def test_variable_length_sequences_with_embeddings_and_batch_norm():
+    """Tests that providing lengths works with embeddings, batch norm and dropout"""
+    X = torch.randn((6, 7, 4))
+    X[:, :, 0] = abs(X[:, :, 0] * 3).long()
+    rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 5], ["linear", 2]], columns_of_data_to_be_embedded=[0],
+              embedding_dimensions=[[20, 3]], batch_norm=True, dropout=0.2, y_range=(-1, 1))
+    out = rnn(X, lengths=[7, 1, 3, 3, 6, 2])
+    assert out.shape == (6, 2)
+    assert torch.all(out > -1) and torch.all(out < 1)
+    out.sum().backward()
+
+def test_final_seq_only_matches_final_timestep_of_all_seqs():
+    """Tests that restricting to the final timestep early gives the same output as computing every timestep"""
+    X = torch.randn((8, 6, 5))
+    for layers_info in [[["gru", 20], ["lstm", 8], ["linear", 10], ["linear", 3]], [["gru", 20], ["linear", 3]],
+                        [["lstm", 20], [["linear", 3], ["linear", 4]]], [["lstm", 20], [["gru", 3], ["linear", 4]]]]:
+        output_activation = ["softmax", "relu"] if isinstance(layers_info[-1][0], list) else "softmax"
+        final_seq_rnn = RNN(input_dim=5, layers_info=copy.deepcopy(layers_info), hidden_activations="relu",
+                            output_activation=output_activation, return_final_seq_only=True)
+        all_seqs_rnn = RNN(input_dim=5, layers_info=copy.deepcopy(layers_info), hidden_activations="relu",
+                           output_activation=output_activation, return_final_seq_only=False)
+        assert torch.allclose(final_seq_rnn(X), all_seqs_rnn(X)[:, -1, :], atol=1e-6)
+
+def test_streaming_with_state_matches_full_sequence():
+    """Tests that streaming chunks of a sequence through the network while carrying the state gives the same output as
+    putting the whole sequence through at once"""
+    X = torch.randn((4, 9, 6))
+    X[:, :, 0] = abs(X[:, :, 0] * 3).long()
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(input_dim=6, layers_info=[["gru", 10], ["lstm", 7], [["lstm", 3], ["linear", 5]]],
+                  output_activation=["softmax", None], columns_of_data_to_be_embedded=[0], embedding_dimensions=[[20, 3]],
+                  batch_norm=True, return_final_seq_only=return_final_seq_only)
+        rnn.eval()
+        full_out = rnn(X)
+        state = rnn.init_state(4)
+        assert len(state) == 4
+        assert state[0].shape == (1, 4, 10)
+        assert state[1][0].shape == (1, 4, 7) and state[1][1].shape == (1, 4, 7)
+        assert state[3] is None
+        chunk_outputs = []
+        for start in range(0, 9, 3):
+            out, state = rnn(X[:, start:start+3], state=state)
+            chunk_outputs.append(out)
+        if return_final_seq_only:
+            assert torch.allclose(chunk_outputs[-1], full_out, atol=1e-5)
+        else:
+            assert torch.allclose(torch.cat(chunk_outputs, dim=1), full_out, atol=1e-5)
+
+def test_streaming_state_user_input():
+    """Tests that forward rejects a state that doesn't match the network"""
+    rnn = RNN(input_dim=6, layers_info=[["gru", 10], ["lstm", 7], ["linear", 5]])
+    X = torch.randn((4, 9, 6))
+    for invalid_state in [rnn.init_state(3), rnn.init_state(4)[:2], (None, None, None)]:
+        with pytest.raises(AssertionError):
+            rnn(X, state=invalid_state)
+
+def test_bidirectional_layers():
+    """Tests that bidirectional layers get created with the right widths and output the right shapes"""
+    rnn = RNN(input_dim=5, layers_info=[["bigru", 10], ["bilstm", 7], ["gru", 4], [["bilstm", 3], ["linear", 2]]],
+              output_activation=[None, "softmax"], batch_norm=True)
+    assert rnn.hidden_layers[0].bidirectional and type(rnn.hidden_layers[0]) == nn.GRU
+    assert rnn.hidden_layers[1].bidirectional and type(rnn.hidden_layers[1]) == nn.LSTM
+    assert rnn.hidden_layers[1].input_size == 20
+    assert rnn.hidden_layers[2].input_size == 14
+    assert rnn.batch_norm_layers[0].num_features == 20
+    assert rnn.batch_norm_layers[1].num_features == 14
+    assert rnn.output_layers[0].input_size == 4
+    assert rnn.output_layers[1].in_features == 4
+    X = torch.randn((6, 8, 5))
+    assert rnn(X).shape == (6, 8)
+    assert rnn(X, lengths=[8, 3, 5, 1, 8, 2]).shape == (6, 8)
+    with pytest.raises(AssertionError):
+        rnn.init_state(6)
+
+def test_bidirectional_final_timestep_sees_whole_sequence():
+    """Tests that with return_final_seq_only the backward direction's output is taken from where it has seen the whole
+    sequence, including when the sequences are padded"""
+    rnn = RNN(input_dim=5, layers_info=[["bilstm", 6], ["linear", 3]], return_final_seq_only=True)
+    hidden_layer = rnn.hidden_layers[0]
+    X = torch.randn((4, 7, 5))
+    full_output = hidden_layer(X)[0]
+    expected = rnn.output_layers[0](torch.cat((full_output[:, -1, :6], full_output[:, 0, 6:]), dim=1))
+    assert torch.allclose(rnn(X), expected, atol=1e-6)
+    lengths = [7, 2, 5, 4]
+    out = rnn(X, lengths=lengths)
+    for ix, length in enumerate(lengths):
+        assert torch.allclose(out[ix], rnn(X[ix:ix+1, :length])[0], atol=1e-5)
+
+def test_batch_norm_matches_transposed_batch_norm():
+    """Tests that batch norm on the (batch, seq, features) layout matches applying BatchNorm1d to (batch, features, seq)"""
+    rnn = RNN(input_dim=5, layers_info=[["gru", 10], ["lstm", 4]], batch_norm=True, return_final_seq_only=False)
+    X = torch.randn((6, 8, 5))
+    out = rnn(X)
+    expected = rnn.hidden_layers[0](X)[0]
+    expected = nn.functional.batch_norm(expected.transpose(1, 2), None, None, training=True).transpose(1, 2)
+    expected = rnn.output_layers[0](expected)[0]
+    assert torch.allclose(out, expected, atol=1e-5)
+
+def test_layer_norm():
+    """Tests that layer norm layers get created and normalise the output of every hidden layer"""
+    with pytest.raises(AssertionError):
+        RNN(input_dim=5, layers_info=[["gru", 10], ["linear", 4]], batch_norm=True, layer_norm=True)
+    with pytest.raises(AssertionError):
+        RNN(input_dim=5, layers_info=[["gru", 10], ["linear", 4]], layer_norm="yes")
+    rnn = RNN(input_dim=5, layers_info=[["gru", 10], ["bilstm", 3], ["linear", 6], ["linear", 4]], layer_norm=True)
+    assert [layer.normalized_shape for layer in rnn.layer_norm_layers] == [(10,), (6,), (6,)]
+    X = torch.randn((6, 8, 5))
+    assert rnn(X).shape == (6, 4)
+    assert rnn(X, lengths=[8, 1, 2, 3, 4, 5]).shape == (6, 4)
+    rnn(X).sum().backward()
+    assert rnn.layer_norm_layers[0].weight.grad is not None
+
+def test_tcn_layers():
+    """Tests that tcn layers get created correctly and are causal"""
+    for invalid_layer in [["tcn", 5, 3], ["tcn", 5, 0, 1], ["tcn", 5, 3, 1.5], ["tcn", 5, 3, 1, 1]]:
+        with pytest.raises(AssertionError):
+            RNN(input_dim=4, layers_info=[invalid_layer, ["linear", 1]])
+    rnn = RNN(input_dim=4, layers_info=[["tcn", 8, 3, 1], ["tcn", 8, 3, 2], ["tcn", 6, 2, 4], ["linear", 2]],
+              return_final_seq_only=False, batch_norm=True)
+    assert rnn.hidden_layers[0].conv.in_channels == 4 and rnn.hidden_layers[0].conv.out_channels == 8
+    assert rnn.hidden_layers[1].residual is None
+    assert rnn.hidden_layers[2].residual.out_channels == 6
+    assert rnn.output_layers[0].in_features == 6
+    assert rnn.calculate_receptive_field() == 1 + 2 + 4 + 4
+    rnn.eval()
+    X = torch.randn((3, 20, 4))
+    out = rnn(X)
+    assert out.shape == (3, 20, 2)
+    X_changed = X.clone()
+    X_changed[:, 12:] = torch.randn((3, 8, 4))
+    out_changed = rnn(X_changed)
+    assert torch.allclose(out[:, :12], out_changed[:, :12], atol=1e-6)
+    assert not torch.allclose(out[:, 12:], out_changed[:, 12:], atol=1e-6)
+    X_changed = X.clone()
+    X_changed[:, 0] = torch.randn((3, 4))
+    out_changed = rnn(X_changed)
+    assert torch.allclose(out[:, 11:], out_changed[:, 11:], atol=1e-6)
+    assert RNN(input_dim=4, layers_info=[["tcn", 8, 3, 1], ["lstm", 2]]).calculate_receptive_field() is None
+
+def test_tcn_layers_with_lengths_and_state():
+    """Tests that tcn layers work with padded sequences, streaming and the final timestep output"""
+    X = torch.randn((4, 12, 5))
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(input_dim=5, layers_info=[["tcn", 8, 3, 2], ["gru", 6], [["tcn", 3, 2, 1], ["linear", 2]]],
+                  output_activation=["softmax", None], return_final_seq_only=return_final_seq_only)
+        full_out = rnn(X)
+        state = rnn.init_state(4)
+        assert state[0].shape == (4, 4, 5)
+        chunk_outputs = []
+        for start in range(0, 12, 5):
+            out, state = rnn(X[:, start:start+5], state=state)
+            chunk_outputs.append(out)
+        if return_final_seq_only: assert torch.allclose(chunk_outputs[-1], full_out, atol=1e-5)
+        else: assert torch.allclose(torch.cat(chunk_outputs, dim=1), full_out, atol=1e-5)
+        lengths = [12, 3, 7, 1]
+        out, state = rnn(X, lengths=lengths, state=rnn.init_state(4))
+        for ix, length in enumerate(lengths):
+            individual_out, individual_state = rnn(X[ix:ix+1, :length], state=rnn.init_state(1))
+            if return_final_seq_only: assert torch.allclose(out[ix], individual_out[0], atol=1e-5)
+            else: assert torch.allclose(out[ix, :length], individual_out[0], atol=1e-5)
+            assert torch.allclose(state[0][ix], individual_state[0][0], atol=1e-6)
+
+def test_attention_layers():
+    """Tests that attention layers get created correctly and are causal"""
+    for invalid_layer in [["attention", 6, 4], ["attention", 8], ["attention", 8, 0], ["attention", 8, 2, "yes"],
+                          ["attention", 8, 2, True, 1]]:
+        with pytest.raises(AssertionError):
+            RNN(input_dim=4, layers_info=[invalid_layer, ["linear", 1]])
+    rnn = RNN(input_dim=4, layers_info=[["attention", 8, 2, True], ["attention", 8, 4], ["lstm", 5], ["linear", 2]],
+              return_final_seq_only=False, layer_norm=True, initialiser="xavier")
+    assert rnn.hidden_layers[0].input_projection.in_features == 4
+    assert rnn.hidden_layers[0].positional_encoding and not rnn.hidden_layers[1].positional_encoding
+    assert rnn.hidden_layers[1].input_projection is None
+    assert rnn.hidden_layers[1].attention.num_heads == 4
+    assert rnn.hidden_layers[2].input_size == 8
+    assert rnn.calculate_receptive_field() is None
+    with pytest.raises(AssertionError):
+        rnn.init_state(3)
+    rnn.eval()
+    X = torch.randn((3, 15, 4))
+    out = rnn(X)
+    assert out.shape == (3, 15, 2)
+    X_changed = X.clone()
+    X_changed[:, 9:] = torch.randn((3, 6, 4))
+    out_changed = rnn(X_changed)
+    assert torch.allclose(out[:, :9], out_changed[:, :9], atol=1e-5)
+    assert not torch.allclose(out[:, 9:], out_changed[:, 9:], atol=1e-5)
+    lengths = [15, 4, 9]
+    out = rnn(X, lengths=lengths)
+    for ix, length in enumerate(lengths):
+        assert torch.allclose(out[ix, :length], rnn(X[ix:ix+1, :length])[0], atol=1e-5)
+    rnn = RNN(input_dim=4, layers_info=[["attention", 8, 2], [["attention", 4, 1], ["linear", 3]]],
+              output_activation=["softmax", None])
+    assert rnn(X).shape == (3, 7)
+
+def test_static_embedding_columns():
+    """Tests that static embedding columns give the same output as embedding them at every timestep"""
+    X = torch.randn((5, 6, 4))
+    X[:, :, 0] = abs(X[:, :, 0] * 3).long()
+    X[:, :, 2] = torch.arange(5).float().unsqueeze(1).repeat(1, 6)
+    for invalid_static_columns in [[1], 2, [0, 3]]:
+        with pytest.raises(AssertionError):
+            RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+                embedding_dimensions=[[20, 3], [5, 4]], static_columns_of_data_to_be_embedded=invalid_static_columns)
+    rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+              embedding_dimensions=[[20, 3], [5, 4]], return_final_seq_only=False)
+    static_rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+                     embedding_dimensions=[[20, 3], [5, 4]], return_final_seq_only=False,
+                     static_columns_of_data_to_be_embedded=[2])
+    static_rnn.load_state_dict(rnn.state_dict())
+    assert torch.allclose(rnn(X), static_rnn(X))
+    assert torch.allclose(rnn(X, lengths=[6, 2, 3, 1, 5]), static_rnn(X, lengths=[6, 2, 3, 1, 5]))
+    static_rnn(X).sum().backward()
+    assert static_rnn.embedding_layers[1].weight.grad is not None
+    padded_X = X.clone()
+    for sequence_ix, length in enumerate([6, 2, 3, 1, 5]): padded_X[sequence_ix, length:] = 0.0
+    static_rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+                     embedding_dimensions=[[20, 3], [5, 4]], return_final_seq_only=False,
+                     static_columns_of_data_to_be_embedded=[2])
+    static_rnn.load_state_dict(rnn.state_dict())
+    assert torch.allclose(rnn(padded_X, lengths=[6, 2, 3, 1, 5]), static_rnn(padded_X, lengths=[6, 2, 3, 1, 5]))
+    X[0, 3, 2] = 4.0
+    static_rnn = RNN(input_dim=4, layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+                     embedding_dimensions=[[20, 3], [5, 4]], static_columns_of_data_to_be_embedded=[2])
+    with pytest.raises(AssertionError):
+        static_rnn(X)
+
+def test_rollout():
+    """Tests that rollout gives the same forecasts as putting the history plus the fed back predictions through forward"""
+    history = torch.randn((6, 10, 3))
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(input_dim=3, layers_info=[["gru", 12], ["lstm", 8], ["linear", 3]], batch_norm=True,
+                  return_final_seq_only=return_final_seq_only)
+        rnn.eval()
+        with torch.no_grad():
+            predictions = rnn.rollout(history, horizon=5)
+            assert predictions.shape == (6, 5, 3)
+            for step in range(5):
+                full_sequence = torch.cat((history, predictions[:, :step]), dim=1)
+                out = rnn(full_sequence)
+                out = out if return_final_seq_only else out[:, -1]
+                assert torch.allclose(predictions[:, step], out, atol=1e-5)
+    rnn = RNN(input_dim=3, layers_info=[["gru", 12], ["tcn", 5, 2, 2], ["linear", 1]])
+    rnn.eval()
+    feedback_fn = lambda prediction, previous_input: torch.cat((prediction, previous_input[:, 1:2] + 1.0,
+                                                                previous_input[:, 2:]), dim=1)
+    with torch.no_grad():
+        predictions = rnn.rollout(history, horizon=4, feedback_fn=feedback_fn)
+        assert predictions.shape == (6, 4, 1)
+        next_input = feedback_fn(predictions[:, 0], history[:, -1])
+        assert torch.allclose(predictions[:, 1], rnn(torch.cat((history, next_input.unsqueeze(1)), dim=1)), atol=1e-5)
+    assert rnn.rollout(history, horizon=1).shape == (6, 1, 1)
+    with pytest.raises(AssertionError):
+        rnn.rollout(history, horizon=0)
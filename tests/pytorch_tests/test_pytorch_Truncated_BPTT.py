@@ -0,0 +1,63 @@
+# Run from home directory with python -m pytest tests
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from nn_builder.pytorch.RNN import RNN
+from nn_builder.pytorch.Truncated_BPTT import Truncated_BPTT
+
+torch.manual_seed(0)
+N = 16
+X = torch.randn((N, 200, 3))
+y = torch.cumsum(X[:, :, 0:1], dim=1) * 0.1
+
+def create_rnn(return_final_seq_only=False):
+    """Creates a small RNN to train"""
+    return RNN(input_dim=3, layers_info=[["gru", 16], ["lstm", 8], ["linear", 1]], return_final_seq_only=return_final_seq_only,
+               initialiser="xavier")
+
+def test_user_input_rejections():
+    """Tests whether the trainer rejects invalid inputs"""
+    rnn = create_rnn()
+    optimizer = optim.Adam(rnn.parameters())
+    for k1, k2 in [(0, None), (5, 4), (2.5, None), (5, 5.5)]:
+        with pytest.raises(AssertionError):
+            Truncated_BPTT(rnn, optimizer, nn.MSELoss(), k1=k1, k2=k2)
+    with pytest.raises(AssertionError):
+        Truncated_BPTT(nn.LSTM(3, 5), optimizer, nn.MSELoss(), k1=5)
+
+def test_number_of_updates():
+    """Tests that the parameters get updated once per window of k1 timesteps"""
+    for k1, k2, expected_updates in [(50, None, 4), (30, 60, 7), (200, 200, 1), (7, 20, 29)]:
+        rnn = create_rnn()
+        trainer = Truncated_BPTT(rnn, optim.Adam(rnn.parameters()), nn.MSELoss(), k1=k1, k2=k2)
+        losses = trainer.train_on_sequences(X, y)
+        assert len(losses) == expected_updates
+
+def test_gradients_only_flow_back_k2_timesteps():
+    """Tests that the graph of each update only covers the last k2 timesteps"""
+    rnn = create_rnn()
+    x = X[:2, :30].clone().requires_grad_(True)
+    window_grads = []
+    class Recording_Optimizer(optim.SGD):
+        def step(self, closure=None):
+            window_grads.append(x.grad.clone())
+            x.grad = None
+            return super().step(closure)
+    trainer = Truncated_BPTT(rnn, Recording_Optimizer(rnn.parameters(), lr=0.0), nn.MSELoss(), k1=10, k2=15)
+    trainer.train_on_sequences(x, y[:2, :30])
+    assert len(window_grads) == 3
+    for window_ix, grad in enumerate(window_grads):
+        window_end = (window_ix + 1) * 10
+        nonzero_timesteps = torch.nonzero(grad.abs().sum(dim=(0, 2))).squeeze(1)
+        assert nonzero_timesteps.min() >= max(0, window_end - 15)
+        assert nonzero_timesteps.max() < window_end
+
+def test_model_trains():
+    """Tests that training with truncated backpropagation through time reduces the loss"""
+    for return_final_seq_only in [False, True]:
+        rnn = create_rnn(return_final_seq_only)
+        trainer = Truncated_BPTT(rnn, optim.Adam(rnn.parameters(), lr=0.01), nn.MSELoss(), k1=20, k2=40, clip_grad_norm=1.0)
+        first_losses = trainer.train_on_sequences(X, y)
+        for _ in range(15): losses = trainer.train_on_sequences(X, y)
+        assert sum(losses) < sum(first_losses)
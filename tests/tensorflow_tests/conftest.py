@@ -0,0 +1,8 @@
+import pytest
+from nn_builder.tensorflow.Base_Network import Base_Network
+
+@pytest.fixture(scope="session", autouse=True)
+def cpu_split_into_2_devices():
+    """Splits the CPU into 2 logical devices before any test runs something in TensorFlow so that networks can be trained
+    on 2 replicas"""
+    Base_Network.split_cpu_into_devices(2)
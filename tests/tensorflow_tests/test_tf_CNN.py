@@ -4,11 +4,12 @@ import pytest
 import random
 import numpy as np
 import tensorflow as tf
+import torch
 import torch.nn as nn
+from nn_builder.pytorch.CNN import CNN as PyTorch_CNN
 from nn_builder.tensorflow.CNN import CNN
 from tensorflow.keras.layers import Dense, Flatten, Conv2D, Concatenate, BatchNormalization, MaxPool2D, AveragePooling2D
 
-
 N = 250
 X = np.random.random((N, 5, 5, 1))
 X[0:125, 3, 3, 0] += 20.0
@@ -507,3 +508,121 @@ def test_output_head_shapes_correct():
         assert out.shape[0] == N
         assert out.shape[1] == 20
 
+
+def test_compile_call():
+    """Tests that compile_call gives the same output as calling the network eagerly and only traces once for all batch
+    sizes when given an input signature"""
+    X = np.random.random((20, 6, 6, 2)).astype('float32')
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["linear", 5], [["linear", 2], ["linear", 1]]],
+              output_activation=["softmax", None], batch_norm=True)
+    compiled_call = cnn.compile_call(input_signature=(6, 6, 2), jit_compile=True)
+    for batch_size in [1, 7, 20]:
+        assert np.allclose(compiled_call(X[:batch_size]), cnn(X[:batch_size], training=False), atol=1e-5)
+    assert cnn.trace_count == 1
+
+def test_to_functional():
+    """Tests that to_functional creates a functional model that gives the same output and shares its weights"""
+    X = np.random.random((5, 6, 6, 2)).astype('float32')
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["linear", 5], [["linear", 2], ["linear", 1]]],
+              output_activation=["softmax", None], batch_norm=True, dropout=0.2)
+    functional_model = cnn.to_functional((6, 6, 2))
+    assert np.allclose(functional_model(X, training=False), cnn(X, training=False), atol=1e-6)
+    cnn.hidden_layers[0].kernel.assign(tf.zeros_like(cnn.hidden_layers[0].kernel))
+    assert np.allclose(functional_model(X, training=False), cnn(X, training=False), atol=1e-6)
+
+def test_dtype_policy():
+    """Tests that the hidden layers use the dtype policy while the output layers and output stay float32"""
+    X = np.random.random((5, 6, 6, 2)).astype('float32')
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["linear", 5], [["linear", 2], ["linear", 1]]],
+              output_activation=["softmax", None], batch_norm=True, dropout=0.2, dtype_policy="mixed_bfloat16")
+    assert cnn(X).dtype == tf.float32
+    assert all(layer.compute_dtype == "bfloat16" for layer in cnn.hidden_layers + cnn.batch_norm_layers)
+    assert all(layer.compute_dtype == "float32" for layer in cnn.output_layers)
+
+def test_export_for_serving(tmp_path):
+    """Tests that export_for_serving saves SavedModel and TFLite models that give the same output as the network"""
+    X = np.random.random((5, 6, 6, 2)).astype('float32')
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"], ["linear", 5], [["linear", 2], ["linear", 1]]],
+              output_activation=["softmax", None], batch_norm=True, dropout=0.2)
+    report = cnn.export_for_serving(str(tmp_path / "model"), (6, 6, 2), representative_data=X)
+    assert report["max_abs_error"] < 1e-6
+    for quantize, max_error in [(None, 1e-5), ("dynamic", 0.05), ("int8", 0.2)]:
+        report = cnn.export_for_serving(str(tmp_path / "model.tflite"), (6, 6, 2), format="tflite", quantize=quantize,
+                                        representative_data=X)
+        assert report["max_abs_error"] < max_error
+
+def test_fold_batch_norm():
+    """Tests that folding the batch norm layers into the layers after them doesn't change the output when not training and
+    that batch norm layers followed by same padding convolutions or pooling layers are kept"""
+    X = np.random.random((5, 8, 8, 2)).astype('float32')
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "valid"], ["conv", 4, 3, 1, "same"], ["maxpool", 2, 2, "valid"],
+                           ["conv", 4, 1, 1, "valid"], ["linear", 5], [["linear", 2], ["linear", 1]]],
+              output_activation=["softmax", None], batch_norm=True, dropout=0.2)
+    for _ in range(10): cnn(X, training=True)
+    output = cnn(X, training=False)
+    assert cnn.fold_batch_norm() == [2, 3]
+    assert np.allclose(cnn(X, training=False), output, atol=1e-5)
+    cnn = CNN(layers_info=[["conv", 4, 3, 1, "valid"], ["conv", 4, 3, 1, "valid"], ["linear", 3]], batch_norm=True)
+    for _ in range(10): cnn(X, training=True)
+    output = cnn(X, training=False)
+    assert cnn.fold_batch_norm() == [0, 1]
+    assert np.allclose(cnn(X, training=False), output, atol=1e-5)
+
+def test_distribute():
+    """Tests that training a network created with distribute on 2 replicas gives the same weights as training on 1"""
+    X = np.random.random((32, 6, 6, 2)).astype('float32')
+    y = np.mean(X, axis=(1, 2))
+    networks = [CNN(layers_info=[["conv", 4, 3, 1, "valid"], ["maxpool", 2, 2, "valid"], ["linear", 2]], batch_norm=True,
+                    distribute=distribute) for distribute in [None, 2]]
+    networks[0](X)
+    networks[1](X)
+    networks[1].set_weights(networks[0].get_weights())
+    for network in networks:
+        network.compile(optimizer="sgd", loss="mse")
+        network.fit(X, y, batch_size=16, epochs=3, shuffle=False, verbose=0)
+    for weights, distributed_weights in zip(networks[0].get_weights(), networks[1].get_weights()):
+        assert np.allclose(weights, distributed_weights, atol=1e-5)
+
+def test_fuse_output_heads():
+    """Tests that fusing the output heads puts them into 1 Dense layer that gives the same output as 1 layer per head
+    once the weights of the network with 1 layer per head have been converted for it"""
+    with pytest.raises(AssertionError):
+        CNN(layers_info=[["conv", 2, 3, 1, "valid"], [["conv", 2, 3, 1, "valid"], ["conv", 3, 3, 1, "valid"]]],
+            output_activation=["relu", "relu"], fuse_output_heads=True)
+    X = np.random.random((8, 6, 6, 2)).astype('float32')
+    networks = [CNN(layers_info=[["conv", 4, 3, 1, "valid"], ["linear", 5], [["linear", 3], ["linear", 2]]],
+                    output_activation=["softmax", "sigmoid"], batch_norm=True, fuse_output_heads=fuse_output_heads)
+                for fuse_output_heads in [False, True]]
+    for network in networks: network(X)
+    assert len(networks[1].output_layers) == 1 and networks[1].output_layers[0].units == 5
+    networks[1].set_weights(networks[1].fuse_output_head_weights(networks[0].get_weights()))
+    assert np.allclose(networks[0](X, training=False), networks[1](X, training=False), atol=1e-6)
+
+def test_data_format():
+    """Tests that a channels_first network takes (batch, channels, height, width) data and flattens it like the PyTorch CNN
+    so that it gives the same output as the PyTorch CNN with the same weights, and that its batch norm layers fold"""
+    with pytest.raises(AssertionError):
+        CNN(layers_info=[["conv", 2, 3, 1, "valid"], ["linear", 1]], data_format="NCHW")
+    X = np.random.random((4, 3, 10, 10)).astype('float32')
+    layers_info = [["conv", 4, 3, 1, "valid"], ["maxpool", 2, 2, "valid"], ["conv", 5, 2, 1, "valid"], ["linear", 6], ["linear", 2]]
+    cnn = CNN(layers_info=layers_info, data_format="channels_first")
+    assert cnn(X).shape == (4, 2)
+    assert cnn.hidden_layers[0](X).shape == (4, 4, 8, 8)
+    pytorch_cnn = PyTorch_CNN(input_dim=(3, 10, 10), layers_info=[["conv", 4, 3, 1, 0], ["maxpool", 2, 2, 0],
+                                                                  ["conv", 5, 2, 1, 0], ["linear", 6], ["linear", 2]])
+    pytorch_layers = [layer for layer in list(pytorch_cnn.hidden_layers) + list(pytorch_cnn.output_layers)
+                      if type(layer) in [nn.Conv2d, nn.Linear]]
+    layers = [layer for layer in cnn.hidden_layers + cnn.output_layers if type(layer) in [Conv2D, Dense]]
+    with torch.no_grad():
+        for layer, pytorch_layer in zip(layers, pytorch_layers):
+            kernel, bias = layer.get_weights()
+            kernel = kernel.transpose(3, 2, 0, 1) if kernel.ndim == 4 else kernel.T
+            pytorch_layer.weight.copy_(torch.tensor(kernel))
+            pytorch_layer.bias.copy_(torch.tensor(bias))
+        assert np.allclose(cnn(X, training=False), pytorch_cnn(torch.tensor(X)).numpy(), atol=1e-5)
+    cnn = CNN(layers_info=layers_info, data_format="channels_first", batch_norm=True)
+    assert [layer.axis for layer in cnn.batch_norm_layers] == [1, 1, -1]
+    for _ in range(5): cnn(X, training=True)
+    output = cnn(X, training=False)
+    assert cnn.fold_batch_norm() == [1, 2]
+    assert np.allclose(cnn(X, training=False), output, atol=1e-5)
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from nn_builder.tensorflow.CNN import CNN
+from nn_builder.tensorflow.Input_Pipeline import Input_Pipeline
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+
+np.random.seed(0)
+X = np.random.random((50, 4)).astype('float32')
+X[:, 0] = np.random.randint(0, 5, 50)
+y = np.random.random((50, 1)).astype('float32')
+sequences = [np.random.random((length, 3)).astype('float32') for length in np.random.randint(1, 12, 30)]
+
+def create_nn():
+    """Creates an NN with an embedding layer"""
+    return NN(layers_info=[10, 1], columns_of_data_to_be_embedded=[0], embedding_dimensions=[[5, 2]])
+
+def test_user_inputs_checked():
+    """Tests that invalid user inputs raise an error"""
+    invalid_inputs = [(create_nn(), X[:, None], None, {}), (create_nn(), X, y[:10], {}), (create_nn(), X, y, {"batch_size": 0}),
+                      (create_nn(), X, y, {"shuffle": 1}), (create_nn(), X, y, {"map_fn": 3}), (create_nn(), X * 7, y, {}),
+                      (create_nn(), X + 0.5, y, {}), (CNN(layers_info=[["conv", 2, 3, 1, "valid"], ["linear", 1]]), X, y, {}),
+                      (RNN(layers_info=[["gru", 4], ["linear", 1]]), [sequences[0], X], None, {}), ("network", X, y, {})]
+    for network, x, targets, kwargs in invalid_inputs:
+        with pytest.raises(AssertionError):
+            Input_Pipeline(network, x, targets, **kwargs)
+
+def test_batches_cover_every_example_once():
+    """Tests that each epoch contains every example once in float32 batches and is reshuffled each epoch"""
+    pipeline = Input_Pipeline(create_nn(), X, y, batch_size=16, random_seed=1)
+    assert len(pipeline) == 4
+    epochs = []
+    for _ in range(2):
+        batches = list(pipeline)
+        assert [len(batch_y) for _, batch_y in batches] == [16, 16, 16, 2]
+        assert all(batch_x.dtype == tf.float32 for batch_x, _ in batches)
+        epoch_y = np.concatenate([batch_y for _, batch_y in batches])
+        assert np.array_equal(np.sort(epoch_y, axis=0), np.sort(y, axis=0))
+        epochs.append(epoch_y)
+    assert not np.array_equal(epochs[0], epochs[1])
+    batches = list(Input_Pipeline(create_nn(), X, batch_size=16, shuffle=False))
+    assert np.array_equal(np.concatenate(batches), X)
+
+def test_cnn_images_get_channels_and_cast():
+    """Tests that single channel uint8 images get a channel dimension where the network expects it and are cast to float32"""
+    images = np.random.randint(0, 255, (10, 8, 8)).astype(np.uint8)
+    cnn = CNN(layers_info=[["conv", 2, 3, 1, "valid"], ["linear", 1]])
+    batches = list(Input_Pipeline(cnn, images, batch_size=4, shuffle=False))
+    assert [batch.shape for batch in batches] == [(4, 8, 8, 1), (4, 8, 8, 1), (2, 8, 8, 1)]
+    assert batches[0].dtype == tf.float32 and np.array_equal(batches[0][..., 0], images[:4])
+    assert cnn(batches[0]).shape == (4, 1)
+    cnn = CNN(layers_info=[["conv", 2, 3, 1, "valid"], ["linear", 1]], data_format="channels_first")
+    batches = list(Input_Pipeline(cnn, images, batch_size=4, shuffle=False))
+    assert batches[0].shape == (4, 1, 8, 8) and np.array_equal(batches[0][:, 0], images[:4])
+    assert cnn(batches[0]).shape == (4, 1)
+
+def test_rnn_sequences_get_padded_with_mask():
+    """Tests that variable length sequences and per timestep targets get padded with zeros to the longest in each batch
+    along with a mask, so that the network gives the same output as for each sequence on its own, and that fit trains on
+    them"""
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(layers_info=[["gru", 4], ["linear", 1]], return_final_seq_only=return_final_seq_only)
+        targets = np.arange(30.0) / 30 if return_final_seq_only else [sequence[:, :1] for sequence in sequences]
+        pipeline = Input_Pipeline(rnn, sequences, targets, batch_size=8, shuffle=False)
+        for batch_ix, batch in enumerate(pipeline):
+            (batch_x, mask), batch_y = batch[:2]
+            batch_sequences = sequences[batch_ix * 8:(batch_ix + 1) * 8]
+            lengths = np.array([len(sequence) for sequence in batch_sequences])
+            assert batch_x.shape == (len(batch_sequences), max(lengths), 3)
+            assert np.array_equal(mask, np.arange(max(lengths))[None, :] < lengths[:, None])
+            out = rnn((batch_x, mask), training=False)
+            for row, sequence in enumerate(batch_sequences):
+                assert np.array_equal(batch_x[row, :len(sequence)], sequence)
+                assert np.all(batch_x[row, len(sequence):] == 0)
+                single_out = rnn(sequence[None], training=False)[0]
+                if return_final_seq_only: assert np.allclose(out[row], single_out, atol=1e-5)
+                else: assert np.allclose(out[row, :len(sequence)], single_out, atol=1e-5)
+            if return_final_seq_only: assert len(batch) == 2 and batch_y.shape == (len(batch_sequences),)
+            else: assert batch_y.shape == batch_x.shape[:2] + (1,) and np.array_equal(batch[2], mask)
+        rnn.compile(optimizer="adam", loss="mse")
+        history = rnn.fit(pipeline.dataset, epochs=5, verbose=0)
+        assert history.history["loss"][-1] < history.history["loss"][0]
+
+def test_rnn_per_sequence_targets_get_stacked():
+    """Tests that a list of 1 target array per variable length sequence gets stacked instead of padded like per timestep
+    targets, even when some sequences are as long as the targets"""
+    rnn = RNN(layers_info=[["gru", 4], ["linear", 2]])
+    targets = [np.random.random(2).astype('float32') for _ in sequences]
+    assert any(len(sequence) == 2 for sequence in sequences)
+    for cache, map_fn in [(True, None), (False, lambda x, y: (x, y))]:
+        pipeline = Input_Pipeline(rnn, sequences, targets, batch_size=8, shuffle=False, cache=cache, map_fn=map_fn)
+        batches = list(pipeline)
+        assert all(len(batch) == 2 for batch in batches)
+        for batch_ix, ((batch_x, mask), batch_y) in enumerate(batches):
+            assert isinstance(batch_y, tf.Tensor)
+            assert np.array_equal(batch_y, np.stack(targets[batch_ix * 8:(batch_ix + 1) * 8]))
+            assert mask.shape == batch_x.shape[:2]
+    rnn.compile(optimizer="adam", loss="mse")
+    history = rnn.fit(pipeline.dataset, epochs=5, verbose=0)
+    assert history.history["loss"][-1] < history.history["loss"][0]
+
+def test_map_fn_and_cache():
+    """Tests that map_fn gets applied to every example and that with caching it only runs in the first epoch"""
+    calls = tf.Variable(0)
+    def map_fn(x, y):
+        calls.assign_add(1)
+        return x, y * 2.0
+    for cache, expected_calls in [(True, 50), (False, 100)]:
+        calls.assign(0)
+        pipeline = Input_Pipeline(create_nn(), X, y, batch_size=16, shuffle=False, cache=cache, map_fn=map_fn)
+        for _ in range(2):
+            assert np.allclose(np.concatenate([batch_y for _, batch_y in pipeline]), y * 2.0)
+        assert calls.numpy() == expected_calls
+
+def test_stall_report_and_training():
+    """Tests that the stall report counts the batches and waiting time and that the dataset trains a network with fit"""
+    pipeline = Input_Pipeline(create_nn(), X, y, batch_size=16)
+    assert pipeline.stall_report()["stall_fraction"] == 0.0
+    for _ in pipeline: pass
+    for batch_ix, _ in enumerate(pipeline):
+        if batch_ix == 1: break
+    report = pipeline.stall_report()
+    assert report["batches"] == 6
+    assert 0 < report["stall_seconds"] <= report["total_seconds"] and 0 < report["stall_fraction"] <= 1
+    nn_instance = create_nn()
+    nn_instance.compile(optimizer="adam", loss="mse")
+    history = nn_instance.fit(pipeline.dataset, epochs=5, verbose=0)
+    assert history.history["loss"][-1] < history.history["loss"][0]
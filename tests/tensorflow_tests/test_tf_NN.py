@@ -4,6 +4,7 @@ import copy
 import random
 import numpy as np
 import tensorflow as tf
+from nn_builder.tensorflow.Fused_Embedding import Fused_Embedding
 from nn_builder.tensorflow.NN import NN
 import tensorflow.keras.initializers as initializers
 import tensorflow.keras.activations as activations
@@ -111,17 +112,16 @@ def test_linear_layers_info():
         assert output_layer.activation == activations.softmax
 
 def test_embedding_layers():
-    """Tests whether create_embedding_layers_info method works correctly"""
+    """Tests whether create_embedding_layer method works correctly"""
     for embedding_in_dim_1, embedding_out_dim_1, embedding_in_dim_2, embedding_out_dim_2 in zip(range(5, 8), range(3, 6), range(1, 4), range(24, 27)):
         nn_instance = NN( layers_info=[5], columns_of_data_to_be_embedded=[0, 1],
                          embedding_dimensions =[[embedding_in_dim_1, embedding_out_dim_1], [embedding_in_dim_2, embedding_out_dim_2]])
-        for layer in nn_instance.embedding_layers:
-            assert isinstance(layer, tf.keras.layers.Embedding)
-        assert len(nn_instance.embedding_layers) == 2
-        assert nn_instance.embedding_layers[0].input_dim == embedding_in_dim_1
-        assert nn_instance.embedding_layers[0].output_dim == embedding_out_dim_1
-        assert nn_instance.embedding_layers[1].input_dim == embedding_in_dim_2
-        assert nn_instance.embedding_layers[1].output_dim == embedding_out_dim_2
+        nn_instance.incorporate_embeddings(np.zeros((3, 2)))
+        assert isinstance(nn_instance.embedding_layer, Fused_Embedding)
+        assert [table.shape for table in nn_instance.embedding_layer.tables] == [(embedding_in_dim_1, embedding_out_dim_1),
+                                                                                (embedding_in_dim_2, embedding_out_dim_2)]
+        assert nn_instance.embedding_layer.get_embeddings(0).shape == (embedding_in_dim_1, embedding_out_dim_1)
+        assert nn_instance.embedding_layer.get_embeddings(1).shape == (embedding_in_dim_2, embedding_out_dim_2)
 
 def test_incorporate_embeddings():
     """Tests the method incorporate_embeddings"""
@@ -134,6 +134,26 @@ def test_incorporate_embeddings():
     out = nn_instance.incorporate_embeddings(X)
     assert out.shape == (N, X.shape[1]+3+4-2)
 
+def test_fused_embeddings_match_separate_embedding_layers():
+    """Tests that the fused embedding layer gives exactly the same output as an Embedding layer per column and doesn't
+    retrace inside a tf.function"""
+    X = np.random.random((20, 5)).astype('float32')
+    for column, input_dim in [(1, 7), (3, 4), (4, 9)]: X[:, column] = np.random.randint(0, input_dim, 20)
+    nn_instance = NN(layers_info=[10, 1], columns_of_data_to_be_embedded=[4, 1, 3],
+                     embedding_dimensions=[[9, 3], [7, 2], [4, 3]])
+    out = nn_instance.incorporate_embeddings(X)
+    assert len(nn_instance.embedding_layer.tables) == 2
+    embedded_data = []
+    for embedding_ix, (column, (input_dim, output_dim)) in enumerate(zip([4, 1, 3], nn_instance.embedding_dimensions)):
+        embedding_layer = tf.keras.layers.Embedding(input_dim, output_dim)
+        embedding_layer.build((None,))
+        embedding_layer.set_weights([nn_instance.embedding_layer.get_embeddings(embedding_ix)])
+        embedded_data.append(embedding_layer(X[:, column]))
+    assert np.array_equal(out, np.concatenate([X[:, [0, 2]]] + embedded_data, axis=1))
+    incorporate_embeddings = tf.function(nn_instance.incorporate_embeddings)
+    for _ in range(3): assert np.array_equal(incorporate_embeddings(X), out)
+    assert incorporate_embeddings.experimental_get_tracing_count() == 1
+
 def test_embedding_network_can_solve_simple_problem():
     """Tests whether network can solve simple problem using embeddings"""
     X = (np.random.random((N, 5)) - 0.5) * 5.0 + 20.0
@@ -332,4 +352,162 @@ def test_boston_housing_progress():
     model.compile(optimizer='adam', loss='mse')
     model.fit(x_train, y_train, epochs=200, batch_size=64)
     results = model.evaluate(x_test, y_test)
-    assert results < 30
\ No newline at end of file
+    assert results < 30
+
+def test_compile_call():
+    """Tests that compile_call gives the same output as calling the network eagerly and only traces once for all batch
+    sizes when given an input signature"""
+    X = np.random.random((20, 5)).astype('float32')
+    X[:, 0] = np.round(X[:, 0] * 5)
+    for jit_compile in [False, True]:
+        nn_instance = NN(layers_info=[10, 10, [2, 3]], output_activation=["softmax", None], batch_norm=True, dropout=0.5,
+                         columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]])
+        compiled_call = nn_instance.compile_call(input_signature=(5,), jit_compile=jit_compile)
+        for batch_size in [1, 7, 20]:
+            assert np.allclose(compiled_call(X[:batch_size]), nn_instance(X[:batch_size], training=False), atol=1e-5)
+        assert nn_instance.trace_count == 1
+        compiled_call(X, training=True)
+        assert nn_instance.trace_count == 2
+    nn_instance = NN(layers_info=[10, 1])
+    compiled_call = nn_instance.compile_call()
+    for batch_size in [1, 7, 20, 5, 13]: compiled_call(X[:batch_size])
+    assert nn_instance.trace_count <= 2
+
+def test_to_functional():
+    """Tests that to_functional creates a functional model that gives the same output and shares its weights"""
+    X = np.random.random((20, 5)).astype('float32')
+    X[:, 0] = np.round(X[:, 0] * 5)
+    nn_instance = NN(layers_info=[10, 10, [2, 3]], output_activation=["softmax", None], batch_norm=True, dropout=0.5,
+                     columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]], y_range=(-1, 1))
+    functional_model = nn_instance.to_functional((5,))
+    assert isinstance(functional_model, tf.keras.Model) and functional_model.name == "NN_functional"
+    assert np.allclose(functional_model(X, training=False), nn_instance(X, training=False), atol=1e-6)
+    assert len(functional_model.trainable_weights) == len(nn_instance.trainable_weights)
+    functional_model.compile(optimizer="adam", loss="mse")
+    functional_model.fit(X, np.random.random((20, 5)), epochs=2, verbose=0)
+    assert np.allclose(functional_model(X, training=False), nn_instance(X, training=False), atol=1e-6)
+    nn_instance.hidden_layers[0].kernel.assign(tf.zeros_like(nn_instance.hidden_layers[0].kernel))
+    assert np.allclose(functional_model(X, training=False), nn_instance(X, training=False), atol=1e-6)
+
+def test_dtype_policy():
+    """Tests that the hidden layers use the dtype policy while the output layers and output stay float32"""
+    X = np.random.random((20, 5)).astype('float32')
+    X[:, 0] = np.round(X[:, 0] * 5)
+    with pytest.raises(AssertionError):
+        NN(layers_info=[10, 1], dtype_policy="float8")
+    for dtype_policy, compute_dtype in [("mixed_bfloat16", "bfloat16"), ("mixed_float16", "float16"), ("float32", "float32")]:
+        nn_instance = NN(layers_info=[10, 10, [2, 3]], output_activation=["softmax", None], batch_norm=True, dropout=0.1,
+                         columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]], dtype_policy=dtype_policy)
+        out = nn_instance(X)
+        assert out.dtype == tf.float32
+        for layer in nn_instance.hidden_layers + [nn_instance.embedding_layer] + nn_instance.batch_norm_layers:
+            assert layer.compute_dtype == compute_dtype
+            assert layer.variable_dtype == "float32"
+        assert all(layer.compute_dtype == "float32" for layer in nn_instance.output_layers)
+        assert np.allclose(np.sum(out[:, :2], axis=1), 1.0, atol=1e-5)
+
+def test_export_for_serving(tmp_path):
+    """Tests that export_for_serving saves SavedModel and TFLite models that give the same output as the network"""
+    X = np.random.random((20, 5)).astype('float32')
+    X[:, 0] = np.round(X[:, 0] * 5)
+    nn_instance = NN(layers_info=[64, 64, [2, 3]], output_activation=["softmax", None], batch_norm=True, dropout=0.5,
+                     columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]])
+    with pytest.raises(AssertionError):
+        nn_instance.export_for_serving(str(tmp_path / "model"), (5,), format="onnx")
+    with pytest.raises(AssertionError):
+        nn_instance.export_for_serving(str(tmp_path / "model"), (5,), quantize="dynamic")
+    with pytest.raises(AssertionError):
+        nn_instance.export_for_serving(str(tmp_path / "model.tflite"), (5,), format="tflite", quantize="int8")
+    report = nn_instance.export_for_serving(str(tmp_path / "model"), (5,), representative_data=X)
+    assert report["max_abs_error"] < 1e-6 and report["size_bytes"] > 0 and report["latency_ms"] > 0
+    loaded_model = tf.saved_model.load(str(tmp_path / "model")).signatures["serving_default"]
+    assert np.allclose(loaded_model(x=tf.constant(X))["output"], nn_instance(X, training=False), atol=1e-6)
+    sizes = {}
+    for quantize, max_error in [(None, 1e-5), ("dynamic", 0.05), ("int8", 0.2)]:
+        report = nn_instance.export_for_serving(str(tmp_path / "model_{}.tflite".format(quantize)), (5,), format="tflite",
+                                                quantize=quantize, representative_data=X)
+        assert report["max_abs_error"] < max_error
+        sizes[quantize] = report["size_bytes"]
+    assert sizes["dynamic"] < sizes[None] and sizes["int8"] < sizes[None]
+
+def test_batch_norm_follows_training():
+    """Tests that batch norm uses the batch statistics and updates its moving statistics only when training"""
+    X = np.random.random((20, 5)).astype('float32') * 3.0 + 1.0
+    nn_instance = NN(layers_info=[10, 10, 1], batch_norm=True)
+    functional_model = nn_instance.to_functional((5,))
+    batch_norm_layer = nn_instance.batch_norm_layers[0]
+    for model in [nn_instance, functional_model]:
+        moving_mean = batch_norm_layer.moving_mean.numpy()
+        model(X, training=False)
+        assert np.allclose(batch_norm_layer.moving_mean.numpy(), moving_mean)
+        model(X, training=True)
+        assert not np.allclose(batch_norm_layer.moving_mean.numpy(), moving_mean)
+    moving_mean = batch_norm_layer.moving_mean.numpy()
+    assert np.allclose(nn_instance.call(X, training=False), nn_instance(X, training=False))
+    assert np.allclose(batch_norm_layer.moving_mean.numpy(), moving_mean)
+    nn_instance.call(X, training=True)
+    assert not np.allclose(batch_norm_layer.moving_mean.numpy(), moving_mean)
+    assert batch_norm_layer.momentum == 0.99
+    assert NN(layers_info=[10, 1], batch_norm=True, batch_norm_momentum=0.9).batch_norm_layers[0].momentum == 0.9
+    for invalid_momentum in [1, 1.5, -0.1]:
+        with pytest.raises(AssertionError):
+            NN(layers_info=[10, 1], batch_norm=True, batch_norm_momentum=invalid_momentum)
+    training_output = nn_instance.hidden_layers[0](X)
+    assert np.allclose(np.mean(batch_norm_layer(training_output, training=True), axis=0), 0.0, atol=1e-4)
+
+def test_fold_batch_norm():
+    """Tests that folding the batch norm layers into the layers after them doesn't change the output when not training"""
+    X = np.random.random((20, 5)).astype('float32')
+    X[:, 0] = np.round(X[:, 0] * 5)
+    assert NN(layers_info=[10, 1]).fold_batch_norm() == []
+    nn_instance = NN(layers_info=[10, 10, [2, 3]], output_activation=["softmax", None], batch_norm=True, dropout=0.5,
+                     columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]], y_range=(-1, 1))
+    with pytest.raises(AssertionError):
+        nn_instance.fold_batch_norm()
+    for _ in range(10): nn_instance(X, training=True)
+    output = nn_instance(X, training=False)
+    assert nn_instance.fold_batch_norm() == [0, 1]
+    assert np.allclose(nn_instance(X, training=False), output, atol=1e-5)
+    assert nn_instance.fold_batch_norm() == [0, 1]
+    assert np.allclose(nn_instance(X, training=False), output, atol=1e-5)
+
+def test_distribute():
+    """Tests that a network created with distribute trains on 2 replicas with all of its variables, including the batch
+    norm and dropout ones, distributed and gives the same weights as training on 1 replica"""
+    for invalid_distribute in [0, -2, 1.5, True, "cpu"]:
+        with pytest.raises(AssertionError):
+            NN(layers_info=[5, 1], distribute=invalid_distribute)
+    X = np.random.random((64, 5)).astype('float32')
+    y = np.sum(X, axis=1, keepdims=True)
+    nn_instance = NN(layers_info=[10, 10, 1], batch_norm=True, dropout=0.2, distribute=2)
+    assert nn_instance.distribute_strategy.num_replicas_in_sync == 2
+    nn_instance(X)
+    assert all(isinstance(variable.value, tf.distribute.DistributedValues) for variable in nn_instance.variables)
+    assert all(layer.synchronized for layer in nn_instance.batch_norm_layers)
+    networks = [NN(layers_info=[10, 10, 1], batch_norm=True, distribute=distribute) for distribute in [None, 2]]
+    networks[0](X)
+    networks[1](X)
+    networks[1].set_weights(networks[0].get_weights())
+    for network in networks:
+        network.compile(optimizer="sgd", loss="mse")
+        network.fit(X, y, batch_size=32, epochs=3, shuffle=False, verbose=0)
+    for weights, distributed_weights in zip(networks[0].get_weights(), networks[1].get_weights()):
+        assert np.allclose(weights, distributed_weights, atol=1e-5)
+
+def test_fuse_output_heads():
+    """Tests that fusing the output heads puts them into 1 Dense layer that gives the same output as 1 layer per head
+    once the weights of the network with 1 layer per head have been converted for it"""
+    with pytest.raises(AssertionError):
+        NN(layers_info=[5, [2, 3]], output_activation=["softmax", "linear"], fuse_output_heads=1)
+    X = np.random.random((16, 5)).astype('float32')
+    for output_activation in [["linear", "linear", "linear"], ["softmax", "sigmoid", "linear"], ["softmax", "softmax", "softmax"]]:
+        networks = [NN(layers_info=[10, [3, 1, 4]], output_activation=output_activation, batch_norm=True,
+                       fuse_output_heads=fuse_output_heads) for fuse_output_heads in [False, True]]
+        for network in networks: network(X)
+        assert len(networks[1].output_layers) == 1 and networks[1].output_layers[0].units == 8
+        networks[1].set_weights(networks[1].fuse_output_head_weights(networks[0].get_weights()))
+        assert np.allclose(networks[0](X, training=False), networks[1](X, training=False), atol=1e-6)
+    with pytest.raises(AssertionError):
+        networks[1].fuse_output_head_weights(networks[1].get_weights())
+    with pytest.raises(AssertionError):
+        networks[0].fuse_output_head_weights(networks[0].get_weights())
@@ -4,6 +4,7 @@ import random
 import tensorflow as tf
 import numpy as np
 from tensorflow.keras.layers import Dense, Concatenate, BatchNormalization, GRU, LSTM
+from nn_builder.tensorflow.Fused_Embedding import Fused_Embedding
 from nn_builder.tensorflow.RNN import RNN
 
 N = 250
@@ -340,7 +341,7 @@ def test_model_trains_with_batch_norm():
     """Tests whether a model with batch norm on can solve a simple task"""
     rnn = RNN(layers_info=[["lstm", 20], ["linear", 20], ["linear", 1]],
                        hidden_activations="relu", output_activation=None,
-                       initialiser="xavier", batch_norm=True)
+                       initialiser="xavier", batch_norm=True, batch_norm_momentum=0.9)
     assert solves_simple_problem(X, y, rnn)
 
 def test_dropout():
@@ -412,17 +413,16 @@ def test_return_final_seq_user_input_valid():
                 hidden_activations="relu", initialiser="xavier", return_final_seq_only=invalid_case)
 
 def test_embedding_layers():
-    """Tests whether create_embedding_layers_info method works correctly"""
+    """Tests whether create_embedding_layer method works correctly"""
     for embedding_in_dim_1, embedding_out_dim_1, embedding_in_dim_2, embedding_out_dim_2 in zip(range(5, 8), range(3, 6), range(1, 4), range(24, 27)):
         nn_instance = RNN( layers_info=[["gru", 20], ["lstm", 8], ["linear", 7]], columns_of_data_to_be_embedded=[0, 1],
                          embedding_dimensions =[[embedding_in_dim_1, embedding_out_dim_1], [embedding_in_dim_2, embedding_out_dim_2]])
-        for layer in nn_instance.embedding_layers:
-            assert isinstance(layer, tf.keras.layers.Embedding)
-        assert len(nn_instance.embedding_layers) == 2
-        assert nn_instance.embedding_layers[0].input_dim == embedding_in_dim_1
-        assert nn_instance.embedding_layers[0].output_dim == embedding_out_dim_1
-        assert nn_instance.embedding_layers[1].input_dim == embedding_in_dim_2
-        assert nn_instance.embedding_layers[1].output_dim == embedding_out_dim_2
+        nn_instance.incorporate_embeddings(np.zeros((3, 4, 2)))
+        assert isinstance(nn_instance.embedding_layer, Fused_Embedding)
+        assert [table.shape for table in nn_instance.embedding_layer.tables] == [(embedding_in_dim_1, embedding_out_dim_1),
+                                                                                (embedding_in_dim_2, embedding_out_dim_2)]
+        assert nn_instance.embedding_layer.get_embeddings(0).shape == (embedding_in_dim_1, embedding_out_dim_1)
+        assert nn_instance.embedding_layer.get_embeddings(1).shape == (embedding_in_dim_2, embedding_out_dim_2)
 
 def test_incorporate_embeddings():
     """Tests the method incorporate_embeddings"""
@@ -446,6 +446,26 @@ def test_incorporate_embeddings():
     out = nn_instance.incorporate_embeddings(X)
     assert out.shape == (N, 3, 34)
 
+def test_fused_embeddings_match_separate_embedding_layers():
+    """Tests that the fused embedding layer gives exactly the same output as an Embedding layer per column and doesn't
+    retrace inside a tf.function"""
+    X = np.random.random((6, 5, 4)).astype('float32')
+    for column, input_dim in [(0, 7), (2, 4), (3, 9)]: X[:, :, column] = np.random.randint(0, input_dim, (6, 5))
+    rnn = RNN(layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[3, 0, 2],
+              embedding_dimensions=[[9, 3], [7, 2], [4, 3]], static_columns_of_data_to_be_embedded=[0])
+    out = rnn.incorporate_embeddings(X)
+    embedded_data = []
+    for embedding_ix, (column, (input_dim, output_dim)) in enumerate(zip([3, 0, 2], rnn.embedding_dimensions)):
+        embedding_layer = tf.keras.layers.Embedding(input_dim, output_dim)
+        embedding_layer.build((None,))
+        embedding_layer.set_weights([rnn.embedding_layer.get_embeddings(embedding_ix)])
+        column_data = np.repeat(X[:, :1, column], 5, axis=1) if column == 0 else X[:, :, column]
+        embedded_data.append(embedding_layer(column_data))
+    assert np.array_equal(out, np.concatenate([X[:, :, [1]]] + embedded_data, axis=2))
+    incorporate_embeddings = tf.function(rnn.incorporate_embeddings)
+    for _ in range(3): assert np.array_equal(incorporate_embeddings(X), out)
+    assert incorporate_embeddings.experimental_get_tracing_count() == 1
+
 def test_embedding_network_can_solve_simple_problem():
     """Tests whether network can solve simple problem using embeddings"""
     X = (np.random.random((N, 4, 5)) - 0.5) * 5.0 + 20.0
@@ -542,3 +562,268 @@ def test_output_head_shapes_correct():
         out = nn_instance(X)
         assert out.shape[0] == N
         assert out.shape[1] == 20
+
+def test_streaming_with_state_matches_full_sequence():
+    """Tests that streaming chunks of a sequence through the network while carrying the state gives the same output as
+    putting the whole sequence through at once"""
+    X = np.random.random((4, 9, 6)).astype('float32')
+    X[:, :, 0] = np.round(X[:, :, 0] * 10)
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(layers_info=[["gru", 10], ["lstm", 7], [["lstm", 3], ["linear", 5]]], output_activation=["softmax", None],
+                  columns_of_data_to_be_embedded=[0], embedding_dimensions=[[20, 3]], batch_norm=True,
+                  return_final_seq_only=return_final_seq_only)
+        full_out = rnn(X, training=False)
+        state = rnn.init_state(4)
+        assert len(state) == 4
+        assert state[0][0].shape == (4, 10)
+        assert state[1][0].shape == (4, 7) and state[1][1].shape == (4, 7)
+        assert state[3] is None
+        chunk_outputs = []
+        for start in range(0, 9, 3):
+            out, state = rnn(X[:, start:start+3], training=False, state=state)
+            chunk_outputs.append(out)
+        if return_final_seq_only:
+            assert np.allclose(chunk_outputs[-1], full_out, atol=1e-5)
+        else:
+            assert np.allclose(np.concatenate(chunk_outputs, axis=1), full_out, atol=1e-5)
+        assert not np.allclose(chunk_outputs[-1], rnn(X[:, 6:9], training=False), atol=1e-5)
+
+def test_bidirectional_layers():
+    """Tests that bidirectional layers get created and output the right shapes"""
+    X = np.random.random((6, 8, 5)).astype('float32')
+    rnn = RNN(layers_info=[["bigru", 10], ["bilstm", 7], ["gru", 4], [["bilstm", 3], ["linear", 2]]],
+              output_activation=[None, "softmax"], batch_norm=True)
+    assert type(rnn.hidden_layers[0]) == tf.keras.layers.Bidirectional
+    assert type(rnn.hidden_layers[0].forward_layer) == GRU
+    assert type(rnn.hidden_layers[1].forward_layer) == LSTM
+    assert rnn(X).shape == (6, 8)
+    assert rnn.hidden_layers[2].cell.kernel.shape[0] == 14
+    rnn = RNN(layers_info=[["bilstm", 7], ["linear", 3]], return_final_seq_only=False)
+    assert rnn(X).shape == (6, 8, 3)
+    with pytest.raises(AssertionError):
+        rnn.init_state(6)
+
+def test_bidirectional_final_timestep_sees_whole_sequence():
+    """Tests that with return_final_seq_only the backward direction's output is taken from where it has seen the whole
+    sequence"""
+    X = np.random.random((4, 7, 5)).astype('float32')
+    rnn = RNN(layers_info=[["bilstm", 6], ["linear", 3]])
+    out = rnn(X)
+    full_output = rnn.hidden_layers[0](X)[0]
+    expected = rnn.output_layers[0](tf.concat([full_output[:, -1, :6], full_output[:, 0, 6:]], axis=1))
+    assert np.allclose(out, expected, atol=1e-6)
+
+def test_attention_layers():
+    """Tests that attention layers get created correctly and are causal"""
+    for invalid_layer in [["attention", 6, 4], ["attention", 8], ["attention", 8, 0], ["attention", 8, 2, "yes"],
+                          ["attention", 8, 2, True, 1]]:
+        with pytest.raises(AssertionError):
+            RNN(layers_info=[invalid_layer, ["linear", 1]])
+    rnn = RNN(layers_info=[["attention", 8, 2, True], ["attention", 8, 4], ["lstm", 5], ["linear", 2]],
+              return_final_seq_only=False)
+    X = np.random.random((3, 15, 4)).astype('float32')
+    out = rnn(X, training=False)
+    assert out.shape == (3, 15, 2)
+    assert rnn.hidden_layers[0].input_projection is not None and rnn.hidden_layers[0].positional_encoding
+    assert rnn.hidden_layers[1].input_projection is None and not rnn.hidden_layers[1].positional_encoding
+    assert rnn.hidden_layers[1].attention.num_heads == 4
+    with pytest.raises(AssertionError):
+        rnn.init_state(3)
+    X_changed = X.copy()
+    X_changed[:, 9:] = np.random.random((3, 6, 4))
+    out_changed = rnn(X_changed, training=False)
+    assert np.allclose(out[:, :9], out_changed[:, :9], atol=1e-5)
+    assert not np.allclose(out[:, 9:], out_changed[:, 9:], atol=1e-5)
+    rnn = RNN(layers_info=[["attention", 8, 2], [["attention", 4, 1], ["linear", 3]]], output_activation=["softmax", None])
+    assert rnn(X).shape == (3, 7)
+
+def test_static_embedding_columns():
+    """Tests that static embedding columns give the same output as embedding them at every timestep"""
+    X = np.random.random((5, 6, 4)).astype('float32')
+    X[:, :, 0] = np.round(X[:, :, 0] * 10)
+    X[:, :, 2] = np.arange(5)[:, None]
+    with pytest.raises(AssertionError):
+        RNN(layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+            embedding_dimensions=[[20, 3], [5, 4]], static_columns_of_data_to_be_embedded=[1])
+    rnn = RNN(layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+              embedding_dimensions=[[20, 3], [5, 4]], return_final_seq_only=False)
+    static_rnn = RNN(layers_info=[["gru", 10], ["linear", 2]], columns_of_data_to_be_embedded=[0, 2],
+                     embedding_dimensions=[[20, 3], [5, 4]], return_final_seq_only=False,
+                     static_columns_of_data_to_be_embedded=[2])
+    embedded = static_rnn.incorporate_embeddings(X)
+    assert embedded.shape == (5, 6, 9)
+    X_after_first_timestep_ignored = X.copy()
+    X_after_first_timestep_ignored[:, 1:, 2] = 100.0
+    assert np.array_equal(static_rnn.incorporate_embeddings(X_after_first_timestep_ignored), embedded)
+    rnn(X)
+    static_rnn(X)
+    rnn.set_weights(static_rnn.get_weights())
+    assert np.allclose(rnn.incorporate_embeddings(X), embedded)
+    assert np.allclose(rnn(X), static_rnn(X), atol=1e-6)
+
+def test_rollout():
+    """Tests that rollout gives the same forecasts as putting the history plus the fed back predictions through call"""
+    history = np.random.random((6, 10, 3)).astype('float32')
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(layers_info=[["gru", 12], ["lstm", 8], ["linear", 3]], return_final_seq_only=return_final_seq_only)
+        predictions = rnn.rollout(history, horizon=5)
+        assert predictions.shape == (6, 5, 3)
+        for step in range(5):
+            out = rnn(tf.concat([history, predictions[:, :step]], axis=1), training=False)
+            out = out if return_final_seq_only else out[:, -1]
+            assert np.allclose(predictions[:, step], out, atol=1e-5)
+    rnn = RNN(layers_info=[["gru", 12], ["linear", 1]])
+    feedback_fn = lambda prediction, previous_input: tf.concat([prediction, previous_input[:, 1:]], axis=1)
+    assert rnn.rollout(history, horizon=4, feedback_fn=feedback_fn).shape == (6, 4, 1)
+    with pytest.raises(AssertionError):
+        rnn.rollout(history, horizon=0)
+
+def test_compile_call():
+    """Tests that compile_call gives the same output as calling the network eagerly and only traces once for all batch
+    sizes and sequence lengths when given an input signature"""
+    X = np.random.random((20, 9, 4)).astype('float32')
+    for jit_compile in [False, True]:
+        rnn = RNN(layers_info=[["gru", 10], ["lstm", 5], [["linear", 2], ["linear", 3]]], output_activation=["softmax", None],
+                  batch_norm=True, dropout=0.3)
+        compiled_call = rnn.compile_call(input_signature=(None, 4), jit_compile=jit_compile)
+        for batch_size, seq_length in [(1, 9), (7, 3), (20, 9)]:
+            assert np.allclose(compiled_call(X[:batch_size, :seq_length]), rnn(X[:batch_size, :seq_length], training=False),
+                               atol=1e-5)
+        assert rnn.trace_count == 1
+
+def test_to_functional():
+    """Tests that to_functional creates a functional model that gives the same output and shares its weights"""
+    X = np.random.random((6, 7, 5)).astype('float32')
+    X[:, :, 0] = np.round(X[:, :, 0] * 5)
+    X[:, :, 1] = np.arange(6)[:, None]
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(layers_info=[["bigru", 10], ["attention", 8, 2, True], ["lstm", 5], ["linear", 4], [["linear", 2], ["linear", 3]]],
+                  output_activation=["softmax", None], columns_of_data_to_be_embedded=[0, 1],
+                  embedding_dimensions=[[10, 3], [10, 2]], static_columns_of_data_to_be_embedded=[1], batch_norm=True,
+                  dropout=0.3, y_range=(-2, 2), return_final_seq_only=return_final_seq_only)
+        functional_model = rnn.to_functional((None, 5))
+        assert np.allclose(functional_model(X, training=False), rnn(X, training=False), atol=1e-6)
+        assert np.allclose(functional_model(X[:, :4], training=False), rnn(X[:, :4], training=False), atol=1e-6)
+        assert len(functional_model.weights) == len(rnn.weights)
+        rnn.output_layers[0].kernel.assign(tf.zeros_like(rnn.output_layers[0].kernel))
+        assert np.allclose(functional_model(X, training=False), rnn(X, training=False), atol=1e-6)
+
+def test_dtype_policy():
+    """Tests that the hidden layers use the dtype policy while the output layers, output and streamed output state stay
+    float32"""
+    X = np.random.random((6, 7, 5)).astype('float32')
+    X[:, :, 0] = np.round(X[:, :, 0] * 5)
+    rnn = RNN(layers_info=[["bigru", 10], ["attention", 8, 2, True], ["lstm", 5], ["linear", 4], [["linear", 2], ["linear", 3]]],
+              output_activation=["softmax", None], columns_of_data_to_be_embedded=[0], embedding_dimensions=[[10, 3]],
+              batch_norm=True, dropout=0.3, y_range=(-2, 2), dtype_policy="mixed_bfloat16")
+    assert rnn(X).dtype == tf.float32
+    assert all(layer.compute_dtype == "bfloat16" for layer in rnn.hidden_layers + [rnn.embedding_layer])
+    assert rnn.hidden_layers[1].attention.compute_dtype == "bfloat16"
+    assert all(layer.compute_dtype == "float32" for layer in rnn.output_layers)
+    rnn = RNN(layers_info=[["gru", 10], [["lstm", 2], ["linear", 3]]], output_activation=["softmax", None],
+              dtype_policy="mixed_float16")
+    out, state = rnn(X, state=rnn.init_state(6))
+    assert out.dtype == tf.float32
+    assert state[0][0].dtype == tf.float16 and state[1][0].dtype == tf.float32
+
+def test_export_for_serving(tmp_path):
+    """Tests that export_for_serving saves SavedModel and TFLite models that give the same output as the network"""
+    X = np.random.random((8, 7, 5)).astype('float32')
+    rnn = RNN(layers_info=[["gru", 10], ["lstm", 5], ["linear", 4], [["linear", 2], ["linear", 3]]],
+              output_activation=["softmax", None], batch_norm=True)
+    report = rnn.export_for_serving(str(tmp_path / "model"), (None, 5), representative_data=X)
+    assert report["max_abs_error"] < 1e-6
+    loaded_model = tf.saved_model.load(str(tmp_path / "model")).signatures["serving_default"]
+    assert np.allclose(loaded_model(x=tf.constant(X[:, :4]))["output"], rnn(X[:, :4], training=False), atol=1e-6)
+    for kwargs in [{"input_shape": (None, 5), "batch_size": 4}, {"input_shape": (7, 5)},
+                   {"input_shape": (7, 5), "batch_size": 4, "quantize": "int8"}]:
+        with pytest.raises(AssertionError):
+            rnn.export_for_serving(str(tmp_path / "model.tflite"), format="tflite", representative_data=X, **kwargs)
+    for quantize, max_error in [(None, 1e-5), ("dynamic", 0.05)]:
+        report = rnn.export_for_serving(str(tmp_path / "model.tflite"), (7, 5), format="tflite", quantize=quantize,
+                                        representative_data=X, batch_size=4)
+        assert report["max_abs_error"] < max_error
+
+def test_fold_batch_norm():
+    """Tests that folding the batch norm layers into the linear layers after them doesn't change the output when not
+    training and that batch norm layers followed by recurrent layers are kept"""
+    X = np.random.random((6, 7, 5)).astype('float32')
+    for return_final_seq_only in [True, False]:
+        rnn = RNN(layers_info=[["bigru", 10], ["lstm", 5], ["linear", 4], [["linear", 2], ["linear", 3]]],
+                  output_activation=["softmax", None], batch_norm=True, return_final_seq_only=return_final_seq_only)
+        for _ in range(10): rnn(X, training=True)
+        output = rnn(X, training=False)
+        assert rnn.fold_batch_norm() == [1, 2]
+        assert np.allclose(rnn(X, training=False), output, atol=1e-5)
+
+def test_variable_length_sequences():
+    """Tests that padded sequences with a mask and ragged sequences give the same output as putting each sequence through
+    the network on its own"""
+    lengths = [3, 7, 5, 1]
+    X = np.random.random((4, 9, 5)).astype('float32')
+    X[:, :, 0] = np.round(X[:, :, 0] * 5)
+    mask = np.arange(9)[None, :] < np.array(lengths)[:, None]
+    ragged_X = tf.RaggedTensor.from_tensor(X, lengths=lengths)
+    for layers_info, output_activation, y_range in [([["gru", 6], ["lstm", 5], ["linear", 3]], None, (-1, 3)),
+                                                    ([["bigru", 6], ["attention", 4, 2], ["lstm", 5],
+                                                      [["lstm", 3], ["linear", 2]]], ["softmax", None], ())]:
+        for return_final_seq_only in [True, False]:
+            rnn = RNN(layers_info=layers_info, output_activation=output_activation, batch_norm=True,
+                      columns_of_data_to_be_embedded=[0], embedding_dimensions=[[6, 2]],
+                      return_final_seq_only=return_final_seq_only, y_range=y_range)
+            masked_output = rnn(X, training=False, mask=mask)
+            ragged_output = rnn(ragged_X, training=False)
+            assert masked_output.shape[:-1] == ((4,) if return_final_seq_only else (4, 9))
+            for ix, length in enumerate(lengths):
+                single_output = rnn(X[ix:ix + 1, :length], training=False)[0]
+                if return_final_seq_only:
+                    assert np.allclose(masked_output[ix], single_output, atol=1e-5)
+                    assert np.allclose(ragged_output[ix], single_output, atol=1e-5)
+                else:
+                    assert np.allclose(masked_output[ix, :length], single_output, atol=1e-5)
+                    assert np.all(np.asarray(masked_output)[ix, length:] == 0)
+                    assert np.allclose(ragged_output[ix].numpy(), single_output, atol=1e-5)
+            assert isinstance(ragged_output, tf.RaggedTensor) != return_final_seq_only
+            rnn(X, training=True, mask=mask)
+
+def test_streaming_variable_length_chunks():
+    """Tests that streaming chunks with a mask carries on each sequence's state from its last real timestep"""
+    X = np.random.random((3, 8, 4)).astype('float32')
+    rnn = RNN(layers_info=[["gru", 6], ["lstm", 5], ["linear", 2]], return_final_seq_only=True)
+    first_chunk_lengths = [2, 5, 0]
+    mask = np.arange(5)[None, :] < np.array(first_chunk_lengths)[:, None]
+    _, state = rnn(X[:, :5], training=False, state=rnn.init_state(3), mask=mask)
+    second_chunks = [X[ix, length:] for ix, length in enumerate(first_chunk_lengths)]
+    out, _ = rnn(tf.ragged.constant(second_chunks, ragged_rank=1), training=False, state=state)
+    assert np.allclose(out, rnn(X, training=False), atol=1e-5)
+
+def test_distribute():
+    """Tests that training a network created with distribute on 2 replicas gives the same weights as training on 1"""
+    X = np.random.random((32, 6, 3)).astype('float32')
+    X[:, :, 0] = np.random.randint(0, 4, (32, 6))
+    y = np.sum(X, axis=1)
+    networks = [RNN(layers_info=[["lstm", 8], ["gru", 6], ["linear", 3]], batch_norm=True, columns_of_data_to_be_embedded=[0],
+                    embedding_dimensions=[[4, 2]], distribute=distribute) for distribute in [None, 2]]
+    networks[0](X)
+    networks[1](X)
+    networks[1].set_weights(networks[0].get_weights())
+    for network in networks:
+        network.compile(optimizer="sgd", loss="mse")
+        network.fit(X, y, batch_size=16, epochs=3, shuffle=False, verbose=0)
+    for weights, distributed_weights in zip(networks[0].get_weights(), networks[1].get_weights()):
+        assert np.allclose(weights, distributed_weights, atol=1e-5)
+
+def test_fuse_output_heads():
+    """Tests that fusing the output heads puts them into 1 Dense layer that gives the same output as 1 layer per head
+    once the weights of the network with 1 layer per head have been converted for it"""
+    with pytest.raises(AssertionError):
+        RNN(layers_info=[["gru", 4], [["gru", 2], ["linear", 3]]], output_activation=["relu", "relu"], fuse_output_heads=True)
+    X = np.random.random((8, 5, 3)).astype('float32')
+    for return_final_seq_only in [True, False]:
+        networks = [RNN(layers_info=[["lstm", 6], [["linear", 3], ["linear", 2]]], output_activation=["softmax", "sigmoid"],
+                        return_final_seq_only=return_final_seq_only, fuse_output_heads=fuse_output_heads)
+                    for fuse_output_heads in [False, True]]
+        for network in networks: network(X)
+        assert len(networks[1].output_layers) == 1 and networks[1].output_layers[0].units == 5
+        networks[1].set_weights(networks[1].fuse_output_head_weights(networks[0].get_weights()))
+        assert np.allclose(networks[0](X, training=False), networks[1](X, training=False), atol=1e-6)
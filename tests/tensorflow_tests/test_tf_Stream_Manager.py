@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from nn_builder.tensorflow.NN import NN
+from nn_builder.tensorflow.RNN import RNN
+from nn_builder.tensorflow.Stream_Manager import Stream_Manager
+
+np.random.seed(0)
+streams = {stream_id: np.random.random((12, 3)).astype('float32') for stream_id in ["a", "b", "c", 7, 8]}
+
+def create_rnn():
+    """Creates an RNN with GRU and LSTM layers that returns the output at every timestep"""
+    return RNN(layers_info=[["gru", 5], ["lstm", 4], ["linear", 2]], return_final_seq_only=False)
+
+def test_user_inputs_checked():
+    """Tests that invalid user inputs raise an error"""
+    invalid_inputs = [(NN(layers_info=[5, 1]), 8), (create_rnn(), 0), (create_rnn(), 2.0),
+                      (RNN(layers_info=[["bigru", 5], ["linear", 1]]), 8),
+                      (RNN(layers_info=[["attention", 4, 2], ["linear", 1]]), 8)]
+    for network, initial_capacity in invalid_inputs:
+        with pytest.raises(AssertionError):
+            Stream_Manager(network, initial_capacity)
+    manager = Stream_Manager(create_rnn())
+    with pytest.raises(AssertionError):
+        manager.step(["a", "a"], np.stack([streams["a"][:4]] * 2))
+    with pytest.raises(AssertionError):
+        manager.step(["a", "b"], streams["a"][None, :4])
+
+def test_streaming_matches_whole_sequences():
+    """Tests that stepping through interleaved streams chunk by chunk gives the same output as putting each whole stream
+    through the network at once, including once more streams are open than the initial capacity"""
+    rnn = create_rnn()
+    manager = Stream_Manager(rnn, initial_capacity=2)
+    expected = {stream_id: rnn(stream[None], training=False)[0] for stream_id, stream in streams.items()}
+    steps = [["a", "b"], ["c", "a", 7], ["b", 8], ["c", 7, "a"], ["b", 8, "c", 7], [8]]
+    positions = {stream_id: 0 for stream_id in streams}
+    for stream_ids in steps:
+        chunk_length = np.random.randint(1, 5) if len(stream_ids) > 1 else 4
+        chunk_length = min([chunk_length] + [12 - positions[stream_id] for stream_id in stream_ids])
+        x = np.stack([streams[stream_id][positions[stream_id]:positions[stream_id] + chunk_length] for stream_id in stream_ids])
+        out = manager.step(stream_ids, x)
+        for row, stream_id in enumerate(stream_ids):
+            position = positions[stream_id]
+            assert np.allclose(out[row], expected[stream_id][position:position + chunk_length], atol=1e-5)
+            positions[stream_id] += chunk_length
+    assert len(manager) == 5 and manager.capacity == 8
+    assert manager.step_network.experimental_get_tracing_count() <= 2
+
+def test_mask_keeps_state_at_last_real_timestep():
+    """Tests that padded timesteps at the end of a chunk don't change the state the stream carries on from"""
+    rnn = create_rnn()
+    manager = Stream_Manager(rnn)
+    x = np.stack([streams["a"][:4], np.concatenate([streams["b"][:2], np.zeros((2, 3), 'float32')])])
+    manager.step(["a", "b"], x, mask=np.array([[True] * 4, [True, True, False, False]]))
+    out = manager.step(["b"], streams["b"][None, 2:6])
+    assert np.allclose(out[0], rnn(streams["b"][None, :6], training=False)[0, 2:], atol=1e-5)
+
+def test_reset():
+    """Tests that a stream that gets reset starts again from a zero state and that its row gets reused"""
+    rnn = create_rnn()
+    manager = Stream_Manager(rnn)
+    manager.step(["a", "b"], np.stack([streams["a"][:4], streams["b"][:4]]))
+    row = manager.stream_rows["a"]
+    manager.reset("a")
+    manager.reset("not a stream")
+    assert len(manager) == 1 and "a" not in manager.stream_rows
+    out = manager.step(["c"], streams["c"][None, :4])
+    assert manager.stream_rows["c"] == row
+    assert np.allclose(out[0], rnn(streams["c"][None, :4], training=False)[0], atol=1e-5)
+    out = manager.step(["b"], streams["b"][None, 4:8])
+    assert np.allclose(out[0], rnn(streams["b"][None, :8], training=False)[0, 4:], atol=1e-5)
+    manager.reset()
+    assert len(manager) == 0
+    assert all(np.all(array == 0) for layer_state in manager.states if layer_state is not None for array in layer_state)